@@ -17,6 +17,7 @@ setup(
         "qdarkstyle",
         "qimage2ndarray",
         "flammkuchen",
+        "tables",
         "anytree",
         "pims",
         "GitPython",
@@ -73,7 +73,7 @@ class Stytra:
             preprocessing_method: str, optional
                "prefilter" or "bgsub"
             method: str
-                one of "tail", "eyes" or "fish"
+                one of "tail", "multi_tail" (several embedded fish), "eyes" or "fish"
             estimator: str or class
                 for closed-loop experiments: either "vigor" for embedded experiments
                     or "position" for freely-swimming ones. A custom estimator can be supplied.
@@ -85,6 +85,16 @@ class Stytra:
                     potentially overfilling it
                 kbit_rate: int
                     for mp4 format, target kilobits per second of video
+                codec: str
+                    for the video formats, mpeg4 (default), libx264 or ffv1
+                lossless: bool (False)
+                    for the video formats, to encode the frames without loss,
+                    with ffv1 (default) or libx264
+                segment_frames: int, optional
+                    to split the recording in files of this number of frames,
+                    listed in a video_index.json file
+                segment_minutes: float, optional
+                    to split the recording in files of this duration
 
         embedded : bool
             if not embedded, use circle calibrator
@@ -117,6 +127,16 @@ class Stytra:
             number of tracking processes to be used. Using more than 1 can improve performance
             but also cause issues in state-dependent tracking functions.
 
+        tracking_timing : bool
+            if True, the time spent in each step of the tracking is measured,
+            displayed in a dock of the main window and saved with the metadata.
+
+        closed_loop_latency : bool
+            if True, the latency from the acquisition of each camera frame to
+            its tracking, its use by the estimator and the painting of the
+            stimulus is measured, displayed in a dock of the main window
+            and saved in a log.
+
     """
 
     def __init__(self, recording=None, exec=True, app=None, **kwargs):
@@ -4,10 +4,10 @@ import numpy as np
 from queue import Empty
 import pandas as pd
 from collections import namedtuple
-from bisect import bisect_right
 from os.path import basename
+from time import perf_counter
 
-from stytra.utilities import save_df
+from stytra.utilities import save_df, TimingRecorder
 
 
 class Accumulator(QObject):
@@ -15,8 +15,6 @@ class Accumulator(QObject):
         super().__init__()
         self.name = name
         self.exp = experiment
-        self.stored_data = []
-        self.times = []
         self.max_history_if_not_running = max_history_if_not_running
 
 
@@ -24,29 +22,44 @@ class DataFrameAccumulator(Accumulator):
     """Abstract class for accumulating streams of data.
 
     It is use to save or plot in real time data from stimulus logs or
-    behavior tracking. Data is stored in a list in the stored_data
-    attribute.
+    behavior tracking. Data is stored in a preallocated float64 array
+    with one contiguous column for the timestamp and one for each of the
+    accumulated values, so the t column and every data column can be read
+    without copying.
 
     Specific methods
-    for updating the stored_data list (e.g., by acquiring data from a
+    for updating the stored data (e.g., by acquiring data from a
     Queue or a DynamicStimulus attribute) are defined in subclasses of the
     Accumulator.
 
-    Data that end up in the stored_data list must be NamedTuples where the first
-    element is a timestamp.
-    Therefore, stored_data of an Accumulator that is fed 2 values will be
+    Data that are fed to the accumulator must be NamedTuples, and their
+    fields define the columns. The first column is always the timestamp,
+    therefore the data of an Accumulator that is fed 2 values will be
     something like
-    [(t_0, x_0, y_0), (t_0, x_0, y_0), ...]
+    [[t_0, x_0, y_0], [t_1, x_1, y_1], ...]
 
+    The buffer grows by doubling as long as max_length is None. If
+    max_length is given, the accumulator works as a ring buffer keeping only
+    the last max_length samples. In both cases, the arrays returned by
+    :meth:`get_last_n() <DataFrameAccumulator.get_last_n()>` are views on
+    the buffer, valid until the next update of the accumulator. The number
+    of samples received since the last reset is kept in n_received, so that
+    consumers can pick up only the samples which are new to them, and the
+    number of resets in n_resets, so that they can tell when to start over.
 
     Data can be retrieved from the Accumulator as a pandas DataFrame with the
-    :meth:`get_dataframe() <Accumulator.get_dataframe()>` method.
+    :meth:`get_dataframe() <Accumulator.get_dataframe()>` method, which
+    is meant to be used only for saving.
 
 
     Parameters
     ----------
     fps_calc_points : int
         number of data points used to calculate the sampling rate of the data.
+    max_length : int
+        if not None, maximal number of samples kept (ring buffer mode)
+    initial_length : int
+        number of samples preallocated for a growable buffer
 
     Returns
     -------
@@ -58,23 +71,53 @@ class DataFrameAccumulator(Accumulator):
     sig_acc_reset = pyqtSignal()
     sig_acc_init = pyqtSignal()
 
-    def __init__(self, *args, fps_calc_points=10, monitored_headers=None, **kwargs):
+    def __init__(
+        self,
+        *args,
+        fps_calc_points=10,
+        monitored_headers=None,
+        max_length=None,
+        initial_length=1024,
+        **kwargs
+    ):
         super().__init__(*args, **kwargs)
         """ """
         self.plot_columns = monitored_headers
         self.fps_calc_points = fps_calc_points
+        self.max_length = max_length
+        self.initial_length = initial_length
         self._header_dict = None
+        self._tupletype = None
+
+        # the data live in the rows [_i_start, _i_end) of _data
+        self._data = None
+        self._i_start = 0
+        self._i_end = 0
+
+        # number of samples received since the last reset, including
+        # the ones which have been discarded
+        self.n_received = 0
+        self.n_resets = 0
+
+    def __len__(self):
+        return self._i_end - self._i_start
 
     def __getitem__(self, item):
         if isinstance(item, tuple):
-            return np.array(getattr(k, item[1]) for k in self.stored_data[item[0]])
+            return self.get_last_n()[item[0], self.header_dict[item[1]]]
 
         if isinstance(item, str):
-            return np.array(getattr(k, item[1]) for k in self.stored_data)
+            return self.get_last_n()[:, self.header_dict[item]]
 
     @property
     def t(self):
-        return np.array(self.times)
+        if self._data is None:
+            return np.empty(0)
+        return self._data[self._i_start : self._i_end, 0]
+
+    @property
+    def times(self):
+        return self.t
 
     def values_at_abs_time(self, time):
         """ Finds the values in the accumulator closest to the datetime time
@@ -90,15 +133,14 @@ class DataFrameAccumulator(Accumulator):
 
         """
         find_time = (time - self.exp.t0).total_seconds()
-        i = bisect_right(self.times, find_time)
-        return self.stored_data[i - 1]
+        i = np.searchsorted(self.t, find_time, side="right")
+        return self._tupletype(*self._data[self._i_start + max(i - 1, 0), 1:])
 
     @property
     def columns(self):
-        try:
-            return ("t",) + self.stored_data[-1]._fields
-        except IndexError:
+        if self._tupletype is None:
             raise ValueError("Accumulator empty, data types not known")
+        return ("t",) + self._tupletype._fields
 
     @property
     def header_dict(self):
@@ -124,26 +166,123 @@ class DataFrameAccumulator(Accumulator):
         if monitored_headers is not None:
             self.plot_columns = monitored_headers
 
-        self.stored_data = []
-        self.times = []
+        self._data = None
+        self._i_start = 0
+        self._i_end = 0
+        self.n_received = 0
+        self.n_resets += 1
 
         self._header_dict = None
 
+    def _set_tupletype(self, tupletype):
+        """ Sets the type of the accumulated data, which determines the
+        columns of the buffer
+        """
+        self._tupletype = tupletype
+        self._header_dict = None
+        self._data = None
+        self._i_start = 0
+        self._i_end = 0
+        self.n_received = 0
+        self.n_resets += 1
+
+    def _make_room(self):
+        """ Called when the end of the buffer is reached: the data is moved
+        to the beginning of the buffer if it takes up less than half of it,
+        otherwise the buffer is doubled in size.
+        """
+        n = len(self)
+        if self._i_start > 0 and n <= self._data.shape[0] // 2:
+            self._data[:n] = self._data[self._i_start : self._i_end]
+        else:
+            new_data = np.empty(
+                (self._data.shape[0] * 2, self._data.shape[1]), order="F"
+            )
+            new_data[:n] = self._data[self._i_start : self._i_end]
+            self._data = new_data
+        self._i_start = 0
+        self._i_end = n
+
+    def _reserve(self, n):
+        """ Makes sure that n rows can be added at the end of the buffer """
+        if self._data is None:
+            if self.max_length is not None:
+                # with twice the room, moving the data back to the start
+                # happens only once every max_length samples
+                buffer_length = 2 * self.max_length
+            else:
+                buffer_length = max(self.initial_length, n)
+            self._data = np.empty(
+                (buffer_length, len(self._tupletype._fields) + 1), order="F"
+            )
+            self._i_start = 0
+            self._i_end = 0
+        while self._i_end + n > self._data.shape[0]:
+            self._make_room()
+
+    def _append(self, t, values):
+        """ Appends a timestamp and the corresponding values
+
+        Parameters
+        ----------
+        t : float
+            time in seconds
+        values : tuple
+            the values, in the same order as the columns of the accumulator
+
+        """
+        self._reserve(1)
+
+        self._data[self._i_end, 0] = t
+        self._data[self._i_end, 1:] = values
+        self._i_end += 1
+        self.n_received += 1
+
+        if self.max_length is not None and len(self) > self.max_length:
+            self._i_start = self._i_end - self.max_length
+
+    def _append_block(self, t, values):
+        """ Appends many rows at once
+
+        Parameters
+        ----------
+        t : np.ndarray
+            N times in seconds
+        values : np.ndarray
+            NxJ array of values, in the same order as the columns of the
+            accumulator
+
+        """
+        self.n_received += len(t)
+        if self.max_length is not None:
+            t = t[-self.max_length :]
+            values = values[-self.max_length :]
+        n = len(t)
+        self._reserve(n)
+
+        self._data[self._i_end : self._i_end + n, 0] = t
+        self._data[self._i_end : self._i_end + n, 1:] = values
+        self._i_end += n
+
+        if self.max_length is not None and len(self) > self.max_length:
+            self._i_start = self._i_end - self.max_length
+
     def trim_data(self):
         if (
             not self.exp.protocol_runner.running
-            and len(self.times) > self.max_history_if_not_running * 1.5
+            and len(self) > self.max_history_if_not_running * 1.5
         ):
-            self.times[: -self.max_history_if_not_running] = []
-            self.stored_data[: -self.max_history_if_not_running] = []
+            self._i_start = self._i_end - self.max_history_if_not_running
 
     def get_fps(self):
         """ """
+        if len(self) < self.fps_calc_points:
+            return 0.0
         try:
-            last_t = self.times[-1]
-            t_minus_dif = self.times[-self.fps_calc_points]
-            return self.fps_calc_points / (last_t - t_minus_dif)
-        except (IndexError, ValueError, ZeroDivisionError, OverflowError):
+            last_t = self._data[self._i_end - 1, 0]
+            t_minus_dif = self._data[self._i_end - self.fps_calc_points, 0]
+            return self.fps_calc_points / float(last_t - t_minus_dif)
+        except (ValueError, ZeroDivisionError, OverflowError):
             return 0.0
 
     def get_last_n(self, n=None):
@@ -159,22 +298,20 @@ class DataFrameAccumulator(Accumulator):
         -------
         np.array
             NxJ Array containing the last n data points, where J is the
-            number of values collected at each timepoint + 1 (the timestamp)
+            number of values collected at each timepoint + 1 (the timestamp).
+            The array is a view on the accumulator buffer, and the
+            column indices are given by the header_dict property
 
         """
         if n is not None:
-            last_n = min(n, len(self.stored_data))
+            last_n = min(n, len(self))
         else:
-            last_n = len(self.stored_data)
+            last_n = len(self)
 
-        if last_n == 0:
+        if last_n <= 0:
             return None
 
-        df = pd.DataFrame.from_records(
-            self.stored_data[-last_n:], columns=self.stored_data[-1]._fields
-        )
-        df["t"] = np.array(self.times[-last_n:])
-        return df
+        return self._data[self._i_end - last_n : self._i_end]
 
     def get_last_t(self, t):
         """
@@ -203,7 +340,17 @@ class DataFrameAccumulator(Accumulator):
     def get_dataframe(self):
         """Returns pandas DataFrame with data and headers.
         """
-        return self.get_last_n(len(self.stored_data))
+        data = self.get_last_n()
+        if data is None:
+            return None
+        df = pd.DataFrame(
+            {
+                col: data[:, i + 1].copy()
+                for i, col in enumerate(self._tupletype._fields)
+            }
+        )
+        df["t"] = data[:, 0].copy()
+        return df
 
     def save(self, path, format="csv"):
         """ Saves the content of the accumulator in a tabular format.
@@ -226,32 +373,35 @@ class DataFrameAccumulator(Accumulator):
         return basename(saved_filename)
 
     def is_empty(self):
-        return len(self.stored_data) == 0
+        return len(self) == 0
 
 
 class QueueDataAccumulator(DataFrameAccumulator):
     """General class for retrieving data from a Queue.
 
-    The QueueDataAccumulator takes as input a multiprocessing.Queue object
+    The QueueDataAccumulator takes as input a NamedTupleArrayQueue object
     and retrieves data from it whenever its :meth:`update_list()
     <QueueDataAccumulator.update_list()>` method is called.
-    All the data are then put in the stored_data list.
+    All the data are then put in the accumulator buffer.
     It is usually connected with a QTimer() timeout to make sure that data
     from the Queue are constantly retrieved.
 
     Parameters
     ----------
-    data_queue : (multiprocessing.Queue object)
+    data_queue : (NamedTupleArrayQueue object)
         queue from witch to retrieve data.
     header_list : list of str
         headers for the data to stored.
+    latency_log : LatencyLog
+        if the queue records the latency, the log which is notified of
+        the latest frame received
 
     Returns
     -------
 
     """
 
-    def __init__(self, data_queue, **kwargs):
+    def __init__(self, data_queue, latency_log=None, **kwargs):
         """ """
         super().__init__(**kwargs)
 
@@ -259,41 +409,46 @@ class QueueDataAccumulator(DataFrameAccumulator):
         # only time differences in milliseconds in the list (faster)
         self.starting_time = None
         self.data_queue = data_queue
+        self.latency_log = latency_log
 
     def update_list(self):
-        """Upon calling put all available data into a list.
+        """Upon calling put all available data into the buffer.
         """
-        while True:
-            try:
-                # Get data from queue:
-                t, data = self.data_queue.get(timeout=0.001)
-                newtype = False
-                if len(self.stored_data) == 0 or type(data) != type(
-                    self.stored_data[-1]
-                ):
-                    self.reset()
-                    newtype = True
+        # the acquisition and tracking times follow the timestamp
+        n_latency = 2 if getattr(self.data_queue, "latency", False) else 0
 
-                # Time in ms (for having np and not datetime objects)
-                t_s = (t - self.exp.t0).total_seconds()
+        # Get all the data from the queue at once, grouped by type:
+        for tupletype, data in self.data_queue.get_all():
+            newtype = False
+            if self.is_empty() or self._tupletype._fields != tupletype._fields:
+                self.reset()
+                self._set_tupletype(tupletype)
+                newtype = True
 
-                # append:
-                self.times.append(t_s)
-                self.stored_data.append(data)
+            # Times relative to the experiment start, in seconds
+            self._append_block(
+                data[:, 0] - self.exp.t0.timestamp(), data[:, 1 + n_latency :]
+            )
+            if n_latency > 0 and self.latency_log is not None:
+                self.latency_log.frame_received(data[-1, 1], data[-1, 2])
 
-                self.trim_data()
+            self.trim_data()
 
-                # if the data type changed, emit a signal
-                if newtype:
-                    self.sig_acc_init.emit()
-            except Empty:
-                break
+            # if the data type changed, emit a signal
+            if newtype:
+                self.sig_acc_init.emit()
 
 
 class FramerateAccumulator(Accumulator):
+    columns = ("t", "framerate")
+    header_dict = {"t": 0, "framerate": 1}
+    plot_columns = None
+
     def __init__(self, *args, goal_framerate=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.goal_framerate = goal_framerate
+        self.stored_data = []
+        self.times = []
 
     def trim_data(self):
         if len(self.times) > self.max_history_if_not_running * 1.5:
@@ -308,30 +463,244 @@ class FramerateAccumulator(Accumulator):
         self.stored_data.append(fps)
         self.times.append((datetime.datetime.now() - self.exp.t0).total_seconds())
 
+    def __len__(self):
+        return len(self.times)
+
+    def get_last_n(self, n=None):
+        """Return the last n framerates, as an Nx2 array of times and
+        framerates, with missing framerates as nan
+
+        Parameters
+        ----------
+        n : int
+            number of data points to be returned, all if None
+
+        """
+        n = len(self) if n is None else min(n, len(self))
+        if n == 0:
+            return np.empty((0, 2))
+        return np.array([self.times[-n:], self.stored_data[-n:]], dtype=float).T
+
+    def get_last_t(self, t):
+        """Return the framerates of the last t seconds, as in get_last_n
+
+        Parameters
+        ----------
+        t : float
+            Time window in seconds from which data should be returned
+
+        """
+        if len(self) == 0:
+            return self.get_last_n()
+        times = np.array(self.times)
+        return self.get_last_n(len(self) - np.searchsorted(times, times[-1] - t))
+
 
 class FramerateQueueAccumulator(FramerateAccumulator):
-    """A simple accumulator, just for framerates"""
+    """A simple accumulator, just for framerates. If a list of queues
+    is given (e.g. from parallel processes), the framerates are summed.
+    """
 
     def __init__(self, *args, queue, **kwargs):
         super().__init__(*args, **kwargs)
-        self.queue = queue
+        self.queues = queue if isinstance(queue, list) else [queue]
+        self.last_fps = [0.0 for _ in self.queues]
 
     def update_list(self):
-        while True:
-            try:
-                # Get data from queue:
-                t, fps = self.queue.get(timeout=0.001)
-                # Time in ms (for having np and not datetime objects)
-                t_s = (t - self.exp.t0).total_seconds()
+        for i_queue, queue in enumerate(self.queues):
+            while True:
+                try:
+                    # Get data from queue:
+                    t, fps = queue.get(timeout=0.001)
+                    # Time in ms (for having np and not datetime objects)
+                    t_s = (t - self.exp.t0).total_seconds()
+
+                    if len(self.queues) > 1:
+                        self.last_fps[i_queue] = fps or 0.0
+                        fps = sum(self.last_fps)
+
+                    # append:
+                    self.times.append(t_s)
+                    self.stored_data.append(fps)
+
+                    self.trim_data()
+
+                except Empty:
+                    break
+
+
+class TimingQueueAccumulator(Accumulator):
+    """Collects the histograms of durations sent by one or more processes
+    through a queue, as produced by a
+    :class:`TimingRecorder <stytra.utilities.TimingRecorder>`.
+    The histograms are kept both for the whole experiment and for the
+    last update which received data.
+    """
+
+    def __init__(self, *args, queue, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queues = queue if isinstance(queue, list) else [queue]
+        self.histograms = dict()
+        self.totals = dict()
+        self.last_histograms = dict()
+        self.last_totals = dict()
+        self.n_updates = 0
+
+    def update_list(self):
+        received = False
+        for queue in self.queues:
+            while True:
+                try:
+                    collected = queue.get(timeout=0.001)
+                except Empty:
+                    break
+                if not received:
+                    self.last_histograms = dict()
+                    self.last_totals = dict()
+                    self.n_updates += 1
+                    received = True
+                for name, (counts, total) in collected.items():
+                    for histograms, totals in [
+                        (self.histograms, self.totals),
+                        (self.last_histograms, self.last_totals),
+                    ]:
+                        if name in histograms:
+                            histograms[name] = histograms[name] + counts
+                            totals[name] += total
+                        else:
+                            histograms[name] = counts
+                            totals[name] = total
+
+    @staticmethod
+    def summarize(counts, total):
+        """Number, mean and percentiles (in ms) of the durations in a
+        histogram
+
+        """
+        n = int(np.sum(counts))
+        return dict(
+            n=n,
+            mean_ms=total * 1000 / max(n, 1),
+            **{
+                "p{}_ms".format(q): TimingRecorder.percentile(counts, q) * 1000
+                for q in [50, 95, 99]
+            }
+        )
+
+    def get_last_summaries(self):
+        return {
+            name: self.summarize(counts, self.last_totals[name])
+            for name, counts in self.last_histograms.items()
+        }
+
+    def get_metadata(self):
+        """The histograms for the whole experiment, with their summaries,
+        to be saved with the metadata
+
+        """
+        return dict(
+            bin_edges_s=TimingRecorder.bin_edges.tolist(),
+            steps={
+                name: dict(
+                    counts=counts.tolist(), **self.summarize(counts, self.totals[name])
+                )
+                for name, counts in self.histograms.items()
+            },
+        )
+
 
-                # append:
-                self.times.append(t_s)
-                self.stored_data.append(fps)
+class LatencyLog(DataFrameAccumulator):
+    """Log of the closed-loop latency, from the acquisition of a camera
+    frame to the painting of the stimulus updated from its tracking.
 
-                self.trim_data()
+    Every time the stimulus is painted after a new tracking output arrived,
+    the delays in seconds from the acquisition of the latest frame are
+    logged for each stage:
 
-            except Empty:
-                break
+        - tracked: the tracking output is put in the output queue;
+        - received: the output is read by the tracking accumulator;
+        - consumed: the output is first used by the estimator (NaN if it
+          is not used before the stimulus is painted);
+        - painted: the stimulus display has finished painting.
+
+    All the times are taken with perf_counter, a monotonic clock shared by
+    the camera, tracking and main processes.
+
+    Parameters
+    ----------
+    summary_length : int
+        number of the last frames for the percentiles shown in the GUI
+    summary_interval : float
+        minimal time in seconds between updates of the summaries
+
+    """
+
+    stages = ("tracked", "received", "consumed", "painted")
+
+    def __init__(self, *args, summary_length=500, summary_interval=1.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.summary_length = summary_length
+        self.summary_interval = summary_interval
+        self._set_tupletype(namedtuple("latency", self.stages))
+
+        # acquisition time of the latest frame received and times of its stages
+        self._frame = None
+        self._painted = True
+
+        # the summaries are recalculated when this counter changes
+        self.n_updates = 0
+        self._t_last_update = perf_counter()
+
+    def reset(self, **kwargs):
+        super().reset(**kwargs)
+        self._frame = None
+        self._painted = True
+
+    def frame_received(self, t_acquired, t_tracked):
+        self._frame = np.array([t_acquired, t_tracked, perf_counter(), np.nan])
+        self._painted = False
+
+    def frame_consumed(self):
+        if not self._painted and self._frame[3] != self._frame[3]:
+            self._frame[3] = perf_counter()
+
+    def frame_painted(self):
+        if self._painted:
+            return
+        t_painted = perf_counter()
+        self._painted = True
+        self._append(
+            (datetime.datetime.now() - self.exp.t0).total_seconds(),
+            np.append(self._frame[1:], t_painted) - self._frame[0],
+        )
+        self.trim_data()
+        if t_painted - self._t_last_update > self.summary_interval:
+            self.n_updates += 1
+            self._t_last_update = t_painted
+
+    def get_last_summaries(self):
+        """Number, mean and percentiles (in ms) of the latency of each stage
+        for the last frames
+
+        """
+        last = self.get_last_n(self.summary_length)
+        if last is None:
+            return dict()
+        summaries = dict()
+        for i_stage, stage in enumerate(self.stages):
+            delays = last[:, i_stage + 1]
+            delays = delays[np.isfinite(delays)] * 1000
+            if len(delays) == 0:
+                continue
+            summaries[stage] = dict(
+                n=len(delays),
+                mean_ms=np.mean(delays),
+                **{
+                    "p{}_ms".format(q): p
+                    for q, p in zip([50, 95, 99], np.percentile(delays, [50, 95, 99]))
+                }
+            )
+        return summaries
 
 
 class DynamicLog(DataFrameAccumulator):
@@ -348,7 +717,6 @@ class DynamicLog(DataFrameAccumulator):
     def __init__(self, stimuli, **kwargs):
         """ """
         self.name = "stimulus_params"
-        self._tupletype = None
         super().__init__(**kwargs)
         # it is assumed the first dynamic stimulus has all the fields
 
@@ -356,10 +724,9 @@ class DynamicLog(DataFrameAccumulator):
 
     @property
     def columns(self):
-        try:
-            return ("t",) + self._tupletype._fields
-        except IndexError:
+        if self._tupletype is None:
             raise ValueError("Data type not set for stimulus log")
+        return ("t",) + self._tupletype._fields
 
     def update_list(self, time, data):
         """
@@ -373,10 +740,7 @@ class DynamicLog(DataFrameAccumulator):
         -------
 
         """
-        self.times.append(time)
-        self.stored_data.append(
-            self._tupletype(*(data.get(f, np.nan) for f in self._tupletype._fields))
-        )
+        self._append(time, [data.get(f, np.nan) for f in self._tupletype._fields])
 
     def update_stimuli(self, stimuli):
         dynamic_params = []
@@ -387,7 +751,7 @@ class DynamicLog(DataFrameAccumulator):
                         dynamic_params.append(new_param)
             except AttributeError:
                 pass
-        self._tupletype = namedtuple("s", dynamic_params)
+        self._set_tupletype(namedtuple("s", dynamic_params))
         self.reset()
 
 
@@ -396,7 +760,6 @@ class EstimatorLog(DataFrameAccumulator):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.stored_data = []
 
     def update_list(self, t, data):
         """
@@ -410,10 +773,12 @@ class EstimatorLog(DataFrameAccumulator):
         -------
 
         """
-        self.times.append(t)
-        self.stored_data.append(data)
+        if self._tupletype is None or self._tupletype._fields != data._fields:
+            self._set_tupletype(type(data))
+
+        self._append(t, data)
 
         self.trim_data()
 
-        if len(self.stored_data) == 1:
+        if len(self) == 1:
             self.sig_acc_init.emit()
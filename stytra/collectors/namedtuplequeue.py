@@ -1,5 +1,10 @@
-from multiprocessing import Queue
+from multiprocessing import Queue, Array, Value
 from collections import namedtuple
+from datetime import datetime
+from queue import Full
+import time
+
+import numpy as np
 
 
 class NamedTupleQueue:
@@ -23,3 +28,296 @@ class NamedTupleQueue:
             return t, self.tuple_type(*obtained)
         else:
             return t, self.tuple_type(*el)
+
+
+class RecordLayout:
+    """ Describes how the rows of a NamedTupleArrayQueue are arranged in
+    the shared buffer from the row with index i_start onwards
+
+    """
+
+    def __init__(self, array, max_bytes, i_start, stride, fields, n_meta=1):
+        self.i_start = i_start
+        self.stride = stride
+        self.tuple_type = namedtuple("t", fields)
+        self.n_fields = len(fields) + n_meta
+        self.n_rows = int(max_bytes // (8 * stride))
+        self.view = np.frombuffer(array, np.float64, self.n_rows * stride).reshape(
+            self.n_rows, stride
+        )
+
+    def read(self, i_from, i_to):
+        """ Copies out the rows between the two (absolute) indices """
+        i_wrapped = i_from % self.n_rows
+        n_read = i_to - i_from
+        if i_wrapped + n_read <= self.n_rows:
+            return self.view[i_wrapped : i_wrapped + n_read, : self.n_fields].copy()
+        return np.concatenate(
+            [
+                self.view[i_wrapped:, : self.n_fields],
+                self.view[: n_read - (self.n_rows - i_wrapped), : self.n_fields],
+            ]
+        )
+
+
+class NamedTupleArrayQueue:
+    """ A queue for namedtuples of numbers (e.g. the tracking output) with
+    one process putting and one getting, which stores each tuple as a row of
+    float64 values in shared memory instead of pickling it.
+    The first column of every row is the timestamp in seconds
+    (as in datetime.timestamp()), and, if the queue is indexed, the second
+    one is the index of the frame from which the tuple was obtained.
+    If the queue records the latency, the next two columns are the monotonic
+    (perf_counter) times at which the frame was acquired and tracked.
+
+    All the rows which are waiting in the queue are retrieved in one bulk
+    copy by :meth:`get_all() <NamedTupleArrayQueue.get_all()>`.
+    The field names are sent through a normal multiprocessing Queue, only
+    when the type of the tuples changes.
+
+    Parameters
+    ----------
+    max_mbytes : float
+        size of the shared buffer
+    layout_timeout : float
+        if a new tuple type does not fit in the current rows, time in seconds
+        to wait for the reader to get the remaining rows before the buffer
+        is rearranged.
+    indexed : bool
+        whether a frame index is stored alongside the timestamp
+    latency : bool
+        whether the acquisition and tracking times are stored
+
+    """
+
+    def __init__(self, max_mbytes=10, layout_timeout=0.1, indexed=False, latency=False):
+        self.maxbytes = int(max_mbytes * 1000000)
+        self.layout_timeout = layout_timeout
+        self.indexed = indexed
+        self.latency = latency
+        self.n_meta = 1 + indexed + 2 * latency
+        self.array = Array("c", self.maxbytes, lock=False)
+
+        # absolute indices of the rows written and read so far
+        self.i_written = Value("q", 0)
+        self.i_read = Value("q", 0)
+
+        # layouts are announced through a queue, and counted in a
+        # shared value so that the reader can wait for the ones it needs
+        self.layout_queue = Queue()
+        self.n_layouts = Value("i", 0)
+
+        # state of the putting process
+        self.tuple_type = None
+        self.put_layout = None
+
+        # state of the getting process
+        self.get_layouts = []
+        self.n_layouts_read = 0
+
+    def put(self, t, obj, index=None, latency_times=None):
+        """ Puts a namedtuple with a timestamp t, which can be a datetime,
+        a float in seconds or None for the current time, and for indexed queues
+        the frame index. For queues recording the latency, latency_times are
+        the acquisition and tracking times.
+        Raises queue.Full if the reader is lagging too much
+
+        """
+        if self.tuple_type != type(obj):
+            self._set_layout(obj)
+
+        i_written = self.i_written.value
+        if i_written - self.i_read.value >= self.put_layout.n_rows:
+            raise Full("Record queue of length {} full".format(self.put_layout.n_rows))
+
+        if t is None:
+            t = time.time()
+        elif isinstance(t, datetime):
+            t = t.timestamp()
+
+        row = self.put_layout.view[i_written % self.put_layout.n_rows]
+        row[0] = t
+        if self.indexed:
+            row[1] = index
+        if self.latency:
+            row[self.n_meta - 2 : self.n_meta] = latency_times
+        row[self.n_meta : self.put_layout.n_fields] = obj
+        self.i_written.value = i_written + 1
+
+    def _set_layout(self, obj):
+        self.tuple_type = type(obj)
+        i_start = self.i_written.value
+        stride = len(obj) + self.n_meta
+        if self.put_layout is None or stride > self.put_layout.stride:
+            # the rows have to be rearranged: wait for the reader
+            # to get the data in the old arrangement
+            t_wait = time.time()
+            while (
+                self.put_layout is not None
+                and self.i_read.value < i_start
+                and time.time() - t_wait < self.layout_timeout
+            ):
+                time.sleep(0.0005)
+        else:
+            stride = self.put_layout.stride
+
+        self.put_layout = RecordLayout(
+            self.array, self.maxbytes, i_start, stride, obj._fields, self.n_meta
+        )
+        self.layout_queue.put((i_start, stride, obj._fields))
+        with self.n_layouts.get_lock():
+            self.n_layouts.value += 1
+
+    def get_all(self):
+        """ Gets all the rows currently in the queue
+
+        Returns
+        -------
+        list of (tuple_type, np.ndarray) pairs
+            for each tuple type present, the namedtuple class and the NxJ
+            array of rows, where the first column is the timestamp (and the
+            second the frame index, for indexed queues, followed by the
+            acquisition and tracking times if the latency is recorded)
+
+        """
+        i_written = self.i_written.value
+        while self.n_layouts_read < self.n_layouts.value:
+            self.get_layouts.append(
+                RecordLayout(
+                    self.array,
+                    self.maxbytes,
+                    *self.layout_queue.get(),
+                    n_meta=self.n_meta
+                )
+            )
+            self.n_layouts_read += 1
+
+        i_read = self.i_read.value
+        output = []
+        for i_layout, layout in enumerate(self.get_layouts):
+            if i_layout + 1 < len(self.get_layouts):
+                next_layout = self.get_layouts[i_layout + 1]
+                i_end = next_layout.i_start
+                # if the buffer was rearranged without the reader catching
+                # up, the remaining old rows are lost
+                if next_layout.stride != layout.stride:
+                    i_read = max(i_read, i_end)
+            else:
+                i_end = i_written
+
+            if i_read < i_end:
+                output.append((layout.tuple_type, layout.read(i_read, i_end)))
+                i_read = i_end
+
+        # only the last layout is needed for subsequent reads
+        self.get_layouts = self.get_layouts[-1:]
+        self.i_read.value = i_read
+        return output
+
+    def clear(self):
+        """ Discards all the rows in the queue """
+        self.get_all()
+
+    def qsize(self):
+        return self.i_written.value - self.i_read.value
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class ReorderingQueue:
+    """ Merges the outputs of several parallel tracking processes, each
+    putting in its own indexed NamedTupleArrayQueue, and gives them out in
+    the order of the frame indices, with the same interface as a
+    non-indexed NamedTupleArrayQueue.
+
+    Rows are held back while the row of a preceding frame is still missing,
+    for at most max_wait seconds (the frame could have been lost). Rows
+    which arrive after the following frames have been given out are
+    dropped, so that the times always increase, and counted in n_late.
+
+    Parameters
+    ----------
+    queues : list of NamedTupleArrayQueue
+        the indexed queues of the workers
+    max_wait : float
+        maximal time in seconds for which rows are held back
+
+    """
+
+    def __init__(self, queues, max_wait=0.1):
+        self.queues = queues
+        self.latency = queues[0].latency
+        self.max_wait = max_wait
+        self.i_next = 0
+        self.t_held = None
+        # the index after the last row given out, and the rows dropped
+        # because they came after it
+        self.i_given = 0
+        self.n_late = 0
+        # rows waiting to be given out, for each tuple type
+        self.pending = dict()
+
+    def get_all(self):
+        for q in self.queues:
+            for tuple_type, rows in q.get_all():
+                fields = tuple_type._fields
+                # the rows of frames which have been skipped are dropped
+                late = rows[:, 1] < self.i_given
+                if np.any(late):
+                    self.n_late += int(np.sum(late))
+                    rows = rows[~late]
+                    if len(rows) == 0:
+                        continue
+                if fields in self.pending:
+                    rows = np.concatenate([self.pending[fields][1], rows])
+                self.pending[fields] = (tuple_type, rows)
+
+        if len(self.pending) == 0:
+            return []
+
+        indices = np.sort(
+            np.concatenate([rows[:, 1] for _, rows in self.pending.values()])
+        )
+
+        # find the first frame which is missing
+        gaps = np.flatnonzero(np.diff(np.r_[self.i_next - 1, indices]) > 1)
+        if len(gaps) == 0:
+            i_release = indices[-1] + 1
+            self.t_held = None
+        else:
+            if self.t_held is None:
+                self.t_held = time.time()
+            if time.time() - self.t_held > self.max_wait:
+                i_release = indices[-1] + 1
+                self.t_held = None
+            else:
+                i_release = indices[gaps[0]]
+
+        output = []
+        for fields, (tuple_type, rows) in list(self.pending.items()):
+            rows = rows[np.argsort(rows[:, 1], kind="stable")]
+            n_release = np.searchsorted(rows[:, 1], i_release)
+            if n_release > 0:
+                output.append((tuple_type, np.delete(rows[:n_release], 1, axis=1)))
+                self.i_given = max(self.i_given, int(rows[n_release - 1, 1]) + 1)
+            if n_release < len(rows):
+                self.pending[fields] = (tuple_type, rows[n_release:])
+            else:
+                del self.pending[fields]
+
+        self.i_next = max(self.i_next, int(i_release))
+        # if the output type has changed, the older type is given out first
+        return sorted(output, key=lambda tr: tr[1][0, 0])
+
+    def clear(self):
+        self.get_all()
+        self.pending = dict()
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues) + sum(
+            len(rows) for _, rows in self.pending.values()
+        )
+
+    def empty(self):
+        return self.qsize() == 0
@@ -176,7 +176,7 @@ class FlyTrackingSelection(CameraSelection):
             return
 
         # Get data from the tracking queue (first is timestamp):
-        if len(self.experiment.acc_tracking.stored_data) > 1:
+        if len(self.experiment.acc_tracking) > 1:
             # To match tracked points and frame displayed looks for matching
             # timestamps of the displayed frame and of tracked queue:
             retrieved_data = self.experiment.acc_tracking.values_at_abs_time(
@@ -184,7 +184,7 @@ class FlyTrackingSelection(CameraSelection):
             )
 
             # Check for valid data to be displayed:
-            if len(self.experiment.acc_tracking.stored_data) > 1:
+            if len(self.experiment.acc_tracking) > 1:
                 checkifnan = getattr(retrieved_data, "theta")
 
                 if checkifnan == checkifnan:  # will be false if np.nan
@@ -43,6 +43,10 @@ class VideoRecordingExperiment(CameraVisualExperiment):
         )
 
         self.video_writer.start()
+        self.acc_recording_framerate = FramerateQueueAccumulator(
+            self, queue=self.video_writer.framerate_queue, name="recording"
+        )
+        self.gui_timer.timeout.connect(self.acc_recording_framerate.update_list)
 
     def start_protocol(self):
         self.video_writer.filename_queue.put(self.folder_name)
@@ -1,7 +1,11 @@
 import traceback
 
+from datetime import datetime
 from multiprocessing import Queue, Event, Value, set_start_method
 from queue import Empty
+from threading import Thread
+
+from PyQt5.QtCore import pyqtSignal
 
 from stytra.experiments import VisualExperiment
 from stytra.gui.container_windows import (
@@ -20,10 +24,12 @@ from stytra.collectors import (
     QueueDataAccumulator,
     EstimatorLog,
     FramerateQueueAccumulator,
+    TimingQueueAccumulator,
+    LatencyLog,
 )
 from stytra.tracking.tracking_process import TrackingProcess
 from stytra.tracking.pipelines import Pipeline
-from stytra.collectors.namedtuplequeue import NamedTupleQueue
+from stytra.collectors.namedtuplequeue import NamedTupleArrayQueue, ReorderingQueue
 from stytra.experiments.fish_pipelines import pipeline_dict
 
 from stytra.stimulation.estimators import estimator_dict
@@ -48,6 +54,12 @@ class CameraVisualExperiment(VisualExperiment):
 
     """
 
+    # emitted with the file name, the number of frames, the time they span
+    # and the requested duration when the replay buffer has been saved
+    sig_replay_saved = pyqtSignal(str, int, float, float)
+    # emitted with the file name and the error if the saving failed
+    sig_replay_failed = pyqtSignal(str, str)
+
     def __init__(self, *args, camera, camera_queue_mb=100, **kwargs):
         """
         :param video_file: if not using a camera, the video file
@@ -83,10 +95,28 @@ class CameraVisualExperiment(VisualExperiment):
         # New parameters are sent with GUI timer:
         self.gui_timer.timeout.connect(self.send_gui_parameters)
         self.gui_timer.timeout.connect(self.acc_camera_framerate.update_list)
+        self.sig_replay_saved.connect(self.log_replay_saved)
+        self.sig_replay_failed.connect(self.log_replay_failed)
+
+        # Simulated cameras give the real poses of the fish:
+        if getattr(self.camera, "ground_truth_queue", None) is not None:
+            self.acc_ground_truth = QueueDataAccumulator(
+                name="ground_truth",
+                experiment=self,
+                data_queue=self.camera.ground_truth_queue,
+            )
+            self.gui_timer.timeout.connect(self.acc_ground_truth.update_list)
+            self.protocol_runner.sig_protocol_started.connect(
+                self.acc_ground_truth.reset
+            )
+        else:
+            self.acc_ground_truth = None
 
     def reset(self):
         super().reset()
         self.acc_camera_framerate.reset()
+        if self.acc_ground_truth is not None:
+            self.acc_ground_truth.reset()
 
     def initialize_plots(self):
         super().initialize_plots()
@@ -113,6 +143,63 @@ class CameraVisualExperiment(VisualExperiment):
         sys.excepthook = self.excepthook
         self.camera.start()
 
+    def save_replay(self, duration=None):
+        """Saves the frames of the replay buffer of the camera to an HDF5
+        file in a background thread, so that what happened before an event
+        can be kept without recording the whole experiment. If the
+        buffer holds fewer frames than the duration, a shorter span is saved
+        and a warning is logged.
+
+        Parameters
+        ----------
+        duration : float
+            the duration (in seconds) of the end of the buffer which is
+            saved, by default the save_duration camera parameter
+
+        Returns
+        -------
+        Thread
+            the thread saving the file
+
+        """
+        if duration is None:
+            duration = self.camera_state.save_duration
+        filename = (
+            self.filename_base()
+            + datetime.now().strftime("%Y%m%d_%H%M%S")
+            + "_replay.hdf5"
+        )
+        thread = Thread(target=self._save_replay, args=(filename, duration))
+        thread.start()
+        return thread
+
+    def _save_replay(self, filename, duration):
+        # the signals are received in the main thread
+        try:
+            n_frames, span = self.camera.ring_buffer.save(filename, duration)
+        except Exception as e:
+            self.sig_replay_failed.emit(filename, repr(e))
+        else:
+            self.sig_replay_saved.emit(filename, n_frames, span, duration)
+
+    def log_replay_saved(self, filename, n_frames, span, duration):
+        self.logger.info(
+            "Saved {} frames of the replay buffer in {}".format(n_frames, filename)
+        )
+        # if the buffer was long enough, the first frame saved is less than
+        # an interval after the requested start
+        interval = span / max(n_frames - 1, 1)
+        if span + 1.5 * interval < duration:
+            self.logger.warning(
+                "The replay buffer held only {:.1f} s of the {:.1f} s to save, "
+                "camera_queue_mb is too small".format(span, duration)
+            )
+
+    def log_replay_failed(self, filename, error):
+        self.logger.error(
+            "Saving the replay buffer in {} failed: {}".format(filename, error)
+        )
+
     def wrap_up(self, *args, **kwargs):
         """
 
@@ -131,11 +218,16 @@ class CameraVisualExperiment(VisualExperiment):
         super().wrap_up(*args, **kwargs)
         self.camera.kill_event.set()
 
-        for q in [self.camera.frame_queue]:
+        for q in self.camera.frame_queues:
             q.clear()
 
         self.camera.join()
 
+    def save_data(self):
+        if self.acc_ground_truth is not None:
+            self.save_log(self.acc_ground_truth, "ground_truth_log")
+        super().save_data()
+
     def excepthook(self, exctype, value, tb):
         """
 
@@ -179,19 +271,42 @@ class TrackingExperiment(CameraVisualExperiment):
         - the result of the tracking function, is dispatched to a data
           accumulator for saving or other purposes (e.g. VR control).
 
+    If more than one tracking process is requested, the frames from the camera
+    are distributed among them and the outputs are put back in the order
+    of the frames before reaching the data accumulator. This is possible only
+    for pipelines which are not stateful.
+
     Parameters
     ----------
         tracking: dict
             containing fields:  tracking_method
                                 estimator: can be vigor for embedded fish, position
                                     for freely-swimming, or a custom subclass of Estimator
+        n_tracking_processes: int
+            number of parallel tracking processes
+        tracking_timing: bool
+            if True, the durations of the tracking steps are measured,
+            displayed and saved in the metadata
+        closed_loop_latency: bool
+            if True, the delays from the acquisition of the frames to
+            their tracking, their use by the estimator and the painting of
+            the stimulus are measured, displayed and saved in a log
 
     Returns
     -------
 
     """
 
-    def __init__(self, *args, tracking, recording=None, **kwargs):
+    def __init__(
+        self,
+        *args,
+        tracking,
+        recording=None,
+        n_tracking_processes=1,
+        tracking_timing=False,
+        closed_loop_latency=False,
+        **kwargs
+    ):
         """
         :param tracking_method: class with the parameters for tracking (instance
                                 of TrackingMethod class, defined in the child);
@@ -201,8 +316,6 @@ class TrackingExperiment(CameraVisualExperiment):
                            in the child).
         """
 
-        self.processing_params_queue = Queue()
-        self.tracking_output_queue = NamedTupleQueue()
         self.finished_sig = Event()
         super().__init__(*args, **kwargs)
         self.arguments.update(locals())
@@ -217,26 +330,77 @@ class TrackingExperiment(CameraVisualExperiment):
             else tracking["method"]
         )
 
-        self.frame_dispatcher = TrackingProcess(
-            in_frame_queue=self.camera.frame_queue,
-            finished_signal=self.camera.kill_event,
-            pipeline=self.pipeline_cls,
-            processing_parameter_queue=self.processing_params_queue,
-            output_queue=self.tracking_output_queue,
-            recording_signal=self.recording_event,
-            gui_framerate=20,
-        )
         if self.pipeline_cls is None:
             raise NameError("The selected tracking method does not exist!")
         self.pipeline = self.pipeline_cls()
         assert isinstance(self.pipeline, Pipeline)
         self.pipeline.setup(tree=self.dc)
 
+        if n_tracking_processes > 1 and self.pipeline.stateful:
+            self.logger.info(
+                "The tracking pipeline depends on previous frames,"
+                " using only one tracking process"
+            )
+            n_tracking_processes = 1
+        if n_tracking_processes > 1 and recording is not None:
+            self.logger.info(
+                "Frames for video recording have to be in order,"
+                " using only one tracking process"
+            )
+            n_tracking_processes = 1
+
+        # each tracking process has its own parameter and output queues
+        self.processing_params_queues = [Queue() for _ in range(n_tracking_processes)]
+        if n_tracking_processes == 1:
+            worker_output_queues = [NamedTupleArrayQueue(latency=closed_loop_latency)]
+            self.tracking_output_queue = worker_output_queues[0]
+        else:
+            worker_output_queues = [
+                NamedTupleArrayQueue(indexed=True, latency=closed_loop_latency)
+                for _ in range(n_tracking_processes)
+            ]
+            self.tracking_output_queue = ReorderingQueue(worker_output_queues)
+
+        # each tracking process gets frames from its own queue
+        frame_queues = [self.camera.frame_queue] + [
+            self.camera.add_frame_queue() for _ in range(n_tracking_processes - 1)
+        ]
+        self.frame_dispatchers = [
+            TrackingProcess(
+                in_frame_queue=frame_queue,
+                finished_signal=self.camera.kill_event,
+                pipeline=self.pipeline_cls,
+                processing_parameter_queue=params_queue,
+                output_queue=output_queue,
+                recording_signal=self.recording_event,
+                gui_framerate=20,
+                gui_dispatcher=i_worker == 0,
+                timing_interval=1.0 if tracking_timing else None,
+                acquisition_times=(
+                    self.camera.acquisition_times if closed_loop_latency else None
+                ),
+            )
+            for i_worker, (frame_queue, params_queue, output_queue) in enumerate(
+                zip(frame_queues, self.processing_params_queues, worker_output_queues)
+            )
+        ]
+        # the first process sends the frames to the GUI
+        self.frame_dispatcher = self.frame_dispatchers[0]
+
+        if closed_loop_latency:
+            self.latency_log = LatencyLog(experiment=self, name="latency")
+            self.protocol_runner.sig_protocol_started.connect(self.latency_log.reset)
+            if not self.offline:
+                self.window_display.widget_display.latency_log = self.latency_log
+        else:
+            self.latency_log = None
+
         self.acc_tracking = QueueDataAccumulator(
             name="tracking",
             experiment=self,
             data_queue=self.tracking_output_queue,
             monitored_headers=self.pipeline.headers_to_plot,
+            latency_log=self.latency_log,
         )
         self.acc_tracking.sig_acc_init.connect(self.refresh_plots)
 
@@ -246,8 +410,9 @@ class TrackingExperiment(CameraVisualExperiment):
         # Tracking is reset at experiment start:
         self.protocol_runner.sig_protocol_started.connect(self.acc_tracking.reset)
 
-        # start frame dispatcher process:
-        self.frame_dispatcher.start()
+        # start frame dispatcher processes:
+        for frame_dispatcher in self.frame_dispatchers:
+            frame_dispatcher.start()
 
         est_type = tracking.get("estimator", None)
         if est_type is None:
@@ -270,29 +435,55 @@ class TrackingExperiment(CameraVisualExperiment):
 
         self.acc_tracking_framerate = FramerateQueueAccumulator(
             self,
-            queue=self.frame_dispatcher.framerate_queue,
+            queue=[fd.framerate_queue for fd in self.frame_dispatchers],
             name="tracking",
             goal_framerate=kwargs["camera"].get("min_framerate", None),
         )
 
+        if tracking_timing:
+            self.acc_tracking_timing = TimingQueueAccumulator(
+                self,
+                queue=[fd.timing_queue for fd in self.frame_dispatchers],
+                name="tracking_timing",
+            )
+            self.gui_timer.timeout.connect(self.acc_tracking_timing.update_list)
+        else:
+            self.acc_tracking_timing = None
+
         if recording is not None:
             if recording["extension"] == "h5":
                 self.frame_recorder = H5VideoWriter(
-                    self.filename_base(),
                     self.frame_dispatcher.frame_copy_queue,
                     self.finished_sig,
                     self.recording_event,
                     log_format=self.log_format,
+                    segment_frames=recording.get("segment_frames", None),
+                    segment_minutes=recording.get("segment_minutes", None),
+                    acquisition_times=self.camera.acquisition_times,
                 )
             else:
                 self.frame_recorder = StreamingVideoWriter(
                     self.frame_dispatcher.frame_copy_queue,
                     self.finished_sig,
                     self.recording_event,
+                    extension=recording["extension"],
+                    format=recording.get(
+                        "codec", "ffv1" if recording.get("lossless") else "mpeg4"
+                    ),
                     kbit_rate=recording.get("kbit_rate", 1000),
+                    lossless=recording.get("lossless", False),
                     log_format=self.log_format,
+                    segment_frames=recording.get("segment_frames", None),
+                    segment_minutes=recording.get("segment_minutes", None),
+                    acquisition_times=self.camera.acquisition_times,
                 )
             self.frame_recorder.start()
+            self.acc_recording_framerate = FramerateQueueAccumulator(
+                self, queue=self.frame_recorder.framerate_queue, name="recording"
+            )
+            self.gui_timer.timeout.connect(self.acc_recording_framerate.update_list)
+        else:
+            self.acc_recording_framerate = None
 
         self.gui_timer.timeout.connect(self.acc_tracking_framerate.update_list)
 
@@ -303,6 +494,8 @@ class TrackingExperiment(CameraVisualExperiment):
         if self.estimator is not None:
             self.estimator.reset()
             self.estimator_log.reset()
+        if self.latency_log is not None:
+            self.latency_log.reset()
 
     def make_window(self):
         self.window_main = TrackingExperimentWindow(experiment=self)
@@ -339,7 +532,9 @@ class TrackingExperiment(CameraVisualExperiment):
 
         """
         super().send_gui_parameters()
-        self.processing_params_queue.put(self.pipeline.serialize_changed_params())
+        changed_params = self.pipeline.serialize_changed_params()
+        for params_queue in self.processing_params_queues:
+            params_queue.put(changed_params)
 
     def start_protocol(self):
         # Freeze the plots so the plotting does not interfere with
@@ -378,12 +573,19 @@ class TrackingExperiment(CameraVisualExperiment):
         )
         self.dc.add_static_data(self.filename_prefix() + "img.png", "tracking/image")
 
+        if self.acc_tracking_timing is not None:
+            self.dc.add_static_data(
+                self.acc_tracking_timing.get_metadata(), "tracking/timing"
+            )
+
         # Save log and estimators:
         self.save_log(self.acc_tracking, "behavior_log")
         try:
             self.save_log(self.estimator.log, "estimator_log")
         except AttributeError:
             pass
+        if self.latency_log is not None:
+            self.save_log(self.latency_log, "latency_log")
 
         super().save_data()
 
@@ -425,7 +627,8 @@ class TrackingExperiment(CameraVisualExperiment):
 
         self.frame_dispatcher.gui_queue.clear()
 
-        self.frame_dispatcher.join()
+        for frame_dispatcher in self.frame_dispatchers:
+            frame_dispatcher.join()
 
     def excepthook(self, exctype, value, tb):
         """ If an exception happens in the main loop, close all the
@@ -436,4 +639,5 @@ class TrackingExperiment(CameraVisualExperiment):
         print("{0}: {1}".format(exctype, value))
         self.finished_sig.set()
         self.camera.join()
-        self.frame_dispatcher.join()
+        for frame_dispatcher in self.frame_dispatchers:
+            frame_dispatcher.join()
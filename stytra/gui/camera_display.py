@@ -1,5 +1,6 @@
 import datetime
 from queue import Empty
+from time import perf_counter
 
 import numpy as np
 import pyqtgraph as pg
@@ -12,6 +13,7 @@ from math import sin, cos
 from lightparam.gui import ParameterGui, ControlToggleIcon
 
 from stytra.gui.buttons import IconButton, ToggleIconButton, get_icon
+from stytra.tracking.tail import resize_tail_rois
 
 
 class SingleLineROI(pg.LineSegmentROI):
@@ -115,6 +117,13 @@ class CameraViewWidget(QWidget):
             self.btn_rewind.setToolTip("Replay the time period selected in the plot")
             self.layout_control.addWidget(self.btn_rewind)
 
+        if hasattr(self.camera, "ring_buffer"):
+            self.btn_save_replay = IconButton(
+                icon_name="save_replay", action_name="Save the end of the replay buffer"
+            )
+            self.btn_save_replay.clicked.connect(lambda: self.experiment.save_replay())
+            self.layout_control.addWidget(self.btn_save_replay)
+
         if self.control_queue is not None:
             self.btn_camera_param = IconButton(
                 icon_name="edit_camera", action_name="Configure camera"
@@ -138,6 +147,8 @@ class CameraViewWidget(QWidget):
 
         self.setLayout(self.layout)
         self.current_frame_time = None
+        self.current_slot = None
+        self.replay_start = None
 
         self.param_widget = None
 
@@ -165,15 +176,28 @@ class CameraViewWidget(QWidget):
                 # recent one added to the queue, as a queue is FILO:
                 if first:
                     qr = self.frame_queue.get(timeout=0.0001)
+                    # the frame displayed is kept until a new one arrives
+                    self.frame_queue.release(self.current_slot)
                     self.current_image = qr[-1]
                     self.current_frame_time = qr[0]
+                    self.current_slot = qr[2]
                     # first = False
                 else:
                     # Else, get to free the queue:
-                    _, _ = self.frame_queue.get(timeout=0.001)
+                    self.frame_queue.release(self.frame_queue.get(timeout=0.001)[2])
             except Empty:
                 break
 
+        # The replayed frames are shown instead, without interrupting the
+        # acquisition and the tracking:
+        if getattr(self.control_params, "replay", False):
+            replayed = self.replay_image()
+            if replayed is not None:
+                self.current_image = replayed[1]
+                self.current_frame_time = datetime.datetime.fromtimestamp(replayed[0])
+        else:
+            self.replay_start = None
+
         # Once obtained current image, display it:
         if self.isVisible():
             if self.current_image is not None:
@@ -194,6 +218,34 @@ class CameraViewWidget(QWidget):
                     self.current_image, autoLevels=self.btn_autorange.isChecked()
                 )
 
+    def replay_image(self):
+        """Reads the frame to display from the replay buffer of the camera,
+        looping over the frames between the replay limits (or over all of
+        them if there is none) at the replay framerate.
+
+        Returns
+        -------
+        tuple
+            the timestamp of the frame, in seconds, and the frame, or None
+
+        """
+        ring_buffer = getattr(self.camera, "ring_buffer", None)
+        if ring_buffer is None:
+            return None
+        numbers, times = ring_buffer.times()
+        limits = self.control_params.replay_limits
+        in_limits = (times >= limits[0]) & (times <= limits[1])
+        if np.any(in_limits):
+            numbers = numbers[in_limits]
+        if len(numbers) == 0:
+            return None
+        if self.replay_start is None:
+            self.replay_start = perf_counter()
+        i_frame = int(
+            (perf_counter() - self.replay_start) * self.control_params.replay_fps
+        )
+        return ring_buffer.read(numbers[i_frame % len(numbers)])
+
     def scale_changed(self):
         self.display_area.setRange(
             QRectF(0, 0, self.current_image.shape[1], self.current_image.shape[0]),
@@ -281,33 +333,68 @@ class CameraSelection(CameraViewWidget):
 
 
 class TailTrackingSelection(CameraSelection):
+    """Displays a line ROI to select each tracked tail, for pipelines which
+    track a single tail (with tail_start and tail_length parameters) or
+    several ones (with n_tails, tail_starts and tail_lengths parameters)
+    """
+
     def __init__(self, **kwargs):
         """ """
         super().__init__(**kwargs)
 
-        # Draw ROI for tail selection:
         self.tail_params = self.experiment.pipeline.tailtrack._params
-        self.roi_tail = SingleLineROI(
-            self.tail_points(), pen=dict(color=(40, 5, 200), width=3)
-        )
+        self.multiple_tails = hasattr(self.tail_params, "tail_starts")
 
-        # Prepare curve for plotting tracked tail position:
-        self.curve_tail = pg.PlotCurveItem(pen=dict(color=(230, 40, 5), width=3))
-        self.display_area.addItem(self.curve_tail)
-
-        self.initialise_roi(self.roi_tail)
+        # ROIs for tail selection and curves for plotting the tracked tails:
+        self.roi_tails = []
+        self.curves_tail = []
 
         self.setting_param_val = False
+        self.update_rois()
+
+    def tail_rois(self):
+        """Returns the starting point and the length of each tail, from the
+        parameters"""
+        if self.multiple_tails:
+            return list(
+                zip(
+                    *resize_tail_rois(
+                        self.tail_params.tail_starts,
+                        self.tail_params.tail_lengths,
+                        self.tail_params.n_tails,
+                    )
+                )
+            )
+        return [(self.tail_params.tail_start, self.tail_params.tail_length)]
+
+    def update_rois(self):
+        """Adds or removes ROIs so that there is one for each tail"""
+        rois = self.tail_rois()
+        while len(self.roi_tails) > len(rois):
+            self.display_area.removeItem(self.roi_tails.pop())
+            self.display_area.removeItem(self.curves_tail.pop())
+        while len(self.roi_tails) < len(rois):
+            roi = SingleLineROI(
+                self.tail_points(*rois[len(self.roi_tails)]),
+                pen=dict(color=(40, 5, 200), width=3),
+            )
+            curve = pg.PlotCurveItem(pen=dict(color=(230, 40, 5), width=3))
+            self.display_area.addItem(curve)
+            self.initialise_roi(roi)
+            self.roi_tails.append(roi)
+            self.curves_tail.append(curve)
 
     def set_pos_from_tree(self):
         """Go to parent for definition."""
         super().set_pos_from_tree()
         if not self.setting_param_val:
-            self.roi_tail.prepareGeometryChange()
-            p1, p2 = self.roi_tail.getHandles()
-            np1, np2 = self.tail_points()
-            p1.setPos(QPointF(*np1))
-            p2.setPos(QPointF(*np2))
+            self.update_rois()
+            for roi, (start, length) in zip(self.roi_tails, self.tail_rois()):
+                roi.prepareGeometryChange()
+                p1, p2 = roi.getHandles()
+                np1, np2 = self.tail_points(start, length)
+                p1.setPos(QPointF(*np1))
+                p2.setPos(QPointF(*np2))
 
     def set_pos_from_roi(self):
         """Go to parent for definition."""
@@ -315,14 +402,25 @@ class TailTrackingSelection(CameraSelection):
 
         self.setting_param_val = True
 
-        p1, p2 = self.roi_tail.getHandles()
-        self.tail_params.tail_start = (p1.y() / self.scale, p1.x() / self.scale)
-        self.tail_params.params.tail_start.changed = True
-        self.tail_params.tail_length = (
-            (p2.y() - p1.y()) / self.scale,
-            (p2.x() - p1.x()) / self.scale,
-        )
-        self.tail_params.params.tail_length.changed = True
+        tail_starts = []
+        tail_lengths = []
+        for roi in self.roi_tails:
+            p1, p2 = roi.getHandles()
+            tail_starts.append((p1.y() / self.scale, p1.x() / self.scale))
+            tail_lengths.append(
+                ((p2.y() - p1.y()) / self.scale, (p2.x() - p1.x()) / self.scale)
+            )
+
+        if self.multiple_tails:
+            self.tail_params.tail_starts = tail_starts
+            self.tail_params.params.tail_starts.changed = True
+            self.tail_params.tail_lengths = tail_lengths
+            self.tail_params.params.tail_lengths.changed = True
+        else:
+            self.tail_params.tail_start = tail_starts[0]
+            self.tail_params.params.tail_start.changed = True
+            self.tail_params.tail_length = tail_lengths[0]
+            self.tail_params.params.tail_length.changed = True
 
         self.setting_param_val = False
 
@@ -336,45 +434,60 @@ class TailTrackingSelection(CameraSelection):
         if self.current_image is None:
             return
 
+        # the number of tails can be changed from the parameters
+        if self.multiple_tails and len(self.roi_tails) != self.tail_params.n_tails:
+            self.set_pos_from_tree()
+            self.set_pos_from_roi()
+
         # Get data from queue(first is timestamp)
-        if len(self.experiment.acc_tracking.stored_data) > 1:
+        if len(self.experiment.acc_tracking) > 1:
             # To match tracked points and frame displayed looks for matching
             # timestamps from the two different queues:
             retrieved_data = self.experiment.acc_tracking.values_at_abs_time(
                 self.current_frame_time
             )
             # Check for data to be displayed:
-            # Retrieve tail angles from tail
-
-            angles = [
-                getattr(retrieved_data, "theta_{:02d}".format(i))
-                for i in range(self.tail_params.n_output_segments)
-            ]
-            # Get tail position and length from the parameters:
-            (start_y, start_x), (tail_len_y, tail_len_x) = self.tail_dims()
-            tail_length = np.sqrt(tail_len_x ** 2 + tail_len_y ** 2)
-
-            # Get segment length:
-            tail_segment_length = tail_length / (len(angles))
-            points = [np.array([start_x, start_y])]
-
-            # Calculate tail points from angles and position:
-            for angle in angles:
-                points.append(
-                    points[-1]
-                    + tail_segment_length * np.array([np.cos(angle), np.sin(angle)])
+            for i_tail, (curve, (start, length)) in enumerate(
+                zip(self.curves_tail, self.tail_rois())
+            ):
+                # Retrieve tail angles from tail
+                prefix = "f{}_".format(i_tail) if self.multiple_tails else ""
+                try:
+                    angles = [
+                        getattr(retrieved_data, prefix + "theta_{:02d}".format(i))
+                        for i in range(self.tail_params.n_output_segments)
+                    ]
+                except AttributeError:
+                    # the tracking output has not been updated yet
+                    continue
+
+                # Get tail position and length from the parameters:
+                (start_y, start_x), (tail_len_y, tail_len_x) = self.tail_dims(
+                    start, length
                 )
-            points = np.array(points)
-            self.curve_tail.setData(x=points[:, 1], y=points[:, 0])
+                tail_length = np.sqrt(tail_len_x ** 2 + tail_len_y ** 2)
+
+                # Get segment length:
+                tail_segment_length = tail_length / (len(angles))
+                points = [np.array([start_x, start_y])]
+
+                # Calculate tail points from angles and position:
+                for angle in angles:
+                    points.append(
+                        points[-1]
+                        + tail_segment_length * np.array([np.cos(angle), np.sin(angle)])
+                    )
+                points = np.array(points)
+                curve.setData(x=points[:, 1], y=points[:, 0])
 
-    def tail_points(self):
-        tsy, tsx = (t * self.scale for t in self.tail_params.tail_start)
-        tly, tlx = (t * self.scale for t in self.tail_params.tail_length)
+    def tail_points(self, tail_start, tail_length):
+        tsy, tsx = (t * self.scale for t in tail_start)
+        tly, tlx = (t * self.scale for t in tail_length)
         return (tsx, tsy), (tsx + tlx, tsy + tly)
 
-    def tail_dims(self):
-        tsy, tsx = (t * self.scale for t in self.tail_params.tail_start)
-        tly, tlx = (t * self.scale for t in self.tail_params.tail_length)
+    def tail_dims(self, tail_start, tail_length):
+        tsy, tsx = (t * self.scale for t in tail_start)
+        tly, tlx = (t * self.scale for t in tail_length)
         return (tsx, tsy), (tlx, tly)
 
 
@@ -439,7 +552,7 @@ class EyeTrackingSelection(CameraSelection):
             return
 
         # Get data from queue(first is timestamp)
-        if len(self.experiment.acc_tracking.stored_data) > 1:
+        if len(self.experiment.acc_tracking) > 1:
             # To match tracked points and frame displayed looks for matching
             # timestamps from the two different queues:
             retrieved_data = self.experiment.acc_tracking.values_at_abs_time(
@@ -447,7 +560,7 @@ class EyeTrackingSelection(CameraSelection):
             )
             # Check for data to be displayed:
 
-            if len(self.experiment.acc_tracking.stored_data) > 1:
+            if len(self.experiment.acc_tracking) > 1:
                 self.roi_eyes.setPen(dict(color=(5, 40, 200), width=3))
                 checkifnan = getattr(retrieved_data, "th_e0")
                 for i, o in enumerate([0, 5]):
@@ -616,10 +729,7 @@ class CameraViewFish(CameraViewCalib):
     def retrieve_image(self):
         super().retrieve_image()
 
-        if (
-            len(self.experiment.acc_tracking.stored_data) == 0
-            or self.current_image is None
-        ):
+        if len(self.experiment.acc_tracking) == 0 or self.current_image is None:
             return
 
         current_data = self.experiment.acc_tracking.values_at_abs_time(
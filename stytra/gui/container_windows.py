@@ -20,6 +20,7 @@ from stytra.gui.protocol_control import ProtocolControlToolbar
 from stytra.gui.camera_display import CameraViewWidget
 from stytra.gui.buttons import IconButton, ToggleIconButton
 from stytra.gui.status_display import StatusMessageDisplay
+from stytra.gui.timing_display import TimingWidget
 from stytra.gui.framerate_viewer import MultiFrameratesWidget
 
 from stytra.stimulation.stimulus_display import StimulusDisplayOnMainWindow
@@ -367,9 +368,12 @@ class TrackingExperimentWindow(CameraExperimentWindow):
 
         self.track_params_wnd = None
 
-        self.status_display.addMessageQueue(
-            self.experiment.frame_dispatcher.message_queue
-        )
+        for frame_dispatcher in self.experiment.frame_dispatchers:
+            self.status_display.addMessageQueue(frame_dispatcher.message_queue)
+        if self.experiment.acc_recording_framerate is not None:
+            self.status_display.addMessageQueue(
+                self.experiment.frame_recorder.message_queue
+            )
 
     def construct_ui(self):
         """ """
@@ -385,6 +389,28 @@ class TrackingExperimentWindow(CameraExperimentWindow):
         self.add_dock(monitoring_dock)
 
         self.plot_framerate.add_framerate(self.experiment.acc_tracking_framerate)
+        if self.experiment.acc_recording_framerate is not None:
+            self.plot_framerate.add_framerate(self.experiment.acc_recording_framerate)
+
+        if self.experiment.acc_tracking_timing is not None:
+            self.timing_widget = TimingWidget(self.experiment.acc_tracking_timing)
+            self.experiment.gui_timer.timeout.connect(self.timing_widget.update)
+
+            dock_timing = QDockWidget("Tracking timing", self)
+            dock_timing.setObjectName("dock_timing")
+            dock_timing.setWidget(self.timing_widget)
+            self.add_dock(dock_timing)
+            self.addDockWidget(Qt.RightDockWidgetArea, dock_timing)
+
+        if self.experiment.latency_log is not None:
+            self.latency_widget = TimingWidget(self.experiment.latency_log)
+            self.experiment.gui_timer.timeout.connect(self.latency_widget.update)
+
+            dock_latency = QDockWidget("Closed-loop latency", self)
+            dock_latency.setObjectName("dock_latency")
+            dock_latency.setWidget(self.latency_widget)
+            self.add_dock(dock_latency)
+            self.addDockWidget(Qt.RightDockWidgetArea, dock_latency)
 
         if self.extra_widget:
             self.experiment.gui_timer.timeout.connect(self.extra_widget.update)
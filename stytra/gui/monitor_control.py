@@ -256,7 +256,7 @@ class ProjectorAndCalibrationWidget(QWidget):
     def toggle_calibration(self):
         """ """
         if isinstance(self.calibrator, CircleCalibrator):
-            _, frame = self.experiment.frame_dispatcher.gui_queue.get()
+            _, _, frame = self.experiment.frame_dispatcher.gui_queue.get_copy()
             self.widget_proj_viewer.display_calibration_pattern(
                 self.calibrator, frame.shape, frame
             )
@@ -270,7 +270,7 @@ class ProjectorAndCalibrationWidget(QWidget):
 
     def calibrate(self):
         """ """
-        _, frame = self.experiment.frame_dispatcher.gui_queue.get()
+        _, _, frame = self.experiment.frame_dispatcher.gui_queue.get_copy()
         try:
             self.calibrator.find_transform_matrix(frame)
             self.widget_proj_viewer.display_calibration_pattern(
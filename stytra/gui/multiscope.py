@@ -135,6 +135,8 @@ class MultiStreamPlot(QWidget):
 
         self.frozen = True
         self.bounds_visible = None
+        # time of the last update, the origin of the time axis
+        self.current_time = datetime.datetime.now()
 
         # trick to set color on update
         self.color_set = False
@@ -303,6 +305,7 @@ class MultiStreamPlot(QWidget):
             pass
 
         current_time = datetime.datetime.now()
+        self.current_time = current_time
 
         i_stream = 0
         for i_acc, (acc, sel_cols) in enumerate(
@@ -312,10 +315,10 @@ class MultiStreamPlot(QWidget):
             # try:
             # difference from data accumulator time and now in seconds:
             delta_t = (self.experiment.t0 - current_time).total_seconds()
-            data_frame = acc.get_last_t(self.time_past)
+            data_array = acc.get_last_t(self.time_past)
 
             # if this accumulator does not have enough data to plot, skip it
-            if data_frame is None or data_frame.shape[0] <= 1:
+            if data_array is None or data_array.shape[0] <= 1:
                 for _ in sel_cols:
                     self._set_labels(self.stream_items[i_stream])
                     self.stream_items[i_stream].curve.setData(x=[], y=[])
@@ -323,22 +326,20 @@ class MultiStreamPlot(QWidget):
                 continue
 
             # downsampling if there are too many points
-            if len(data_frame) > self.n_points_max:
-                data_frame = data_frame[:: len(data_frame) // self.n_points_max]
+            if len(data_array) > self.n_points_max:
+                data_array = data_array[:: len(data_array) // self.n_points_max]
 
-            time_array = delta_t + data_frame.t.values
+            time_array = delta_t + data_array[:, 0]
 
             # loop to handle nan values in a single column
             new_bounds = np.zeros((len(sel_cols), 2))
 
             for id, col in enumerate(sel_cols):
                 # Exclude nans from calculation of percentile boundaries:
-                d = data_frame[col].values
-                if d.dtype != np.float64:
-                    continue
+                d = data_array[:, acc.header_dict[col]]
                 b = ~np.isnan(d)
                 if np.any(b):
-                    non_nan_data = data_frame[col][b]
+                    non_nan_data = d[b]
                     new_bounds[id, :] = np.percentile(non_nan_data, (0.5, 99.5), 0)
                     # if the bounds are the same, set arbitrary ones
                     if new_bounds[id, 0] == new_bounds[id, 1]:
@@ -353,11 +354,12 @@ class MultiStreamPlot(QWidget):
                 else:
                     self.stream_items[i_stream].curve.setData(
                         x=time_array,
-                        y=i_stream + ((data_frame[col].values - lb) / scale),
+                        y=i_stream
+                        + ((data_array[:, acc.header_dict[col]] - lb) / scale),
                     )
                 self._set_labels(
                     self.stream_items[i_stream],
-                    values=(lb, ub, data_frame[col].values[-1]),
+                    values=(lb, ub, data_array[-1, acc.header_dict[col]]),
                 )
                 i_stream += 1
 
@@ -422,9 +424,11 @@ class MultiStreamPlot(QWidget):
                 left_lim = self.replay_left.getXPos()
                 right_lim = self.replay_right.getXPos()
 
+                # the limits are timestamps, to select the replayed frames
+                t_plot = self.current_time.timestamp()
                 self.experiment.camera_state.replay_limits = (
-                    min(left_lim, right_lim),
-                    max(left_lim, right_lim),
+                    t_plot + min(left_lim, right_lim),
+                    t_plot + max(left_lim, right_lim),
                 )
             except AttributeError:
                 pass
@@ -479,11 +483,7 @@ class FrameratePlot(MultiStreamPlot):
         super().update()
         for acc in self.accumulators:
             lim = self.framerate_limits.get(acc.name, None)
-            if (
-                lim is not None
-                and len(acc.stored_data) > 0
-                and acc.stored_data[-1][0] < lim
-            ):
+            if lim is not None and len(acc) > 0 and acc.get_last_n(1)[0, 1] < lim:
                 print("BAD ", acc.name)
 
     def _round_bounds(self, bounds):
@@ -0,0 +1,40 @@
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QTableWidget, QTableWidgetItem
+
+
+class TimingWidget(QWidget):
+    """Shows the number of calls and the durations of the tracking steps
+    (pipeline nodes, queue wait and dispatching) in the last interval
+    received by a timing accumulator, or the latencies of the stages of
+    the closed loop from a latency log
+
+    """
+
+    columns = ["n", "mean_ms", "p50_ms", "p95_ms", "p99_ms"]
+
+    def __init__(self, acc):
+        super().__init__()
+        self.acc = acc
+        self.n_updates = 0
+        self.table = QTableWidget(0, len(self.columns))
+        self.table.setHorizontalHeaderLabels(
+            [c.replace("_ms", " (ms)") for c in self.columns]
+        )
+        self.setLayout(QVBoxLayout())
+        self.layout().addWidget(self.table)
+
+    def update(self):
+        if self.acc.n_updates == self.n_updates:
+            return
+        self.n_updates = self.acc.n_updates
+
+        summaries = self.acc.get_last_summaries()
+        self.table.setRowCount(len(summaries))
+        self.table.setVerticalHeaderLabels(list(summaries.keys()))
+        for i_row, summary in enumerate(summaries.values()):
+            for i_col, column in enumerate(self.columns):
+                if column == "n":
+                    text = str(summary[column])
+                else:
+                    text = "{:.3f}".format(summary[column])
+                self.table.setItem(i_row, i_col, QTableWidgetItem(text))
+        super().update()
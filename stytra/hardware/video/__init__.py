@@ -5,7 +5,7 @@ implement video saving
 
 import numpy as np
 
-from multiprocessing import Queue, Event
+from multiprocessing import Queue, Event, RawArray
 from queue import Empty, Full
 
 from lightparam import Param
@@ -13,16 +13,19 @@ from lightparam.param_qt import ParametrizedQt
 
 from stytra.hardware.video.cameras.interface import CameraError
 from stytra.utilities import FrameProcess
-from arrayqueues.shared_arrays import IndexedArrayQueue
-import flammkuchen as fl
+from stytra.collectors.namedtuplequeue import NamedTupleArrayQueue
 
 from stytra.hardware.video.cameras import camera_class_dict
 
 from stytra.hardware.video.write import VideoWriter
+from stytra.hardware.video.read import H5FrameReader
 
+from stytra.hardware.video.frame_pool import FramePool
 from stytra.hardware.video.ring_buffer import RingBuffer
 
 import time
+from time import perf_counter
+from datetime import datetime
 
 
 class VideoSource(FrameProcess):
@@ -40,9 +43,19 @@ class VideoSource(FrameProcess):
 
     **Output Queues**
 
-    self.frame_queue :
-        TimestampedArrayQueue from the arrayqueues module
-        where the frames read from the camera are sent.
+    self.frame_pool :
+        FramePool in which each frame read from the camera is written once.
+
+    self.frame_queues :
+        FrameQueues of the pool where the frames read from the camera are
+        sent, each frame to the queue with the fewest frames waiting. The
+        first one is also self.frame_queue, more can be added with
+        add_frame_queue for several consumers.
+
+    self.acquisition_times :
+        shared array with the monotonic (perf_counter) time at which each
+        frame was acquired, at the index of the frame modulo its length,
+        used to measure the closed-loop latency.
 
 
     **Events**
@@ -56,36 +69,69 @@ class VideoSource(FrameProcess):
     rotation : int
         n of times image should be rotated of 90 degrees
     max_mbytes_queue : int
-        maximum size of camera queue (Mbytes)
+        size of the frame pool (Mbytes)
+    max_pending : int
+        maximum number of frames waiting in each frame queue, if the
+        consumers are slower further frames are dropped
 
     Returns
     -------
 
     """
 
-    def __init__(self, rotation=False, max_mbytes_queue=200, n_consumers=1):
+    def __init__(self, rotation=False, max_mbytes_queue=200, max_pending=3):
         """ """
         super().__init__(name="camera")
         self.rotation = rotation
         self.control_queue = Queue()
-        self.frame_queue = IndexedArrayQueue(max_mbytes=max_mbytes_queue)
+        self.frame_pool = FramePool(max_mbytes=max_mbytes_queue)
+        self.max_pending = max_pending
+        self.frame_queue = self.frame_pool.new_queue(max_pending=max_pending)
+        self.frame_queues = [self.frame_queue]
         self.kill_event = Event()
-        self.n_consumers = 1
         self.state = None
+        self.acquisition_times = RawArray("d", 4096)
+        self.frame_counter = 0
+
+    def add_frame_queue(self):
+        """Adds a queue to which frames are sent, for an additional
+        consumer. Has to be called before the process is started.
+        """
+        queue = self.frame_pool.new_queue(max_pending=self.max_pending)
+        self.frame_queues.append(queue)
+        return queue
+
+    def stamp_frame(self, t_acquired=None):
+        """Records the acquisition time of the next frame sent to the
+        frame queues, by default the current time
+        """
+        self.acquisition_times[self.frame_counter % len(self.acquisition_times)] = (
+            perf_counter() if t_acquired is None else t_acquired
+        )
 
-    def put_frame(self, frame, messages):
-        # If the queue is full, arrayqueues should print a warning!
+    def send_frame(self, slot, messages, t_acquired=None, timestamp=None):
+        """Sends a frame of the pool to the least busy frame queue"""
+        self.stamp_frame(t_acquired)
+        queue = min(self.frame_queues, key=lambda q: q.qsize())
         try:
-            if self.frame_queue.queue.qsize() < self.n_consumers + 2:
-                self.frame_queue.put(frame)
-            else:
-                messages.append("W:Dropped frame")
-        except NotImplementedError:
-            try:
-                self.frame_queue.put(frame)
-            except Full:
-                messages.append("W:Dropped frame")
+            self.frame_pool.send(queue, slot, timestamp, self.frame_counter)
+            self.frame_counter += 1
+        except Full:
+            messages.append("W:Dropped frame")
+
+    def put_frame(self, frame, messages, t_acquired=None, timestamp=None):
+        """Writes a frame in the pool and sends it, returns its slot or
+        None if the pool is full
+        """
+        try:
+            slot = self.frame_pool.put(frame)
+        except Full:
+            messages.append("W:Dropped frame")
+            slot = None
+        else:
+            self.send_frame(slot, messages, t_acquired, timestamp)
         self.update_framerate()
+        return slot
 
 
 class CameraSource(VideoSource):
@@ -98,6 +144,17 @@ class CameraSource(VideoSource):
     Avt      Add some info
     ======== ===========================================
 
+    **Output Queues**
+
+    self.ring_buffer :
+        RingBuffer with the most recent frames, which can be replayed or
+        saved from other processes.
+
+    self.ground_truth_queue :
+        for cameras which simulate the animals, NamedTupleArrayQueue with
+        their poses in each frame, with the same timestamps as the frames,
+        otherwise None.
+
     Parameters
     ----------
     camera_type : str
@@ -135,12 +192,19 @@ class CameraSource(VideoSource):
         self.max_buffer_length = max_buffer_length
 
         self.state = None
-        self.ring_buffer = None
+        self.ring_buffer = RingBuffer(max_buffer_length, self.frame_pool)
+        # capacity of the replay buffer for which the last warning was given
+        self._warned_capacity = None
+
+        self.ground_truth_queue = None
+        if getattr(camera_class_dict.get(camera_type), "has_ground_truth", False):
+            self.ground_truth_queue = NamedTupleArrayQueue()
 
     def retrieve_params(self, messages):
         while True:
             try:
-                param_dict = self.control_queue.get(timeout=0.0001)
+                # not waiting, as it would limit the framerate
+                param_dict = self.control_queue.get(block=False)
                 self.state.params.values = param_dict
                 for param, value in param_dict.items():
                     ms = self.cam.set(param, value)
@@ -165,17 +229,18 @@ class CameraSource(VideoSource):
             self.state = CameraControlParameters()
         try:
             CameraClass = camera_class_dict[self.camera_type]
+            camera_params = dict(self.camera_params)
+            if self.ground_truth_queue is not None:
+                camera_params["ground_truth_queue"] = self.ground_truth_queue
             self.cam = CameraClass(
-                downsampling=self.downsampling, roi=self.roi, **self.camera_params
+                downsampling=self.downsampling, roi=self.roi, **camera_params
             )
         except KeyError:
             raise Exception("{} is not a valid camera type!".format(self.camera_type))
         camera_messages = list(self.cam.open_camera())
         [self.message_queue.put(m) for m in camera_messages]
-        prt = None
         while True:
-            # Kill if signal is set:
-            self.kill_event.wait(0.0001)
+            # Kill if signal is set, the loop is paced by the camera:
             if self.kill_event.is_set():
                 break
             # Try to get new parameters from the control queue:
@@ -185,68 +250,73 @@ class CameraSource(VideoSource):
             # Grab the new frame, and put it in the queue if valid:
             try:
                 arr = self.cam.read()
+                t_acquired = perf_counter()
             except CameraError:
                 pass
 
             if self.rotation:
                 arr = np.rot90(arr, self.rotation)
 
-            res_len = int(round(self.state.framerate * self.state.ring_buffer_length))
+            # the buffer is long enough both for the replay and for saving
+            res_len = int(
+                round(
+                    self.state.framerate
+                    * max(self.state.ring_buffer_length, self.state.save_duration)
+                )
+            )
             if res_len > self.max_buffer_length:
                 res_len = self.max_buffer_length
-                self.message_queue.put(
-                    "W:Replay buffer too big, make the plot"
-                    " time range smaller for full replay"
-                    " capabilities"
-                )
-
-            if self.ring_buffer is None or res_len != self.ring_buffer.length:
-                self.ring_buffer = RingBuffer(res_len)
+            if res_len != self.ring_buffer.length:
+                if res_len == self.max_buffer_length:
+                    self.message_queue.put(
+                        "W:Replay buffer too big, make the plot"
+                        " time range smaller for full replay"
+                        " capabilities"
+                    )
+                self.ring_buffer.set_length(res_len)
 
+            # the buffer is replayed by the GUI, while the acquisition goes on
             if self.state.paused:
                 self.message_queue.put(
                     "I:Ring_buffer_size:" + str(self.ring_buffer.length)
                 )
-                if self.ring_buffer.arr is not None:
-                    self.frame_queue.put(self.ring_buffer.get_most_recent())
+                if len(self.ring_buffer) > 0:
+                    self.send_frame(self.ring_buffer.get_most_recent(), messages)
                 else:
                     self.message_queue.put("E:camera paused before any frames acquired")
-                prt = None
-            elif self.state.replay and self.state.replay_fps > 0:
-                messages.append(
-                    "I:Replaying between {} and {} of {}".format(
-                        *self.state.replay_limits, self.ring_buffer.length
-                    )
-                )
-                old_fps = self.framerate_rec.current_framerate
-                if old_fps is not None:
-                    self.ring_buffer.replay_limits = (
-                        int(round(self.state.replay_limits[0] * old_fps)),
-                        int(round(self.state.replay_limits[1] * old_fps)),
-                    )
-                try:
-                    self.frame_queue.put(self.ring_buffer.get())
-                except ValueError:
-                    pass
-                delta_t = 1 / self.state.replay_fps
-                if prt is not None:
-                    extrat = delta_t - (time.process_time() - prt)
-                    if extrat > 0:
-                        time.sleep(extrat)
-                prt = time.process_time()
-            else:
-                prt = None
-                if arr is not None:
-                    try:
-                        self.ring_buffer.put(arr)
-                    except AttributeError:
-                        pass
-                    self.put_frame(arr, messages)
+            elif arr is not None:
+                # the frames of the buffer have to be released before
+                # the pool is rearranged for frames of another shape
+                if self.frame_pool.layout != (arr.dtype.str, arr.shape):
+                    self.ring_buffer.clear()
+                timestamp = self.cam.frame_time or datetime.now()
+                slot = self.put_frame(arr, messages, t_acquired, timestamp)
+                if slot is not None:
+                    self.ring_buffer.put(slot, timestamp)
+                    self.check_replay_capacity()
             for m in messages:
                 self.message_queue.put(m)
 
+        self.ring_buffer.clear()
         self.cam.release()
 
+    def check_replay_capacity(self):
+        """Warns once if the replay buffer cannot hold the frames of the
+        duration which is saved, because the frame pool is too small"""
+        capacity = self.ring_buffer.capacity()
+        n_saved = int(round(self.state.framerate * self.state.save_duration))
+        if n_saved <= capacity or capacity == self._warned_capacity:
+            return
+        self._warned_capacity = capacity
+        self.message_queue.put(
+            "W:The replay buffer holds only {} frames ({:.1f} s), increase"
+            " camera_queue_mb to save {:.1f} s".format(
+                capacity,
+                capacity / self.state.framerate,
+                self.state.save_duration,
+            )
+        )
+
 
 class VideoFileSource(VideoSource):
     """A class to stream videos from a file to test parts of
@@ -289,12 +359,9 @@ class VideoFileSource(VideoSource):
         if self.state is None:
             self.state = VideoControlParameters()
         if self.source_file.endswith("h5") or self.source_file.endswith("hdf5"):
-            framedata = fl.load(self.source_file)
-
-            if isinstance(framedata, np.ndarray):
-                frames = framedata
-            else:
-                frames = framedata["video"]
+            # frames are read lazily, with a read-ahead thread
+            frames = H5FrameReader(self.source_file)
+            frames.loop_start = self.offset
 
             i_frame = self.offset
             prt = None
@@ -312,12 +379,12 @@ class VideoFileSource(VideoSource):
                     if extrat > 0:
                         time.sleep(extrat)
 
-                self.put_frame(frames[i_frame, :, :], messages)
+                self.put_frame(frames[i_frame], messages)
 
                 if not self.state.paused:
                     i_frame += 1
 
-                if i_frame == frames.shape[0]:
+                if i_frame == len(frames):
                     if self.loop:
                         i_frame = self.offset
                     else:
@@ -327,6 +394,8 @@ class VideoFileSource(VideoSource):
                     self.message_queue.put(m)
                 prt = time.process_time()
 
+            frames.close()
+
         else:
             import av
 
@@ -409,3 +478,9 @@ class CameraControlParameters(ParametrizedQt):
             desc="If bigger than 0, the rolling buffer will be replayed at the given framerate",
         )
         self.replay_limits = Param((0, 600), gui=False)
+        self.save_duration = Param(
+            10.0,
+            (0.1, 3600),
+            unit="s",
+            desc="Duration of the end of the replay buffer which is saved",
+        )
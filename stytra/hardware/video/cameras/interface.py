@@ -26,6 +26,10 @@ class Camera:
     debug : bool
         if true, state of the camera is printed.
 
+    frame_time : datetime
+        if the camera sets it, the time at which the last frame was taken,
+        used as the timestamp of the frame instead of the time it is read.
+
 
     """
 
@@ -39,6 +43,7 @@ class Camera:
         self.cam = None
         self.downsampling = downsampling
         self.roi = roi
+        self.frame_time = None
 
     def open_camera(self):
         """Initialise the camera."""
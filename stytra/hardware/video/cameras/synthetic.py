@@ -0,0 +1,422 @@
+"""Camera which generates the frames of simulated larvae, to run and
+benchmark Stytra without a camera, and to measure the accuracy of the
+tracking from the known poses of the fish.
+"""
+
+import time
+from collections import namedtuple
+from datetime import datetime
+from queue import Full
+from time import perf_counter
+
+import numpy as np
+from numba import jit
+
+from stytra.hardware.video.cameras.interface import Camera
+
+# number of segments of the tail of the simulated larvae
+N_TAIL_SEGMENTS = 10
+
+# length of the larvae in pixels, brightness of the background and how much
+# darker the tail, the head and the eyes are, close to the example videos so
+# that the default tracking parameters work
+MODE_DEFAULTS = dict(
+    embedded=dict(fish_length=120.0, background=130, contrasts=(60, 65, 120)),
+    free=dict(fish_length=60.0, background=200, contrasts=(30, 60, 180)),
+)
+
+
+class SyntheticCamera(Camera):
+    """Generates frames of zebrafish larvae, either head-restrained, with the
+    tail and the eyes moving, or swimming freely in bouts.
+    The frames are drawn in a few preallocated buffers which are used in
+    turn, so a frame returned by read is valid until n_buffers more frames
+    are read.
+
+    The pose of the fish in each frame is put in the ground_truth_queue
+    (given by the :class:`CameraSource <stytra.hardware.video.CameraSource>`)
+    with the same timestamp as the frame, so it can be compared with the
+    tracking row by row. For each fish i, the columns are:
+
+    - fi_x, fi_y: position of the head (between the eyes), in pixels;
+    - fi_theta: direction from the head to the tail, in radians, as for the
+      tracking of freely-swimming fish;
+    - fi_tail_sum: total bending of the tail, as for the tail tracking;
+    - fi_th_e0, fi_th_e1: orientations of the eyes, in degrees, as for the
+      eye tracking.
+
+    Parameters
+    ----------
+    frame_size : (int, int)
+        height and width of the frames
+    framerate : float
+        if given, the frames are generated at this rate (which can be much
+        higher than the limit in the camera parameters), otherwise they
+        follow the framerate set for the camera
+    mode : str
+        "embedded" for head-restrained larvae facing upwards and lined up
+        in the middle of the frame, or "free" for freely swimming larvae
+    n_fish : int
+        number of larvae
+    fish_length : float
+        length of the larvae in pixels, by default about the one in the
+        example video of the mode
+    bout_rate : float
+        average number of bouts per second for each fish
+    bout_duration : float
+        duration of a bout, in seconds
+    tail_beat_frequency : float
+        frequency of the tail oscillation during bouts, in Hz
+    saccade_rate : float
+        average number of eye saccades per second
+    background : int
+        brightness of the background, by default the one of the example
+        video of the mode
+    noise : float
+        standard deviation of the pixel noise
+    n_buffers : int
+        number of frames drawn in turn
+    seed : int
+        seed of the random movements
+    ground_truth_queue : NamedTupleArrayQueue
+        queue in which the poses are put, if given
+
+    """
+
+    has_ground_truth = True
+
+    def __init__(
+        self,
+        frame_size=(480, 640),
+        framerate=None,
+        mode="free",
+        n_fish=3,
+        fish_length=None,
+        bout_rate=1.5,
+        bout_duration=0.2,
+        tail_beat_frequency=30.0,
+        saccade_rate=0.5,
+        background=None,
+        noise=3.0,
+        n_buffers=4,
+        seed=0,
+        ground_truth_queue=None,
+        **kwargs
+    ):
+        super().__init__(**kwargs)
+        if mode not in ("free", "embedded"):
+            raise ValueError("{} is not a valid synthetic camera mode".format(mode))
+        self.frame_size = tuple(frame_size)
+        self.fixed_framerate = framerate is not None
+        self.framerate = float(framerate) if framerate is not None else 150.0
+        self.mode = mode
+        self.n_fish = n_fish
+        defaults = MODE_DEFAULTS[mode]
+        self.fish_length = (
+            fish_length if fish_length is not None else defaults["fish_length"]
+        )
+        self.bout_rate = bout_rate
+        self.bout_duration = bout_duration
+        self.tail_beat_frequency = tail_beat_frequency
+        self.saccade_rate = saccade_rate
+        self.noise = noise
+        self.ground_truth_queue = ground_truth_queue
+        self.rng = np.random.RandomState(seed)
+
+        self.background = (
+            background if background is not None else defaults["background"]
+        )
+        # gray levels of the tail, the head and the eyes
+        self.levels = np.clip(
+            self.background - np.array(defaults["contrasts"], float), 0, 255
+        )
+
+        self.buffers = np.zeros((n_buffers,) + self.frame_size, np.uint8)
+        self.backgrounds = self._make_backgrounds(4)
+
+        self.i_frame = 0
+        self.pose = None
+        self._t_next = None
+
+        fields = ["frame"]
+        for i_fish in range(n_fish):
+            fields.extend(
+                "f{}_{}".format(i_fish, name)
+                for name in ["x", "y", "theta", "tail_sum", "th_e0", "th_e1"]
+            )
+        self._pose_type = namedtuple("synthetic_pose", fields)
+
+        self._init_fish()
+
+    def _make_backgrounds(self, n_backgrounds):
+        """Backgrounds with a slightly darker border and independent noise,
+        used in turn
+        """
+        h, w = self.frame_size
+        yy, xx = np.mgrid[0:h, 0:w]
+        r2 = ((yy - h / 2) / h) ** 2 + ((xx - w / 2) / w) ** 2
+        illumination = self.background * (1 - 0.1 * r2)
+        return np.clip(
+            illumination + self.rng.normal(0, self.noise, (n_backgrounds, h, w)),
+            0,
+            255,
+        ).astype(np.uint8)
+
+    def _init_fish(self):
+        h, w = self.frame_size
+        n = self.n_fish
+        if self.mode == "embedded":
+            self.x = (np.arange(n) + 0.5) * w / n
+            self.y = np.full(n, h / 2 - 0.45 * self.fish_length)
+            self.heading = np.full(n, -np.pi / 2)
+        else:
+            margin = self.fish_length
+            self.x = self.rng.uniform(margin, w - margin, n)
+            self.y = self.rng.uniform(margin, h - margin, n)
+            self.heading = self.rng.uniform(-np.pi, np.pi, n)
+
+        self.bends = np.zeros((n, N_TAIL_SEGMENTS))
+        self.bout_time = np.full(n, np.nan)
+        self.bout_amplitude = np.zeros(n)
+        self.bout_turn = np.zeros(n)
+        self.bout_distance = np.zeros(n)
+        self.vergence = self.rng.uniform(0.25, 0.4, n)
+        self.eye_angle = np.zeros(n)
+
+        # the oscillation grows and is delayed along the tail
+        i_segments = np.arange(N_TAIL_SEGMENTS)
+        self._segment_weights = (i_segments + 1) / N_TAIL_SEGMENTS
+        self._segment_phases = 1.6 * np.pi * i_segments / N_TAIL_SEGMENTS
+
+    def open_camera(self):
+        return [
+            "I:Synthetic camera with {} {} fish, {}x{} frames".format(
+                self.n_fish, self.mode, *self.frame_size
+            )
+        ]
+
+    def set(self, param, val):
+        if param == "framerate" and not self.fixed_framerate:
+            self.framerate = val
+
+    def _start_bout(self, i_fish):
+        self.bout_time[i_fish] = 0.0
+        self.bout_amplitude[i_fish] = self.rng.uniform(0.4, 0.8)
+        if self.mode == "embedded":
+            return
+        self.bout_distance[i_fish] = self.rng.uniform(0.25, 0.75) * self.fish_length
+        h, w = self.frame_size
+        near_wall = 1.5 * self.fish_length
+        if (
+            min(self.x[i_fish], w - self.x[i_fish]) < near_wall
+            or min(self.y[i_fish], h - self.y[i_fish]) < near_wall
+        ):
+            # turn towards the centre of the arena
+            towards_centre = np.arctan2(h / 2 - self.y[i_fish], w / 2 - self.x[i_fish])
+            self.bout_turn[i_fish] = (
+                np.mod(towards_centre - self.heading[i_fish] + np.pi, 2 * np.pi) - np.pi
+            ) * self.rng.uniform(0.5, 1.0)
+        else:
+            self.bout_turn[i_fish] = self.rng.normal(0, 0.4)
+
+    def _step(self, dt):
+        """Advances the simulation by dt seconds"""
+        starts = self.rng.random_sample(self.n_fish) < self.bout_rate * dt
+        for i_fish in np.flatnonzero(starts & np.isnan(self.bout_time)):
+            self._start_bout(i_fish)
+
+        saccades = self.rng.random_sample(self.n_fish) < self.saccade_rate * dt
+        self.eye_angle[saccades] = self.rng.uniform(-0.35, 0.35, np.sum(saccades))
+
+        h, w = self.frame_size
+        margin = 0.6 * self.fish_length
+        for i_fish in range(self.n_fish):
+            t_bout = self.bout_time[i_fish]
+            if np.isnan(t_bout):
+                self.bends[i_fish, :] = 0.0
+                continue
+            envelope = np.sin(np.pi * t_bout / self.bout_duration)
+            self.bends[i_fish, :] = (
+                self.bout_amplitude[i_fish]
+                * envelope
+                * self._segment_weights
+                * np.sin(
+                    2 * np.pi * self.tail_beat_frequency * t_bout - self._segment_phases
+                )
+            )
+            if self.mode == "free":
+                # the turn and the displacement follow the envelope, so that
+                # their totals over the bout are bout_turn and bout_distance
+                rate = np.pi / (2 * self.bout_duration) * envelope * dt
+                self.heading[i_fish] += self.bout_turn[i_fish] * rate
+                distance = self.bout_distance[i_fish] * rate
+                self.x[i_fish] = np.clip(
+                    self.x[i_fish] + distance * np.cos(self.heading[i_fish]),
+                    margin,
+                    w - margin,
+                )
+                self.y[i_fish] = np.clip(
+                    self.y[i_fish] + distance * np.sin(self.heading[i_fish]),
+                    margin,
+                    h - margin,
+                )
+            self.bout_time[i_fish] = t_bout + dt
+            if self.bout_time[i_fish] >= self.bout_duration:
+                self.bout_time[i_fish] = np.nan
+
+    def _eye_angles(self, i_fish):
+        """Orientations of the eyes in the image, the eye on the left of the
+        fish first, converging towards the front
+        """
+        return (
+            self.heading[i_fish]
+            + np.array([1.0, -1.0]) * self.vergence[i_fish]
+            + self.eye_angle[i_fish]
+        )
+
+    def _get_pose(self):
+        values = [self.i_frame]
+        for i_fish in range(self.n_fish):
+            bends = self.bends[i_fish]
+            eye_angles = self._eye_angles(i_fish)
+            values.extend(
+                [
+                    self.x[i_fish],
+                    self.y[i_fish],
+                    np.mod(self.heading[i_fish], 2 * np.pi) - np.pi,
+                    # the tail tracking measures the angles the other way round
+                    -(bends[-1] + bends[-2] - bends[0] - bends[1]),
+                ]
+            )
+            values.extend(-np.mod(np.degrees(eye_angles) + 90, 180))
+        return self._pose_type(*values)
+
+    def _wait_frame(self):
+        """Waits until the time of the next frame. If the frames are late by
+        more than one, the following ones are timed from now on
+        """
+        interval = 1 / self.framerate
+        now = perf_counter()
+        if self._t_next is None or now - self._t_next > interval:
+            self._t_next = now
+        while True:
+            remaining = self._t_next - perf_counter()
+            if remaining <= 0:
+                break
+            # sleeping is not precise enough for high framerates, so the
+            # last part is waited yielding to the other processes, which
+            # could not run on a single processor otherwise
+            if remaining > 0.001:
+                time.sleep(remaining - 0.0005)
+            else:
+                time.sleep(0)
+        self._t_next += interval
+
+    def read(self):
+        self._wait_frame()
+        self.frame_time = datetime.now()
+        self._step(1 / self.framerate)
+
+        frame = self.buffers[self.i_frame % len(self.buffers)]
+        np.copyto(frame, self.backgrounds[self.i_frame % len(self.backgrounds)])
+        for i_fish in range(self.n_fish):
+            _draw_larva(
+                frame,
+                self.x[i_fish],
+                self.y[i_fish],
+                self.heading[i_fish],
+                self.bends[i_fish],
+                self._eye_angles(i_fish),
+                self.fish_length,
+                self.levels,
+            )
+
+        self.pose = self._get_pose()
+        if self.ground_truth_queue is not None:
+            try:
+                self.ground_truth_queue.put(self.frame_time, self.pose)
+            except Full:
+                pass
+        self.i_frame += 1
+        return frame
+
+
+@jit(nopython=True)
+def _draw_ellipse(frame, cx, cy, a, b, angle, value):
+    """Darkens the frame towards value inside an ellipse, with antialiased
+    edges
+
+    Parameters
+    ----------
+    frame :
+        image drawn into
+    cx, cy :
+        centre of the ellipse
+    a, b :
+        semi-axes, a along the angle and b across it (b <= a)
+    angle :
+        orientation of the ellipse in radians
+    value :
+        gray level inside the ellipse
+
+    """
+    h, w = frame.shape
+    r = max(a, b) + 1
+    cos_a = np.cos(angle)
+    sin_a = np.sin(angle)
+    for i in range(max(int(cy - r), 0), min(int(cy + r) + 2, h)):
+        for j in range(max(int(cx - r), 0), min(int(cx + r) + 2, w)):
+            dx = j - cx
+            dy = i - cy
+            u = (dx * cos_a + dy * sin_a) / a
+            v = (-dx * sin_a + dy * cos_a) / b
+            # approximate distance to the edge, in pixels
+            coverage = (1.0 - np.sqrt(u * u + v * v)) * b + 0.5
+            if coverage <= 0:
+                continue
+            if coverage > 1:
+                coverage = 1.0
+            old = float(frame[i, j])
+            new = old + coverage * (value - old)
+            if new < old:
+                frame[i, j] = int(new + 0.5)
+
+
+@jit(nopython=True)
+def _draw_larva(frame, x, y, heading, bends, eye_angles, length, levels):
+    """Draws a larva with the head at (x, y), facing heading, with the tail
+    segments bent from the body axis by bends, and the gray levels of the
+    tail, the head and the eyes given by levels
+    """
+    ux = np.cos(heading)
+    uy = np.sin(heading)
+
+    # the tail is made of discs tapering towards the end
+    n_segments = len(bends)
+    seg_length = 0.85 * length / n_segments
+    n_discs = max(int(seg_length), 1)
+    px = x - 0.1 * length * ux
+    py = y - 0.1 * length * uy
+    for i_seg in range(n_segments):
+        psi = heading + np.pi + bends[i_seg]
+        dx = np.cos(psi) * seg_length / n_discs
+        dy = np.sin(psi) * seg_length / n_discs
+        for i_disc in range(n_discs):
+            t = (i_seg * n_discs + i_disc) / (n_segments * n_discs)
+            radius = length * (0.045 - 0.03 * t)
+            _draw_ellipse(frame, px, py, radius, radius, 0.0, levels[0])
+            px += dx
+            py += dy
+
+    _draw_ellipse(frame, x, y, 0.11 * length, 0.085 * length, heading, levels[1])
+    for i_eye in range(2):
+        side = 2 * i_eye - 1
+        _draw_ellipse(
+            frame,
+            x - side * 0.065 * length * uy,
+            y + side * 0.065 * length * ux,
+            0.075 * length,
+            0.045 * length,
+            eye_angles[i_eye],
+            levels[2],
+        )
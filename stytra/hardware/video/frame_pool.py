@@ -0,0 +1,329 @@
+"""
+Shared-memory pool of frames, so that the frames acquired by a camera are
+written only once and read in place by all the processes using them
+"""
+
+from datetime import datetime
+from multiprocessing import Array, RawArray
+from queue import Empty, Full
+import time
+
+import numpy as np
+
+from arrayqueues.portable_queue import PortableQueue
+
+
+class FramePool:
+    """Shared memory divided in slots of the size of a frame, in which
+    the producer (e.g. the camera process) writes each frame once.
+
+    Instead of the frames, only the indices of their slots are sent
+    through the queues (see :class:`FrameQueue`), so that the frames can
+    be tracked, recorded and displayed without being copied.
+
+    A slot is reused when no one references it anymore: sending a slot to
+    a queue or holding it adds a reference, releasing it removes one. The
+    reference counts are kept lock-free, as the sums of two counters per
+    slot, the references taken and the references given back, each of
+    them in a separate row for the producer and for every queue, so that
+    each row is only written by a single process.
+
+    Parameters
+    ----------
+    max_mbytes : float
+        size of the shared memory, in megabytes
+    max_slots : int
+        maximum number of frames in the pool, if they are small
+    max_queues : int
+        maximum number of queues which can be made from the pool
+    layout_timeout : float
+        when the shape or type of the frames changes, maximum time
+        (in seconds) to wait for the references to the old frames to be
+        released, after which the new frames are refused until they are
+
+    """
+
+    def __init__(
+        self, max_mbytes=200, max_slots=1024, max_queues=64, layout_timeout=0.1
+    ):
+        self.maxbytes = int(max_mbytes * 1000000)
+        self.max_slots = max_slots
+        self.max_queues = max_queues
+        self.layout_timeout = layout_timeout
+        self.array = Array("c", self.maxbytes, lock=False)
+        # references taken and released by the producer (row 0) and by
+        # the consumers of each queue
+        self.counter_array = RawArray("q", 2 * (max_queues + 1) * max_slots)
+        self.n_queues = 0
+
+        # state of the producer
+        self.layout = None
+        self.n_slots = 0
+        self.last_slot = -1
+
+        self._counters = None
+        self._frames = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_counters"] = None
+        state["_frames"] = dict()
+        return state
+
+    @property
+    def counters(self):
+        if self._counters is None:
+            self._counters = np.frombuffer(self.counter_array, dtype=np.int64).reshape(
+                2, self.max_queues + 1, self.max_slots
+            )
+        return self._counters
+
+    def slots_for(self, layout):
+        """Number of slots the pool is divided in for frames of a given
+        layout, a tuple of the dtype string and of the shape"""
+        dtype, shape = layout
+        nbytes = int(np.dtype(dtype).itemsize * np.prod(shape))
+        n_slots = min(self.max_slots, self.maxbytes // nbytes)
+        if n_slots == 0:
+            raise ValueError(
+                "Frames of shape {} do not fit in the frame pool".format(shape)
+            )
+        return n_slots
+
+    def frames(self, layout):
+        """Array of all the slots of the pool for a given layout"""
+        try:
+            return self._frames[layout]
+        except KeyError:
+            dtype, shape = layout
+            n_slots = self.slots_for(layout)
+            frames = np.frombuffer(
+                self.array, dtype=dtype, count=int(n_slots * np.prod(shape))
+            ).reshape((n_slots,) + tuple(shape))
+            self._frames[layout] = frames
+            return frames
+
+    def references(self, slots=None):
+        """Number of references to each slot of the current layout, or to
+        the given slots"""
+        if slots is None:
+            slots = slice(0, self.n_slots)
+        # the released references are read before the taken ones, so that
+        # a slot which is forwarded and released in the meantime by a
+        # consumer can only look more referenced than it is, never free
+        released = self.counters[1, :, slots].sum(0)
+        taken = self.counters[0, :, slots].sum(0)
+        return taken - released
+
+    def new_queue(self, max_pending=None):
+        """Makes a queue through which the frames of the pool are sent to
+        a consumer. Has to be called before the processes are started.
+
+        Parameters
+        ----------
+        max_pending : int
+            maximum number of frames waiting in the queue, by default half
+            of the slots of the pool
+
+        Returns
+        -------
+        FrameQueue
+
+        """
+        if self.n_queues == self.max_queues:
+            raise ValueError("No more queues can be made from the frame pool")
+        self.n_queues += 1
+        return FrameQueue(self, self.n_queues, max_pending)
+
+    def _set_layout(self, layout):
+        if self.layout is not None:
+            t_start = time.perf_counter()
+            while (
+                np.any(self.references() != 0)
+                and time.perf_counter() - t_start < self.layout_timeout
+            ):
+                time.sleep(0.001)
+            # the old frames would be overwritten while they are read
+            if np.any(self.references() != 0):
+                raise Full
+        self.layout = layout
+        self.n_slots = self.slots_for(layout)
+        self.last_slot = -1
+
+    def put(self, frame):
+        """Copies a frame in a free slot of the pool. Unless the slot is then
+        sent to a queue or held, it is free again afterwards.
+
+        Parameters
+        ----------
+        frame : np.ndarray
+
+        Returns
+        -------
+        int
+            the slot of the frame
+
+        Raises
+        ------
+        queue.Full
+            if all the slots are in use, or if the shape or type of the
+            frames changed and frames of the previous ones are still in use
+
+        """
+        layout = (frame.dtype.str, frame.shape)
+        if layout != self.layout:
+            self._set_layout(layout)
+
+        # slots are used in order, so that the frames are reused as late
+        # as possible
+        slot = (self.last_slot + 1) % self.n_slots
+        if self.references(slot) != 0:
+            free = np.flatnonzero(self.references() == 0)
+            if len(free) == 0:
+                raise Full
+            slot = free[np.searchsorted(free, slot) % len(free)]
+
+        self.frames(layout)[slot] = frame
+        self.last_slot = slot
+        return slot
+
+    def send(self, queue, slot, timestamp=None, index=0):
+        """Sends a slot written by the producer to a queue
+
+        Parameters
+        ----------
+        queue : FrameQueue
+        slot : int
+        timestamp : datetime
+            by default, the current time
+        index : int
+            the index of the frame
+
+        Raises
+        ------
+        queue.Full
+            if too many frames are waiting in the queue
+
+        """
+        queue.put_slot(0, self.layout, slot, timestamp, index)
+
+    def hold(self, slot):
+        """Keeps a slot from being reused by the producer"""
+        self.counters[0, 0, slot] += 1
+
+    def release(self, slot):
+        """Releases a slot held by the producer"""
+        self.counters[1, 0, slot] += 1
+
+
+class FrameQueue:
+    """Queue of frames from a :class:`FramePool`, made with
+    :meth:`FramePool.new_queue`, with a single consuming process.
+
+    The frames are numpy arrays pointing to the shared memory, which stay
+    valid until they are released, so each frame which is got has to be
+    released by the consumer when it is not used anymore. The consumer
+    can also send a frame it got to other queues, without copying it.
+    Frames which are not in the pool, such as the diagnostic images of
+    the tracking, can be put in the queue as well, in which case they are
+    copied.
+
+    """
+
+    def __init__(self, pool, row, max_pending=None):
+        self.pool = pool
+        self.row = row
+        self.max_pending = max_pending
+        self.queue = PortableQueue()
+        self.layouts = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["layouts"] = dict()
+        return state
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def put_slot(self, sender_row, layout, slot, timestamp=None, index=0):
+        max_pending = self.max_pending
+        if max_pending is None:
+            max_pending = self.pool.slots_for(layout) // 2
+        if self.queue.qsize() >= max_pending:
+            raise Full
+        if timestamp is None:
+            timestamp = datetime.now()
+        # the reference is taken before the slot is sent
+        self.pool.counters[0, sender_row, slot] += 1
+        self.queue.put((timestamp, index, slot, layout))
+
+    def put(self, frame, timestamp=None, index=0):
+        """Puts a copy of a frame which is not in the pool"""
+        if self.max_pending is not None and self.queue.qsize() >= self.max_pending:
+            raise Full
+        if timestamp is None:
+            timestamp = datetime.now()
+        # the frame is pickled later by the thread of the queue
+        self.queue.put((timestamp, index, None, frame.copy()))
+
+    def get(self, block=True, timeout=None):
+        """Gets the next frame
+
+        Returns
+        -------
+        tuple
+            the timestamp, the index of the frame, its slot (None if the
+            frame has been copied) and the frame
+
+        Raises
+        ------
+        queue.Empty
+
+        """
+        timestamp, index, slot, layout = self.queue.get(block, timeout)
+        if slot is None:
+            return timestamp, index, None, layout
+        self.layouts[slot] = layout
+        return timestamp, index, slot, self.pool.frames(layout)[slot]
+
+    def get_copy(self, block=True, timeout=None):
+        """Gets a copy of the next frame, releasing its slot
+
+        Returns
+        -------
+        tuple
+            the timestamp, the index of the frame and the frame
+
+        """
+        timestamp, index, slot, frame = self.get(block, timeout)
+        frame = frame.copy()
+        self.release(slot)
+        return timestamp, index, frame
+
+    def release(self, slot):
+        """Releases a frame which has been got from the queue"""
+        if slot is not None:
+            self.pool.counters[1, self.row, slot] += 1
+
+    def forward(self, queue, timestamp, index, slot):
+        """Sends a frame which has been got from this queue to another
+        queue, the frame still has to be released from this one
+
+        Raises
+        ------
+        queue.Full
+            if too many frames are waiting in the other queue
+
+        """
+        queue.put_slot(self.row, self.layouts[slot], slot, timestamp, index)
+
+    def clear(self):
+        """Empties the queue, releasing the frames"""
+        while not self.queue.empty():
+            try:
+                self.release(self.queue.get(timeout=0.01)[2])
+            except Empty:
+                break
@@ -0,0 +1,218 @@
+import json
+import os
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread, Lock, Condition
+
+import numpy as np
+import tables
+
+# PyTables is not thread-safe, so all its calls in a process, for reading
+# and for writing, go through this lock
+tables_lock = Lock()
+
+
+class H5FrameReader:
+    """Reads frames lazily from an HDF5 video file, as saved by the
+    :class:`H5VideoWriter <stytra.hardware.video.write.H5VideoWriter>` (with
+    the frames in a video node) or by flammkuchen from a single array.
+
+    The frames are read in blocks aligned to the chunks of the file, the
+    last blocks used are kept in a small LRU cache and the block following
+    the current one is read ahead in a separate thread, so that the memory
+    used does not depend on the length of the video.
+
+    Parameters
+    ----------
+    filename
+        path of the HDF5 file
+    block_mbytes
+        approximate size of the blocks read at once
+    cache_blocks
+        number of blocks kept in memory
+    prefetch
+        whether to read the next block in a separate thread
+    """
+
+    def __init__(self, filename, block_mbytes=8, cache_blocks=4, prefetch=True):
+        with tables_lock:
+            self.file = tables.open_file(filename, mode="r")
+            if "video" in self.file.root:
+                self.frames = self.file.root.video
+            else:
+                self.frames = self.file.root.data
+        self.n_frames = self.frames.shape[0]
+        self.frame_shape = self.frames.shape[1:]
+
+        # blocks are made of whole chunks
+        chunk_frames = 1
+        if self.frames.chunkshape is not None:
+            chunk_frames = self.frames.chunkshape[0]
+        frame_bytes = self.frames.atom.itemsize
+        for dim in self.frame_shape:
+            frame_bytes *= dim
+        n_chunks = max(int(block_mbytes * 1000000 // (frame_bytes * chunk_frames)), 1)
+        self.block_frames = n_chunks * chunk_frames
+        self.n_blocks = (self.n_frames + self.block_frames - 1) // self.block_frames
+
+        # the frame from which the video restarts after the end
+        self.loop_start = 0
+
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()
+        # the cache is checked under its own lock, so that the frames of the
+        # cached blocks can be got while another block is read from the file
+        self.lock = Condition()
+        # blocks being read from the file
+        self.reading = set()
+
+        self.prefetch_queue = None
+        self.prefetch_thread = None
+        self.pending = set()
+        if prefetch:
+            self.prefetch_queue = Queue()
+            self.prefetch_thread = Thread(target=self._prefetch_loop, daemon=True)
+            self.prefetch_thread.start()
+
+    def __len__(self):
+        return self.n_frames
+
+    def _read_block(self, i_block):
+        """Returns a block, reading it from the file if it is not cached"""
+        with self.lock:
+            while True:
+                block = self.cache.get(i_block, None)
+                if block is not None:
+                    self.cache.move_to_end(i_block)
+                    return block
+                if i_block not in self.reading:
+                    break
+                # the block is being read by the other thread
+                self.lock.wait()
+            self.reading.add(i_block)
+
+        block = None
+        try:
+            with tables_lock:
+                block = self.frames[
+                    i_block * self.block_frames : (i_block + 1) * self.block_frames
+                ]
+        finally:
+            with self.lock:
+                if block is not None:
+                    self.cache[i_block] = block
+                    while len(self.cache) > self.cache_blocks:
+                        self.cache.popitem(last=False)
+                self.reading.discard(i_block)
+                self.pending.discard(i_block)
+                self.lock.notify_all()
+        return block
+
+    def _prefetch_loop(self):
+        while True:
+            i_block = self.prefetch_queue.get()
+            if i_block is None:
+                break
+            self._read_block(i_block)
+
+    def _request_prefetch(self, i_block):
+        with self.lock:
+            if (
+                i_block in self.cache
+                or i_block in self.pending
+                or i_block in self.reading
+            ):
+                return
+            self.pending.add(i_block)
+        self.prefetch_queue.put(i_block)
+
+    def __getitem__(self, i_frame):
+        """Returns a frame, as a view on the cached block which contains it"""
+        i_block = i_frame // self.block_frames
+        block = self._read_block(i_block)
+        if self.prefetch_queue is not None:
+            if i_block + 1 < self.n_blocks:
+                self._request_prefetch(i_block + 1)
+            else:
+                self._request_prefetch(self.loop_start // self.block_frames)
+        return block[i_frame - i_block * self.block_frames]
+
+    def close(self):
+        if self.prefetch_thread is not None:
+            self.prefetch_queue.put(None)
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+        with self.lock:
+            self.cache.clear()
+        with tables_lock:
+            self.file.close()
+
+
+class VideoIndex:
+    """Index of a recording split in segments, as saved by the video
+    writers (see :class:`VideoWriter
+    <stytra.hardware.video.write.VideoWriter>`), to find the segments
+    which contain given frames or times without opening their files.
+
+    Parameters
+    ----------
+    filename
+        path of the index file, ending in video_index.json
+    """
+
+    def __init__(self, filename):
+        with open(filename) as f:
+            self.segments = json.load(f)["segments"]
+        self.folder = os.path.dirname(filename)
+        self.first_frames = np.array([s["first_frame"] for s in self.segments])
+
+    def __len__(self):
+        if len(self.segments) == 0:
+            return 0
+        return self.segments[-1]["first_frame"] + self.segments[-1]["n_frames"]
+
+    def path(self, i_segment):
+        return os.path.join(self.folder, self.segments[i_segment]["filename"])
+
+    def locate(self, i_frame):
+        """Finds a frame of the recording
+
+        Parameters
+        ----------
+        i_frame : int
+            the number of the frame in the whole recording
+
+        Returns
+        -------
+        tuple
+            the path of the segment and the number of the frame in it
+
+        """
+        if not 0 <= i_frame < len(self):
+            raise IndexError("Frame {} is not in the recording".format(i_frame))
+        i_segment = np.searchsorted(self.first_frames, i_frame, side="right") - 1
+        return self.path(i_segment), i_frame - self.first_frames[i_segment]
+
+    def segments_between(self, t_start, t_end):
+        """Finds the segments with frames in a time range
+
+        Parameters
+        ----------
+        t_start : float
+            the beginning of the range, as a timestamp in seconds
+        t_end : float
+            the end of the range, as a timestamp in seconds
+
+        Returns
+        -------
+        list
+            the paths of the segments
+
+        """
+        return [
+            self.path(i_segment)
+            for i_segment, segment in enumerate(self.segments)
+            if segment["n_frames"] > 0
+            and segment["t_start"] <= t_end
+            and segment["t_end"] >= t_start
+        ]
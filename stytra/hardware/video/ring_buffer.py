@@ -1,40 +1,192 @@
+from multiprocessing import RawArray
+
 import numpy as np
+import tables
+
+from stytra.hardware.video.read import tables_lock
 
 
 class RingBuffer:
-    def __init__(self, length):
+    """Keeps the most recent frames of a
+    :class:`FramePool <stytra.hardware.video.frame_pool.FramePool>` to
+    replay or save them, holding their slots instead of copying the frames.
+    At most half of the slots of the pool are held, so that new frames can
+    always be acquired: to keep the last seconds of large frames, the pool
+    has to be big enough for twice as many frames.
+
+    The frames are put by the producer of the pool (the camera process),
+    while the list of the frames in the buffer is in shared memory, so
+    that they can be read by any other process without interrupting the
+    acquisition. The frames are numbered in the order in which they are
+    put, and a frame which is read is checked to have stayed in the
+    buffer while it was copied.
+
+    Parameters
+    ----------
+    max_length : int
+        maximum number of frames kept
+    pool : FramePool
+        the pool of the frames
+
+    """
+
+    def __init__(self, max_length, pool):
+        self.max_length = max_length
+        self.length = max_length
+        self.pool = pool
+        self.slot_array = RawArray("q", max_length)
+        self.time_array = RawArray("d", max_length)
+        # number of the first frame in the buffer and of the next one
+        self.span_array = RawArray("q", 2)
+        # dtype and shape of the frames
+        self.dtype_array = RawArray("c", 8)
+        self.shape_array = RawArray("q", 4)
+
+    def __len__(self):
+        first, end = self.span_array
+        return end - first
+
+    def _evict(self, n_kept):
+        first, end = self.span_array
+        while end - first > n_kept:
+            # the frame is removed from the buffer before it can be reused
+            self.span_array[0] = first + 1
+            self.pool.release(self.slot_array[first % self.max_length])
+            first += 1
+
+    def capacity(self):
+        """Maximum number of frames which are kept, for the producer"""
+        return min(self.length, self.max_length, self.pool.n_slots // 2)
+
+    def put(self, slot, timestamp):
+        """Adds a frame of the pool, written by the producer
+
+        Parameters
+        ----------
+        slot : int
+        timestamp : datetime
+            the time of the frame
+
+        """
+        if len(self) == 0:
+            dtype, shape = self.pool.layout
+            self.dtype_array.value = dtype.encode()
+            self.shape_array[:] = tuple(shape) + (0,) * (4 - len(shape))
+        self.pool.hold(slot)
+        end = self.span_array[1]
+        self.slot_array[end % self.max_length] = slot
+        self.time_array[end % self.max_length] = timestamp.timestamp()
+        self.span_array[1] = end + 1
+        self._evict(self.capacity())
+
+    def set_length(self, length):
         self.length = length
-        self.arr = None
-        self.insert_idx = length - 1
-        self.read_idx = 0
-        self.replay_limits = (0, self.length)
-
-    def put(self, item):
-        try:
-            if (
-                self.arr is None
-                or self.arr.shape[1:] != item.shape
-                or self.arr.dtype != item.dtype
-            ):
-                self.insert_idx = 0
-                self.arr = np.zeros((self.length,) + item.shape, item.dtype)
-
-            self.arr[self.insert_idx] = item
-            self.insert_idx = (self.insert_idx + 1) % self.length
-            self.read_idx = 0
-        except AttributeError as e:
-            print(e)
-
-    def get(self):
-        if self.arr is None:
-            raise ValueError("Trying to get an item from an empty buffer")
-        replay_range = self.replay_limits[1] - self.replay_limits[0]
-        actual_read_idx = (
-            self.replay_limits[0] + self.read_idx + self.insert_idx
-        ) % self.length
-        out = self.arr[actual_read_idx, :, :]
-        self.read_idx = (self.read_idx + 1) % replay_range
-        return out
+        self._evict(min(self.length, self.max_length))
+
+    def clear(self):
+        """Releases all the frames"""
+        self._evict(0)
 
     def get_most_recent(self):
-        return self.arr[(self.insert_idx + 1) % self.length]
+        """The slot of the most recent frame, for the producer"""
+        return self.slot_array[(self.span_array[1] - 1) % self.max_length]
+
+    def span(self):
+        """The numbers of the first frame in the buffer and of the one
+        after the last"""
+        return tuple(self.span_array)
+
+    def times(self):
+        """The numbers and timestamps (in seconds) of the frames in the
+        buffer, which can be outdated as soon as they are returned"""
+        first, end = self.span()
+        numbers = np.arange(first, end)
+        times = np.frombuffer(self.time_array, dtype=np.float64)[
+            numbers % self.max_length
+        ]
+        # the frames which have been replaced in the meantime are removed
+        valid = numbers >= self.span_array[0]
+        return numbers[valid], times[valid]
+
+    def read(self, number):
+        """Copies a frame of the buffer
+
+        Parameters
+        ----------
+        number : int
+            the number of the frame
+
+        Returns
+        -------
+        tuple
+            the timestamp of the frame, in seconds, and the frame, or None
+            if the frame is not in the buffer anymore
+
+        """
+        first, end = self.span()
+        if not first <= number < end:
+            return None
+        shape = tuple(s for s in self.shape_array if s > 0)
+        layout = (self.dtype_array.value.decode(), shape)
+        position = number % self.max_length
+        timestamp = self.time_array[position]
+        frame = self.pool.frames(layout)[self.slot_array[position]].copy()
+        if self.span_array[0] > number:
+            return None
+        return timestamp, frame
+
+    def save(self, filename, duration=None, complib="blosc:lz4", complevel=5):
+        """Saves the frames of the buffer in an HDF5 file, in the same
+        format as the :class:`H5VideoWriter
+        <stytra.hardware.video.write.H5VideoWriter>`. Can be called from a
+        background thread, the frames being copied before they are
+        replaced in the buffer.
+
+        Parameters
+        ----------
+        filename : str
+        duration : float
+            if not None, only the frames of the last duration seconds are
+            saved
+        complib : str
+            compression library, in the PyTables format
+        complevel : int
+            compression level, from 0 (no compression) to 9
+
+        Returns
+        -------
+        tuple
+            the number of frames saved and the time they span, in seconds,
+            which is shorter than the duration if the buffer does not
+            hold enough frames
+
+        """
+        numbers, times = self.times()
+        if duration is not None and len(times) > 0:
+            numbers = numbers[times >= times[-1] - duration]
+
+        frames = []
+        for number in numbers:
+            frame = self.read(number)
+            if frame is not None:
+                frames.append(frame)
+        if len(frames) == 0:
+            return 0, 0.0
+
+        with tables_lock, tables.open_file(filename, mode="w") as file:
+            shape = frames[0][1].shape
+            video_array = file.create_earray(
+                file.root,
+                "video",
+                tables.Atom.from_dtype(frames[0][1].dtype),
+                shape=(0,) + shape,
+                filters=tables.Filters(complevel=complevel, complib=complib),
+                chunkshape=(1,) + shape,
+                expectedrows=len(frames),
+            )
+            for _, frame in frames:
+                video_array.append(frame[None])
+            file.create_array(
+                file.root, "times", np.array([t for t, _ in frames], dtype=np.float64)
+            )
+        return len(frames), frames[-1][0] - frames[0][0]
@@ -1,9 +1,18 @@
+import json
+import os
 import numpy as np
-import flammkuchen as fl
+import tables
 
 from stytra.utilities import FrameProcess
+from stytra.hardware.video.read import tables_lock
+from collections import deque
+from fractions import Fraction
+from functools import partial
 from multiprocessing import Event, Queue
 from queue import Empty
+from queue import Queue as ThreadQueue
+from threading import Thread
+from time import perf_counter
 from stytra.utilities import save_df
 import pandas as pd
 
@@ -16,19 +25,66 @@ except ImportError:
 class VideoWriter(FrameProcess):
     """Writes behavior movies into video files using PyAV
 
+    Long recordings can be split in segments, each of them in a separate
+    file, which is finalized in the background when the next one starts.
+    The segments are listed in an index file (video_index.json), with the
+    number of their first frame, their number of frames and the
+    timestamps (in seconds) of their first and last frames, so that the
+    frames of any time range can be found without opening all the files
+    (see :class:`VideoIndex <stytra.hardware.video.read.VideoIndex>`).
+    The index is updated every time a segment starts and every time the
+    metadata is flushed, so it stays usable and up to date if the
+    recording is interrupted.
+
+    The metadata of the frames is appended while recording to the
+    video_frames.hdf5 file, with a column for each field: the index of
+    the frame given by the camera (frame), its timestamp in seconds (t),
+    the monotonic time (perf_counter) at which it was acquired
+    (t_acquired) and whether frames are missing from the recording
+    before it (dropped). If the log format is not hdf5, the metadata is
+    also saved in the log format at the end of the recording.
+
     Parameters
     ----------
     folder
         output folder
     input_queue
-        queue of incoming frames
+        FrameQueue of incoming frames
     finished_signal
         signal to finish recording
     kbit_rate
         ouput movie bitrate
+    segment_frames
+        if given, maximum number of frames of each segment
+    segment_minutes
+        if given, maximum duration of each segment, in minutes
+    acquisition_times
+        the shared array in which the camera records the acquisition time
+        of the frames, by default the frames are stamped when received
+    flush_every
+        number of frames after which the data is flushed to disk
     """
 
-    def __init__(self, input_queue, finished_signal, saving_evt, log_format="hdf5"):
+    metadata_dtype = np.dtype(
+        [
+            ("frame", np.int64),
+            ("t", np.float64),
+            ("t_acquired", np.float64),
+            ("dropped", np.bool_),
+        ]
+    )
+
+    def __init__(
+        self,
+        input_queue,
+        finished_signal,
+        saving_evt,
+        log_format="hdf5",
+        segment_frames=None,
+        segment_minutes=None,
+        acquisition_times=None,
+        flush_every=100,
+    ):
         super().__init__()
         self.filename_queue = Queue()
         self.filename_base = None
@@ -36,9 +92,23 @@ class VideoWriter(FrameProcess):
         self.finished_signal = finished_signal
         self.saving_evt = saving_evt
         self.reset_signal = Event()
-        self.times = []
         self.recording = False
         self.log_format = log_format
+        self.segment_frames = segment_frames
+        self.segment_minutes = segment_minutes
+        self.segments = []
+        self.finalizing = []
+        self.acquisition_times = acquisition_times
+        self.flush_every = flush_every
+        self.metadata_file = None
+        self.metadata_buffer = np.zeros(flush_every, self.metadata_dtype)
+        self.n_buffered = 0
+        self.last_frame = None
+        self.dropping = False
+
+    @property
+    def segmented(self):
+        return self.segment_frames is not None or self.segment_minutes is not None
 
     def run(self):
         while True:
@@ -46,18 +116,18 @@ class VideoWriter(FrameProcess):
             self.reset()
             while True:
                 try:
-                    t, current_frame = self.input_queue.get(timeout=0.01)
+                    t, i_frame, slot, current_frame = self.input_queue.get(timeout=0.01)
                     if self.saving_evt.is_set():
-                        if not self.recording:
-                            self.configure(current_frame.shape)
-                            self.recording = True
-                        self.ingest_frame(current_frame)
-                        self.times.append(t)
+                        self.record(t, i_frame, slot, current_frame)
                         toggle_save = True
+                    else:
+                        self.input_queue.release(slot)
 
                 except Empty:
                     pass
 
+                self.release_written()
+
                 if not self.saving_evt.is_set() and toggle_save:
                     self.complete()
                     toggle_save = False
@@ -67,50 +137,377 @@ class VideoWriter(FrameProcess):
                     self.reset()
                     break
 
-                self.framerate_rec.update_framerate()
-
             if self.finished_signal.is_set():
                 break
 
-    def configure(self, size):
+    def configure(self, shape):
         self.filename_base = self.filename_queue.get(timeout=0.01)
+        self.segments = []
+        self.open_metadata()
+        self.new_segment(shape)
+
+    def record(self, t, i_frame, slot, frame):
+        """Writes a frame got from the input queue, starting the recording
+        or a new segment if needed
+
+        Parameters
+        ----------
+        t : datetime
+            the timestamp of the frame
+        i_frame : int
+            the index of the frame
+        slot : int
+            the slot of the frame in the frame pool
+        frame : np.ndarray
+
+        """
+        if self.backlog_full(frame):
+            # the frame is dropped rather than keeping the camera waiting
+            # for free slots of the frame pool
+            if not self.dropping:
+                self.message_queue.put("W:Dropping frames from recording")
+            self.dropping = True
+            self.input_queue.release(slot)
+            return
+        self.dropping = False
+        if not self.recording:
+            try:
+                self.configure(frame.shape)
+            except Empty:
+                # the file name has not been sent yet, the frame is skipped
+                self.input_queue.release(slot)
+                return
+            self.recording = True
+        elif self.segment_ended(t):
+            self.rollover(frame.shape)
+        segment = self.segments[-1]
+        if segment["n_frames"] == 0:
+            segment["t_start"] = t.timestamp()
+        segment["t_end"] = t.timestamp()
+        segment["n_frames"] += 1
+        self.log_metadata(t, i_frame)
+        self.write(t, slot, frame)
+
+    def open_metadata(self):
+        with tables_lock:
+            self.metadata_file = tables.open_file(
+                self.filename_base + "video_frames.hdf5", mode="w"
+            )
+            for name in self.metadata_dtype.names:
+                self.metadata_file.create_earray(
+                    self.metadata_file.root,
+                    name,
+                    tables.Atom.from_dtype(self.metadata_dtype[name]),
+                    shape=(0,),
+                )
+        self.n_buffered = 0
+        self.last_frame = None
+
+    def log_metadata(self, t, i_frame):
+        if self.acquisition_times is not None:
+            t_acquired = self.acquisition_times[i_frame % len(self.acquisition_times)]
+        else:
+            t_acquired = perf_counter()
+        dropped = self.last_frame is not None and i_frame != self.last_frame + 1
+        self.last_frame = i_frame
+        self.metadata_buffer[self.n_buffered] = (
+            i_frame,
+            t.timestamp(),
+            t_acquired,
+            dropped,
+        )
+        self.n_buffered += 1
+        if self.n_buffered == self.flush_every:
+            self.flush_metadata()
+
+    def flush_metadata(self):
+        # the rows are buffered, to append them to the columns in blocks
+        with tables_lock:
+            for name in self.metadata_dtype.names:
+                self.metadata_file.get_node("/" + name).append(
+                    self.metadata_buffer[name][: self.n_buffered]
+                )
+            self.metadata_file.flush()
+        self.n_buffered = 0
+        # the index follows the frames written to the current segment
+        if self.segmented and len(self.segments) > 0:
+            self.save_index()
+
+    def close_metadata(self):
+        if self.metadata_file is None:
+            return
+        self.flush_metadata()
+        with tables_lock:
+            self.metadata_file.close()
+        self.metadata_file = None
+
+    def segment_ended(self, t):
+        """Whether a frame with the timestamp t belongs to a new segment"""
+        segment = self.segments[-1]
+        if self.segment_frames is not None:
+            if segment["n_frames"] >= self.segment_frames:
+                return True
+        if self.segment_minutes is not None and segment["t_start"] is not None:
+            if t.timestamp() - segment["t_start"] >= self.segment_minutes * 60:
+                return True
+        return False
+
+    def segment_filename(self, extension):
+        """The path of the file of the current segment"""
+        if not self.segmented:
+            return self.filename_base + "video." + extension
+        return "{}video_{:04d}.{}".format(
+            self.filename_base, len(self.segments) - 1, extension
+        )
+
+    def new_segment(self, shape):
+        first_frame = 0
+        if len(self.segments) > 0:
+            previous = self.segments[-1]
+            first_frame = previous["first_frame"] + previous["n_frames"]
+        self.segments.append(
+            dict(
+                filename=None,
+                first_frame=first_frame,
+                n_frames=0,
+                t_start=None,
+                t_end=None,
+            )
+        )
+        filename = self.open_segment(shape)
+        if filename is not None:
+            self.segments[-1]["filename"] = os.path.basename(filename)
+        if self.segmented:
+            self.save_index()
+
+    def rollover(self, shape):
+        """Starts a new segment, the previous one being finalized in a
+        background thread"""
+        finalize = self.close_segment()
+        if finalize is not None:
+            thread = Thread(target=finalize)
+            thread.start()
+            self.finalizing.append(thread)
+        self.new_segment(shape)
+
+    def finish_recording(self):
+        """Finalizes all the segments"""
+        finalize = self.close_segment()
+        if finalize is not None:
+            finalize()
+        for thread in self.finalizing:
+            thread.join()
+        self.finalizing = []
+        if self.segmented and len(self.segments) > 0:
+            self.save_index()
+        self.segments = []
+        self.close_metadata()
+
+    def save_index(self):
+        filename = self.filename_base + "video_index.json"
+        # the index is replaced at once, so that it is never incomplete
+        with open(filename + ".tmp", "w") as f:
+            json.dump(dict(segments=self.segments), f)
+        os.replace(filename + ".tmp", filename)
+
+    def open_segment(self, shape):
+        """Opens the file of a new segment
+
+        Parameters
+        ----------
+        shape : tuple
+            the shape of the frames
+
+        Returns
+        -------
+        str
+            the path of the file
+
+        """
+        pass
+
+    def close_segment(self):
+        """Stops writing to the current segment
+
+        Returns
+        -------
+        callable
+            a function which finishes writing the file, or None if there
+            is nothing left to do
+
+        """
+        return None
+
+    def write(self, t, slot, frame):
+        """Writes a frame got from the input queue, releasing it afterwards
+
+        Parameters
+        ----------
+        t : datetime
+            the timestamp of the frame
+        slot : int
+            the slot of the frame in the frame pool
+        frame : np.ndarray
+
+        """
+        self.ingest_frame(frame)
+        self.ingest_time(t)
+        self.input_queue.release(slot)
+        self.update_framerate()
+
+    def backlog_full(self, frame):
+        """Whether too many frames are waiting to be written, so that the
+        frame has to be dropped"""
+        return False
+
+    def release_written(self):
+        """Releases the frames which have been written in the background"""
+        pass
 
     def ingest_frame(self, frame):
         pass
 
+    def ingest_time(self, t):
+        pass
+
     def complete(self):
-        save_df(
-            pd.DataFrame(self.times, columns="t"),
-            self.filename_base + "video_times",
-            self.log_format,
-        )
+        self.finish_recording()
+        if self.log_format != "hdf5":
+            with tables_lock, tables.open_file(
+                self.filename_base + "video_frames.hdf5"
+            ) as file:
+                metadata = pd.DataFrame(
+                    {
+                        name: file.get_node("/" + name).read()
+                        for name in self.metadata_dtype.names
+                    }
+                )
+            save_df(metadata, self.filename_base + "video_frames", self.log_format)
         self.recording = False
 
     def reset(self):
+        self.finish_recording()
         self.recording = False
-        self.times = []
 
 
 class H5VideoWriter(VideoWriter):
-    def __init__(self, *args, **kwargs):
+    """Writes behavior movies into HDF5 files, appending each frame as it
+    arrives to a chunked and compressed dataset, so that the memory used
+    does not depend on the length of the recording. The file contains the
+    video dataset (frames x height x width) and the times dataset, with
+    the timestamp of each frame in seconds.
+
+    Parameters
+    ----------
+    complib
+        compression library, in the PyTables format
+    complevel
+        compression level, from 0 (no compression) to 9
+    expected_frames
+        the expected length of the recording, used to optimize the file
+    """
+
+    def __init__(
+        self, *args, complib="blosc:lz4", complevel=5, expected_frames=100000, **kwargs
+    ):
         super().__init__(*args, **kwargs)
-        self.frames = []
+        self.filters = tables.Filters(complevel=complevel, complib=complib)
+        self.expected_frames = expected_frames
+        self.file = None
+        self.video_array = None
+        self.times_array = None
 
-    def reset(self):
-        super().reset()
-        self.frames = []
+    def open_segment(self, shape):
+        filename = self.segment_filename("hdf5")
+        with tables_lock:
+            self.create_file(filename, shape)
+        return filename
+
+    def create_file(self, filename, shape):
+        self.file = tables.open_file(filename, mode="w")
+        # each frame is a chunk, so frames can be appended and read one by one
+        self.video_array = self.file.create_earray(
+            self.file.root,
+            "video",
+            tables.UInt8Atom(),
+            shape=(0,) + tuple(shape),
+            filters=self.filters,
+            chunkshape=(1,) + tuple(shape),
+            expectedrows=self.expected_frames,
+        )
+        self.times_array = self.file.create_earray(
+            self.file.root,
+            "times",
+            tables.Float64Atom(),
+            shape=(0,),
+            expectedrows=self.expected_frames,
+        )
 
     def ingest_frame(self, frame):
-        self.frames.append(frame)
+        with tables_lock:
+            self.video_array.append(frame[None, :, :].astype(np.uint8, copy=False))
 
-    def complete(self):
-        super().complete()
-        fl.save(
-            self.filename_base + "video.hdf5", np.array(self.frames, dtype=np.uint8)
-        )
+    def ingest_time(self, t):
+        with tables_lock:
+            self.times_array.append([t.timestamp()])
+            if self.times_array.nrows % self.flush_every == 0:
+                self.file.flush()
+
+    @staticmethod
+    def close_file(file):
+        # only the closing is done in the background, still under the lock
+        # shared by all the PyTables calls
+        with tables_lock:
+            file.close()
+
+    def close_segment(self):
+        if self.file is None:
+            return None
+        file = self.file
+        self.file = None
+        self.video_array = None
+        self.times_array = None
+        return partial(self.close_file, file)
 
 
 class StreamingVideoWriter(VideoWriter):
+    """Writes behavior movies into video files using PyAV. The frames are
+    encoded in a separate thread, to which they are passed through a
+    bounded queue without being copied, so that the encoding does not
+    delay the reception of the next frames. As the frames waiting to be
+    encoded keep their slots of the frame pool, at most a quarter of the
+    slots are used for them: when the encoding falls further behind, the
+    frames are dropped from the recording, so that the camera can always
+    acquire new ones.
+
+    Each frame is presented at the time of its timestamp, counted from
+    the first frame of the file, so the timing of the video is preserved
+    if the framerate varies or frames are dropped. When the recording is
+    split in segments, the encoding thread of a segment finishes it in the
+    background while the next one starts. The encoding throughput is sent
+    through the framerate queue.
+
+    Parameters
+    ----------
+    extension
+        extension of the video file, which determines the container
+    output_framerate
+        nominal framerate of the video
+    format
+        the codec, e.g. mpeg4, libx264 or ffv1
+    kbit_rate
+        ouput movie bitrate, for lossy encoding
+    lossless
+        if True, the frames are encoded without loss, which is the case
+        for FFV1 and for libx264 at a constant rate factor of 0
+    max_backlog
+        maximum number of frames waiting to be encoded, if the frame pool
+        has enough slots
+    """
+
+    # resolution of the presentation times, in seconds
+    time_base = Fraction(1, 10000)
+
     def __init__(
         self,
         *args,
@@ -118,6 +515,8 @@ class StreamingVideoWriter(VideoWriter):
         output_framerate=24,
         format="mpeg4",
         kbit_rate=1000,
+        lossless=False,
+        max_backlog=100,
         **kwargs
     ):
         super().__init__(*args, **kwargs)
@@ -125,36 +524,130 @@ class StreamingVideoWriter(VideoWriter):
         self.output_framerate = output_framerate
         self.format = format
         self.kbit_rate = kbit_rate
-        self.container = None
-        self.stream = None
+        self.lossless = lossless
+        self.max_backlog = max_backlog
+        self.encode_queue = None
+        self.encode_thread = None
+        self.encoded_slots = deque()
+        self.n_pending = 0
+        self.max_pending = None
+        self.n_encoded = 0
+        self.max_waiting = 0
 
     def configure(self, shape):
+        self.n_encoded = 0
+        self.max_waiting = 0
         super().configure(shape)
-        filename = self.filename_base + "video." + self.extension
-        self.container = av.open(filename, mode="w")
-        self.stream = self.container.add_stream(self.format, rate=self.output_framerate)
-        self.stream.height, self.stream.width = shape
-        self.stream.codec_context.thread_type = "AUTO"
-        self.stream.codec_context.bit_rate = self.kbit_rate * 1000
-        self.stream.codec_context.bit_rate_tolerance = self.kbit_rate * 200
-        self.stream.pix_fmt = "yuv420p"
 
-    def ingest_frame(self, frame):
-        if self.stream is None:
-            self.configure(frame.shape)
-        av_frame = av.VideoFrame.from_ndarray(frame, format="gray8")
-        for packet in self.stream.encode(av_frame):
-            self.container.mux(packet)
+    def open_segment(self, shape):
+        filename = self.segment_filename(self.extension)
+        container = av.open(filename, mode="w")
+        stream = container.add_stream(self.format, rate=self.output_framerate)
+        stream.height, stream.width = shape
+        codec_context = stream.codec_context
+        codec_context.thread_type = "AUTO"
+        codec_context.time_base = self.time_base
+        if self.lossless:
+            if self.format in ("libx264", "h264"):
+                codec_context.options = dict(crf="0")
+            elif self.format != "ffv1":
+                raise ValueError(
+                    "Lossless encoding is possible with ffv1 or libx264, "
+                    "not {}".format(self.format)
+                )
+        else:
+            codec_context.bit_rate = self.kbit_rate * 1000
+            codec_context.bit_rate_tolerance = self.kbit_rate * 200
+        # the frames are encoded in grayscale if the codec supports it
+        if "gray" in [f.name for f in codec_context.codec.video_formats]:
+            stream.pix_fmt = "gray"
+        else:
+            stream.pix_fmt = "yuv420p"
 
-    def reset(self):
-        super().reset()
-        self.container = None
-        self.stream = None
+        self.encode_queue = ThreadQueue(maxsize=self.max_backlog)
+        self.encode_thread = Thread(
+            target=self.encode_loop,
+            args=(container, stream, self.encode_queue),
+            daemon=True,
+        )
+        self.encode_thread.start()
+        return filename
 
-    def complete(self):
-        super().complete()
-        for packet in self.stream.encode():
-            self.container.mux(packet)
+    def write(self, t, slot, frame):
+        # the frame stays in the frame pool until it has been encoded
+        if self.n_pending > self.max_waiting:
+            self.max_waiting = self.n_pending
+        if self.n_pending >= max(self.max_pending // 2, 1):
+            self.message_queue.put("W:Video encoding lagging behind")
+        self.n_pending += 1
+        # does not block, as the frames waiting are fewer than max_backlog
+        self.encode_queue.put((t, slot, frame))
+
+    def backlog_full(self, frame):
+        self.release_written()
+        if self.max_pending is None:
+            n_slots = self.input_queue.pool.slots_for((frame.dtype.str, frame.shape))
+            self.max_pending = max(min(self.max_backlog, n_slots // 4), 1)
+        return self.n_pending >= self.max_pending
+
+    def release_written(self):
+        while True:
+            try:
+                self.input_queue.release(self.encoded_slots.popleft())
+            except IndexError:
+                break
+            self.n_pending -= 1
+
+    def encode_loop(self, container, stream, encode_queue):
+        """Encodes the frames of a segment, until None is received"""
+        t_first = None
+        last_pts = -1
+        while True:
+            item = encode_queue.get()
+            if item is None:
+                break
+            t, slot, frame = item
+            try:
+                av_frame = av.VideoFrame.from_ndarray(frame, format="gray8")
+                if t_first is None:
+                    t_first = t
+                pts = int(round((t - t_first).total_seconds() / self.time_base))
+                # the presentation times have to increase
+                last_pts = max(pts, last_pts + 1)
+                av_frame.pts = last_pts
+                av_frame.time_base = self.time_base
+                for packet in stream.encode(av_frame):
+                    container.mux(packet)
+            except Exception as e:
+                self.message_queue.put("E:Video encoding failed: {}".format(e))
+            self.encoded_slots.append(slot)
+            self.n_encoded += 1
+            self.update_framerate()
+
+        for packet in stream.encode():
+            container.mux(packet)
+        container.close()
+
+    def close_segment(self):
+        if self.encode_thread is None:
+            return None
+        # the encoding thread encodes the remaining frames and closes the file
+        self.encode_queue.put(None)
+        thread = self.encode_thread
+        self.encode_thread = None
+        self.encode_queue = None
+        return thread.join
 
-        # Close the file
-        self.container.close()
+    def finish_recording(self):
+        super().finish_recording()
+        self.release_written()
+        if self.n_encoded > 0:
+            self.message_queue.put(
+                "I:Video encoded, {} frames, at most {} waiting".format(
+                    self.n_encoded, self.max_waiting
+                )
+            )
+        self.n_encoded = 0
+        self.max_waiting = 0
+        # the backlog is set again for the frames of the next recording
+        self.max_pending = None
@@ -0,0 +1,395 @@
+""" Headless tracking of videos with the parameters saved during an offline
+Stytra session, for example::
+
+    python -m stytra.offline.batch recordings/ fish_trackingparams.json -j 16
+
+Each video is split in chunks of frames which are tracked in parallel in a
+pool of processes, and every chunk is saved as soon as it is tracked, so an
+interrupted run resumes from the chunks which are not saved yet.
+"""
+
+import argparse
+import json
+import os
+import shutil
+from multiprocessing import Pool, cpu_count
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from stytra.experiments.fish_pipelines import pipeline_dict
+from stytra.hardware.video.read import H5FrameReader
+from stytra.utilities import save_df
+
+video_extensions = (".h5", ".hdf5", ".avi", ".mov", ".mp4", ".mkv")
+
+
+def _is_h5(video):
+    return str(video).endswith("h5") or str(video).endswith("hdf5")
+
+
+def count_frames(video):
+    """Returns the number of frames of a video, demuxing the whole file
+    if the number is not in the container metadata
+    """
+    if _is_h5(video):
+        frames = H5FrameReader(str(video), prefetch=False)
+        n_frames = len(frames)
+        frames.close()
+        return n_frames
+
+    import av
+
+    with av.open(str(video)) as container:
+        stream = container.streams.video[0]
+        if stream.frames > 0:
+            return stream.frames
+        return sum(1 for packet in container.demux(stream) if packet.size > 0)
+
+
+def read_frames(video, start, stop):
+    """Yields the frames of a video from start to stop, as grayscale images.
+    The videos which are not HDF5 files are seeked to the closest keyframe,
+    and the frame numbers are found from the timestamps, assuming a constant
+    framerate.
+    """
+    if _is_h5(video):
+        frames = H5FrameReader(str(video))
+        try:
+            for i_frame in range(start, min(stop, len(frames))):
+                frame = frames[i_frame]
+                yield frame if frame.ndim == 2 else frame[:, :, 0]
+        finally:
+            frames.close()
+        return
+
+    import av
+
+    with av.open(str(video)) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        frame_duration = 1 / (stream.average_rate * stream.time_base)
+        first_pts = stream.start_time or 0
+        if start > 0:
+            container.seek(
+                int(first_pts + start * frame_duration), stream=stream, backward=True
+            )
+        i_frame = None
+        for framedata in container.decode(stream):
+            if framedata.pts is None:
+                i_frame = i_frame + 1 if i_frame is not None else start
+            else:
+                i_frame = int(round((framedata.pts - first_pts) / frame_duration))
+            if i_frame < start:
+                continue
+            if i_frame >= stop:
+                break
+            yield framedata.to_ndarray(format="rgb24")[:, :, 0]
+
+
+def load_tracking_params(path):
+    """Reads the pipeline type and parameters saved with the
+    "Save tracking params" button of the offline tracking toolbar
+    """
+    with open(str(path), "r") as f:
+        saved = json.load(f)
+    params = dict(saved["pipeline_params"])
+    # the diagnostic images are not needed and the pipeline is never reset
+    params.pop("diagnostics", None)
+    params.pop("reset", None)
+    return saved["pipeline_type"], params
+
+
+def make_chunks(n_frames, chunk_frames, warmup):
+    """Splits the frames in chunks
+
+    Parameters
+    ----------
+    n_frames
+        number of frames of the video
+    chunk_frames
+        number of frames in each chunk
+    warmup
+        number of frames before each chunk which are tracked and discarded,
+        so that the state of the pipeline is settled at the start of the
+        chunk
+
+    Returns
+    -------
+    list of (first tracked frame, first saved frame, end of the chunk)
+
+    """
+    return [
+        (max(start - warmup, 0), start, min(start + chunk_frames, n_frames))
+        for start in range(0, n_frames, chunk_frames)
+    ]
+
+
+def track_chunk(video, pipeline_type, params, chunk, fps, part_path):
+    """Tracks one chunk of a video and saves it, first to a temporary file
+    so that only complete chunks are found when resuming
+    """
+    warm_start, start, stop = chunk
+    pipeline = pipeline_dict[pipeline_type]()
+    pipeline.setup()
+    pipeline.deserialize_params(params)
+
+    data = []
+    for i_frame, frame in enumerate(read_frames(video, warm_start, stop), warm_start):
+        output = pipeline.run(frame, i_frame / fps if fps else None).data
+        if i_frame >= start:
+            data.append(output)
+
+    df = pd.DataFrame.from_records(data, columns=data[0]._fields if data else None)
+    df.index = np.arange(start, start + len(df))
+    tmp_path = part_path.with_name(part_path.stem + "_tmp")
+    save_df(df, tmp_path, "hdf5")
+    os.replace(str(tmp_path) + ".hdf5", str(part_path))
+    return part_path
+
+
+def _track_chunk_args(args):
+    return track_chunk(*args)
+
+
+class BatchVideo:
+    """The chunks of a video to be tracked and the saved results
+
+    Parameters
+    ----------
+    video
+        path of the video
+    output_path
+        path of the output, without the extension
+    pipeline_type
+        key of the pipeline in the pipeline dictionary
+    params
+        parameters of the pipeline
+    chunk_frames
+        number of frames tracked in a process at once
+    warmup
+        number of frames tracked before each chunk, if the pipeline is
+        stateful
+    fps
+        framerate of the video, if given the nodes which use the time of
+        the frames get it from the frame number
+    """
+
+    def __init__(
+        self, video, output_path, pipeline_type, params, chunk_frames, warmup, fps
+    ):
+        self.video = Path(video)
+        self.output_path = Path(output_path)
+        self.pipeline_type = pipeline_type
+        self.params = params
+        self.fps = fps
+        self.parts_dir = Path(str(self.output_path) + "_chunks")
+
+        pipeline = pipeline_dict[pipeline_type]()
+        if not pipeline.stateful:
+            warmup = 0
+
+        self.n_frames = count_frames(self.video)
+        self.chunks = make_chunks(self.n_frames, chunk_frames, warmup)
+
+        # the chunks saved in a previous run can be reused only if they
+        # were tracked in the same way
+        manifest = dict(
+            n_frames=self.n_frames,
+            chunk_frames=chunk_frames,
+            warmup=warmup,
+            fps=fps,
+            pipeline_type=pipeline_type,
+            pipeline_params=params,
+        )
+        manifest_path = self.parts_dir / "chunks.json"
+        if self.parts_dir.is_dir():
+            try:
+                with open(str(manifest_path), "r") as f:
+                    previous = json.load(f)
+            except (OSError, ValueError):
+                previous = None
+            if previous != json.loads(json.dumps(manifest)):
+                shutil.rmtree(str(self.parts_dir))
+        if not self.parts_dir.is_dir():
+            self.parts_dir.mkdir(parents=True)
+            with open(str(manifest_path), "w") as f:
+                json.dump(manifest, f)
+
+    def part_path(self, i_chunk):
+        return self.parts_dir / "chunk_{:05d}.hdf5".format(i_chunk)
+
+    def pending_tasks(self):
+        """Returns the arguments of track_chunk for the chunks which are
+        not saved yet
+        """
+        return [
+            (
+                self.video,
+                self.pipeline_type,
+                self.params,
+                chunk,
+                self.fps,
+                self.part_path(i_chunk),
+            )
+            for i_chunk, chunk in enumerate(self.chunks)
+            if not self.part_path(i_chunk).is_file()
+        ]
+
+    def merge(self, fileformat):
+        """Concatenates the chunks in the output file and removes them"""
+        df = pd.concat(
+            [
+                pd.read_hdf(str(self.part_path(i_chunk)), "/data")
+                for i_chunk in range(len(self.chunks))
+            ]
+        )
+        save_df(df, self.output_path, fileformat)
+        shutil.rmtree(str(self.parts_dir))
+
+
+def find_videos(path):
+    path = Path(path)
+    if path.is_dir():
+        return sorted(
+            p
+            for p in path.iterdir()
+            if p.is_file() and p.suffix.lower() in video_extensions
+        )
+    return [path]
+
+
+def track_videos(
+    videos,
+    params_file,
+    output_dir=None,
+    fileformat="hdf5",
+    n_processes=None,
+    chunk_frames=5000,
+    warmup=200,
+    fps=None,
+    overwrite=False,
+):
+    """Tracks videos with the parameters saved during an offline Stytra
+    session, the chunks of all the videos are tracked in the same pool of
+    processes
+
+    Parameters
+    ----------
+    videos
+        list of paths of videos
+    params_file
+        path of the _trackingparams.json file
+    output_dir
+        if not given, the results are saved next to each video
+    fileformat
+        format of the output files (csv, feather, hdf5 or json)
+    n_processes
+        number of processes tracking in parallel, all the cores by default
+    chunk_frames
+        number of frames in each chunk
+    warmup
+        number of frames before each chunk which are tracked to settle the
+        state of stateful pipelines
+    fps
+        framerate of the videos, for the nodes which use the time of the
+        frames
+    overwrite
+        whether to track the videos for which there is an output already
+
+    """
+    pipeline_type, params = load_tracking_params(params_file)
+
+    batch = []
+    for video in videos:
+        video = Path(video)
+        out_dir = Path(output_dir) if output_dir is not None else video.parent
+        output_path = out_dir / video.stem
+        if Path(str(output_path) + "." + fileformat).is_file() and not overwrite:
+            print("Skipping {}, already tracked".format(video.name))
+            continue
+        batch.append(
+            BatchVideo(
+                video, output_path, pipeline_type, params, chunk_frames, warmup, fps
+            )
+        )
+
+    tasks = []
+    remaining = dict()
+    for batch_video in batch:
+        pending = batch_video.pending_tasks()
+        if len(pending) == 0:
+            # resumed after all the chunks were tracked
+            batch_video.merge(fileformat)
+        else:
+            tasks.extend(pending)
+            remaining[batch_video.parts_dir] = len(pending)
+    if len(tasks) == 0:
+        return
+
+    by_parts_dir = {batch_video.parts_dir: batch_video for batch_video in batch}
+    with Pool(n_processes or cpu_count()) as pool:
+        for i_done, part_path in enumerate(
+            pool.imap_unordered(_track_chunk_args, tasks)
+        ):
+            print("Tracked chunk {} of {}".format(i_done + 1, len(tasks)))
+            remaining[part_path.parent] -= 1
+            if remaining[part_path.parent] == 0:
+                batch_video = by_parts_dir[part_path.parent]
+                batch_video.merge(fileformat)
+                print("Saved {}.{}".format(batch_video.output_path, fileformat))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Tracks videos without the Stytra GUI, with parameters "
+        "saved during an offline tracking session"
+    )
+    parser.add_argument("videos", help="video file or folder of videos")
+    parser.add_argument("params", help="the _trackingparams.json file")
+    parser.add_argument(
+        "-o", "--output-dir", help="folder of the results, the video folder by default"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        default="hdf5",
+        choices=["csv", "feather", "hdf5", "json"],
+        help="format of the results",
+    )
+    parser.add_argument(
+        "-j", "--processes", type=int, help="number of processes, all cores by default"
+    )
+    parser.add_argument(
+        "--chunk", type=int, default=5000, help="number of frames in each chunk"
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=200,
+        help="frames tracked before each chunk for stateful pipelines",
+    )
+    parser.add_argument(
+        "--fps", type=float, help="framerate, for the nodes using the frame time"
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="track videos already tracked"
+    )
+    args = parser.parse_args(argv)
+
+    track_videos(
+        find_videos(args.videos),
+        args.params,
+        output_dir=args.output_dir,
+        fileformat=args.format,
+        n_processes=args.processes,
+        chunk_frames=args.chunk,
+        warmup=args.warmup,
+        fps=args.fps,
+        overwrite=args.overwrite,
+    )
+
+
+if __name__ == "__main__":
+    main()
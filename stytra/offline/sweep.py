@@ -0,0 +1,316 @@
+"""Tracking of a video with several sets of parameters at once, for
+tuning them offline, for example::
+
+    python -m stytra.offline.sweep video.mp4 video_trackingparams.json sweep.json
+
+The sweep file gives, for some parameters of the saved ones, either a list
+of values to try for each, combined in a grid::
+
+    {"/source/filtering": {"clip": [120, 140, 160]},
+     "/source/filtering/tail_tracking": {"n_segments": [10, 12]}}
+
+or a list of parameter sets::
+
+    [{"/source/filtering": {"clip": 120}},
+     {"/source/filtering": {"clip": 160, "filter_size": 3}}]
+
+Each frame is decoded once, into blocks of shared memory read by one
+process per parameter set. The results of each set are saved in a table
+named after the video with the number of the set, along with its full
+parameters, and a summary of the tracking failures of each set.
+"""
+
+import argparse
+import itertools
+import json
+from collections import Counter
+from multiprocessing import Process, Queue, RawArray
+from pathlib import Path
+from queue import Empty
+
+import numpy as np
+import pandas as pd
+
+from stytra.experiments.fish_pipelines import pipeline_dict
+from stytra.offline.batch import load_tracking_params, read_frames
+from stytra.utilities import save_df
+
+
+def sweep_param_sets(sweep):
+    """Returns the list of parameter changes described by a sweep, either
+    a list of them or a dictionary of lists of values for each parameter of
+    each node, which are combined in a grid
+    """
+    if isinstance(sweep, list):
+        return sweep
+    keys = [(node, param) for node, values in sweep.items() for param in values]
+    param_sets = []
+    for combination in itertools.product(*(sweep[node][param] for node, param in keys)):
+        param_set = dict()
+        for (node, param), value in zip(keys, combination):
+            param_set.setdefault(node, dict())[param] = value
+        param_sets.append(param_set)
+    return param_sets
+
+
+def merge_params(params, changes):
+    """Returns the pipeline parameters with some of them changed"""
+    merged = {node: dict(values) for node, values in params.items()}
+    for node, values in changes.items():
+        merged.setdefault(node, dict()).update(values)
+    return merged
+
+
+class _SweepWorker(Process):
+    """Tracks the frames put in the shared blocks with one set of
+    parameters, acknowledging each block once it is processed
+    """
+
+    def __init__(
+        self,
+        i_set,
+        pipeline_type,
+        params,
+        blocks,
+        block_shape,
+        dtype,
+        block_queue,
+        done_queue,
+        output_path,
+        fileformat,
+        fps,
+    ):
+        super().__init__()
+        self.i_set = i_set
+        self.pipeline_type = pipeline_type
+        self.params = params
+        self.blocks = blocks
+        self.block_shape = block_shape
+        self.dtype = dtype
+        self.block_queue = block_queue
+        self.done_queue = done_queue
+        self.output_path = output_path
+        self.fileformat = fileformat
+        self.fps = fps
+
+    def run(self):
+        pipeline = pipeline_dict[self.pipeline_type]()
+        pipeline.setup()
+        pipeline.deserialize_params(self.params)
+        blocks = np.frombuffer(self.blocks, dtype=self.dtype).reshape(self.block_shape)
+
+        data = []
+        messages = Counter()
+        error_frames = 0
+        warning_frames = 0
+        while True:
+            item = self.block_queue.get()
+            if item is None:
+                break
+            i_block, i_first, n_frames = item
+            for i_frame in range(n_frames):
+                frame_messages, output = pipeline.run(
+                    blocks[i_block, i_frame],
+                    (i_first + i_frame) / self.fps if self.fps else None,
+                )
+                data.append(output)
+                if frame_messages:
+                    messages.update(frame_messages)
+                    error_frames += any(m.startswith("E:") for m in frame_messages)
+                    warning_frames += any(m.startswith("W:") for m in frame_messages)
+            self.done_queue.put((self.i_set, i_block))
+
+        df = pd.DataFrame.from_records(data, columns=data[0]._fields if data else None)
+        save_df(df, self.output_path, self.fileformat)
+        self.done_queue.put(
+            (
+                self.i_set,
+                dict(
+                    n_frames=len(data),
+                    error_frames=error_frames,
+                    warning_frames=warning_frames,
+                    messages=dict(messages.most_common()),
+                ),
+            )
+        )
+
+
+def sweep_video(
+    video,
+    params_file,
+    sweep,
+    output_path=None,
+    fileformat="hdf5",
+    block_frames=64,
+    n_blocks=4,
+    fps=None,
+):
+    """Tracks a video with several sets of parameters in parallel, decoding
+    each frame only once
+
+    Parameters
+    ----------
+    video
+        path of the video
+    params_file
+        path of the _trackingparams.json file with the parameters which are
+        not changed
+    sweep
+        parameter changes, see :func:`sweep_param_sets`
+    output_path
+        path of the outputs, without the extension, by default next to the
+        video and with the same name
+    fileformat
+        format of the output tables (csv, feather, hdf5 or json)
+    block_frames
+        number of frames decoded before they are sent to the workers
+    n_blocks
+        number of blocks in shared memory, the decoding waits for the
+        slowest worker when all are in use
+    fps
+        framerate of the video, for the nodes which use the time of the
+        frames
+
+    Returns
+    -------
+    the summary of the tracking failures for each parameter set
+
+    """
+    video = Path(video)
+    if output_path is None:
+        output_path = video.parent / video.stem
+    output_path = Path(output_path)
+    pipeline_type, params = load_tracking_params(params_file)
+    param_sets = sweep_param_sets(sweep)
+
+    frames = read_frames(video, 0, np.iinfo(np.int64).max)
+    first_frame = next(frames)
+    block_shape = (n_blocks, block_frames) + first_frame.shape
+    blocks_buffer = RawArray("B", int(np.prod(block_shape)) * first_frame.itemsize)
+    blocks = np.frombuffer(blocks_buffer, dtype=first_frame.dtype).reshape(block_shape)
+
+    done_queue = Queue()
+    block_queues = []
+    workers = []
+    for i_set, changes in enumerate(param_sets):
+        set_path = Path("{}_sweep{:03d}".format(output_path, i_set))
+        set_params = merge_params(params, changes)
+        with open(str(set_path) + "_trackingparams.json", "w") as f:
+            json.dump(dict(pipeline_type=pipeline_type, pipeline_params=set_params), f)
+        block_queues.append(Queue())
+        workers.append(
+            _SweepWorker(
+                i_set,
+                pipeline_type,
+                set_params,
+                blocks_buffer,
+                block_shape,
+                first_frame.dtype,
+                block_queues[-1],
+                done_queue,
+                set_path,
+                fileformat,
+                fps,
+            )
+        )
+    for worker in workers:
+        worker.start()
+
+    # number of workers which still have to process each block
+    pending = [0] * n_blocks
+    summaries = [None] * len(param_sets)
+
+    def wait_for_worker():
+        while True:
+            try:
+                i_set, result = done_queue.get(timeout=1.0)
+                break
+            except Empty:
+                for worker in workers:
+                    if not worker.is_alive() and summaries[worker.i_set] is None:
+                        for other in workers:
+                            other.terminate()
+                        raise RuntimeError(
+                            "Tracking with parameter set {} failed".format(worker.i_set)
+                        )
+        if isinstance(result, dict):
+            summaries[i_set] = result
+        else:
+            pending[result] -= 1
+
+    i_block = 0
+    i_first = 0
+    for block in _frame_blocks(itertools.chain([first_frame], frames), block_frames):
+        while pending[i_block] > 0:
+            wait_for_worker()
+        blocks[i_block, : len(block)] = block
+        pending[i_block] = len(workers)
+        for block_queue in block_queues:
+            block_queue.put((i_block, i_first, len(block)))
+        i_first += len(block)
+        i_block = (i_block + 1) % n_blocks
+
+    for block_queue in block_queues:
+        block_queue.put(None)
+    while any(summary is None for summary in summaries):
+        wait_for_worker()
+    for worker in workers:
+        worker.join()
+
+    summary = pd.DataFrame(summaries)
+    summary.insert(0, "params", [json.dumps(changes) for changes in param_sets])
+    summary["messages"] = [json.dumps(s["messages"]) for s in summaries]
+    save_df(summary, str(output_path) + "_sweep_summary", fileformat)
+    return summary
+
+
+def _frame_blocks(frames, block_frames):
+    block = []
+    for frame in frames:
+        block.append(frame)
+        if len(block) == block_frames:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Tracks a video with several sets of parameters, decoding "
+        "it only once"
+    )
+    parser.add_argument("video", help="video file")
+    parser.add_argument("params", help="the _trackingparams.json file")
+    parser.add_argument("sweep", help="json file with the parameters to change")
+    parser.add_argument(
+        "-o", "--output", help="path of the results, without the extension"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        default="hdf5",
+        choices=["csv", "feather", "hdf5", "json"],
+        help="format of the results",
+    )
+    parser.add_argument(
+        "--fps", type=float, help="framerate, for the nodes using the frame time"
+    )
+    args = parser.parse_args(argv)
+
+    with open(args.sweep, "r") as f:
+        sweep = json.load(f)
+    summary = sweep_video(
+        args.video,
+        args.params,
+        sweep,
+        output_path=args.output,
+        fileformat=args.format,
+        fps=args.fps,
+    )
+    with pd.option_context("display.max_colwidth", 80):
+        print(summary.drop(columns="messages"))
+
+
+if __name__ == "__main__":
+    main()
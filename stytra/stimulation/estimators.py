@@ -17,25 +17,157 @@ class Estimator:
         self.exp = experiment
         self.log = experiment.estimator_log
         self.acc_tracking = acc_tracking
+        self.latency_log = getattr(experiment, "latency_log", None)
 
     def reset(self):
         self.log.reset()
 
+    def _frame_consumed(self):
+        """Marks the latest tracking output as used, for the measurement
+        of the closed-loop latency
+        """
+        if self.latency_log is not None:
+            self.latency_log.frame_consumed()
+
 
 class VigorMotionEstimator(Estimator):
     """
     A very common way of estimating velocity of an embedded animal is
     vigor, computed as the standard deviation of the tail cumulative angle in a
     specified time window - generally 50 ms.
+
+    The tail angles are consumed as they arrive in the tracking accumulator:
+    the mean and variance over the window are updated with a sliding-window
+    Welford algorithm, and the vigor after each sample is stored in a delay
+    line, so that the vigor at any lag is found with a lookup.
+
+    Parameters
+    ----------
+    vigor_window : float
+        duration of the window in seconds
+    base_gain : float
+        factor which converts the vigor to a velocity
+    history_length : int
+        initial number of samples kept in the delay line, it is increased if
+        longer lags are requested
     """
 
-    def __init__(self, *args, vigor_window=0.050, base_gain=-12, **kwargs):
+    def __init__(
+        self, *args, vigor_window=0.050, base_gain=-12, history_length=1024, **kwargs
+    ):
         super().__init__(*args, **kwargs)
         self.vigor_window = vigor_window
         self.last_dt = 1 / 500.0
         self.base_gain = base_gain
         self._output_type = namedtuple("s", "vigor")
 
+        # delay lines for the timestamps, the tail sum and the vigor
+        self._t_line = np.zeros(history_length)
+        self._tail_line = np.zeros(history_length)
+        self._vigor_line = np.zeros(history_length)
+        self._reset_window()
+        # the resets of the accumulator seen, to start over after one
+        self._n_resets = self.acc_tracking.n_resets
+
+    def _reset_window(self):
+        self._n_samples = 0  # number of samples in the delay lines
+        self._n_consumed = 0  # number of samples read from the accumulator
+        self._n_window = max(int(round(self.vigor_window / self.last_dt)), 2)
+        self._n_valid = 0  # number of non-NaN samples in the window
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def reset(self):
+        super().reset()
+        self._reset_window()
+
+    def _grow_lines(self, min_length):
+        """ Increases the length of the delay lines, keeping the samples
+        at the same positions modulo the new length
+        """
+        old_length = len(self._t_line)
+        new_length = old_length
+        while new_length < min_length:
+            new_length *= 2
+        i_kept = np.arange(max(self._n_samples - old_length, 0), self._n_samples)
+        for name in ["_t_line", "_tail_line", "_vigor_line"]:
+            old_line = getattr(self, name)
+            new_line = np.zeros(new_length)
+            new_line[i_kept % new_length] = old_line[i_kept % old_length]
+            setattr(self, name, new_line)
+
+    def _add(self, x):
+        if x == x:
+            self._n_valid += 1
+            delta = x - self._mean
+            self._mean += delta / self._n_valid
+            self._m2 += delta * (x - self._mean)
+
+    def _remove(self, x):
+        if x == x:
+            self._n_valid -= 1
+            if self._n_valid == 0:
+                self._mean = 0.0
+                self._m2 = 0.0
+            else:
+                delta = x - self._mean
+                self._mean -= delta / self._n_valid
+                self._m2 -= delta * (x - self._mean)
+
+    def _set_window(self, n_window):
+        """ Recomputes the window statistics for a new window length,
+        which happens only if the estimated sampling rate changes
+        """
+        if n_window + 1 > len(self._t_line):
+            self._grow_lines(n_window + 1)
+        self._n_window = n_window
+        self._n_valid = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        n_line = len(self._tail_line)
+        for i in range(max(self._n_samples - n_window, 0), self._n_samples):
+            self._add(self._tail_line[i % n_line])
+
+    def _push(self, t, x):
+        n_line = len(self._t_line)
+        i = self._n_samples
+        if i >= self._n_window:
+            self._remove(self._tail_line[(i - self._n_window) % n_line])
+        self._add(x)
+        self._t_line[i % n_line] = t
+        self._tail_line[i % n_line] = x
+        if self._n_valid > 0:
+            self._vigor_line[i % n_line] = np.sqrt(max(self._m2, 0.0) / self._n_valid)
+        else:
+            self._vigor_line[i % n_line] = 0.0
+        self._n_samples = i + 1
+
+        # update the sampling interval estimate, as the average over the window
+        if i + 1 >= self._n_window:
+            start_t = self._t_line[(i + 1 - self._n_window) % n_line]
+            new_dt = (t - start_t) / (self._n_window - 1)
+            if new_dt > 0:
+                self.last_dt = new_dt
+                n_window = max(int(round(self.vigor_window / self.last_dt)), 2)
+                if n_window != self._n_window:
+                    self._set_window(n_window)
+
+    def _consume_new_samples(self):
+        if self.acc_tracking.n_resets != self._n_resets:
+            # the accumulator has been reset, possibly with as many new
+            # samples as were consumed before
+            self._reset_window()
+            self._n_resets = self.acc_tracking.n_resets
+        n_received = self.acc_tracking.n_received
+        n_new = n_received - self._n_consumed
+        if n_new > 0:
+            new_rows = self.acc_tracking.get_last_n(n_new)
+            i_tail = self.acc_tracking.header_dict["tail_sum"]
+            for t, x in zip(new_rows[:, 0], new_rows[:, i_tail]):
+                self._push(float(t), float(x))
+            self._frame_consumed()
+        self._n_consumed = n_received
+
     def get_velocity(self, lag=0):
         """
 
@@ -48,23 +180,22 @@ class VigorMotionEstimator(Estimator):
         -------
 
         """
-        vigor_n_samples = max(int(round(self.vigor_window / self.last_dt)), 2)
-        n_samples_lag = max(int(round(lag / self.last_dt)), 0)
-        if not self.acc_tracking.stored_data:
+        self._consume_new_samples()
+        if self._n_samples == 0:
             return 0
-        past_tail_motion = self.acc_tracking.get_last_n(
-            vigor_n_samples + n_samples_lag
-        )[0:vigor_n_samples]
-        end_t = past_tail_motion.t.iloc[-1]
-        start_t = past_tail_motion.t.iloc[0]
-        new_dt = (end_t - start_t) / vigor_n_samples
-        if new_dt > 0:
-            self.last_dt = new_dt
-        vigor = np.nanstd(np.array(past_tail_motion.tail_sum))
-        if np.isnan(vigor):
-            vigor = 0
-
-        if len(self.log.times) == 0 or self.log.times[-1] < end_t:
+
+        n_samples_lag = max(int(round(lag / self.last_dt)), 0)
+        if n_samples_lag + self._n_window + 1 > len(self._t_line):
+            # earlier samples are not available for this call,
+            # but will be kept from now on
+            self._grow_lines(n_samples_lag + self._n_window + 1)
+        n_line = len(self._t_line)
+        n_back = min(n_samples_lag, self._n_samples - 1, n_line - 1)
+        i_sample = (self._n_samples - 1 - n_back) % n_line
+
+        vigor = self._vigor_line[i_sample]
+        end_t = self._t_line[i_sample]
+        if self.log.is_empty() or self.log.times[-1] < end_t:
             self.log.update_list(end_t, self._output_type(vigor))
         return vigor * self.base_gain
 
@@ -108,16 +239,20 @@ class PositionEstimator(Estimator):
         return past_coords["f0_x"], past_coords["f0_y"], past_coords["f0_theta"]
 
     def get_velocity(self):
+        hd = self.acc_tracking.header_dict
         vel = np.diff(
-            self.acc_tracking.get_last_n(self.velocity_window)[["f0_x", "f0_y"]].values,
+            self.acc_tracking.get_last_n(self.velocity_window)[
+                :, [hd["f0_x"], hd["f0_y"]]
+            ],
             0,
         )
         return np.sqrt(np.sum(vel ** 2))
 
     def get_istantaneous_velocity(self):
+        hd = self.acc_tracking.header_dict
         vel_xy = self.acc_tracking.get_last_n(self.velocity_window)[
-            ["f0_vx", "f0_vy"]
-        ].values
+            :, [hd["f0_vx"], hd["f0_vy"]]
+        ]
         return np.sqrt(np.sum(vel_xy ** 2))
 
     def reset(self):
@@ -125,32 +260,30 @@ class PositionEstimator(Estimator):
         self.past_values = None
 
     def get_position(self):
-        if len(self.acc_tracking.stored_data) == 0 or not np.isfinite(
-            self.acc_tracking.stored_data[-1].f0_x
-        ):
-            o = self._output_type(np.nan, np.nan, np.nan)
-            return o
+        if self.acc_tracking.is_empty():
+            return self._output_type(np.nan, np.nan, np.nan)
+
+        hd = self.acc_tracking.header_dict
+        last_row = self.acc_tracking.get_last_n(1)[0, :]
+        if not np.isfinite(last_row[hd["f0_x"]]):
+            return self._output_type(np.nan, np.nan, np.nan)
 
-        past_coords = self.acc_tracking.stored_data[-1]
-        t = self.acc_tracking.times[-1]
+        f0_x, f0_y, f0_theta = (last_row[hd[c]] for c in ["f0_x", "f0_y", "f0_theta"])
+        t = last_row[0]
+        self._frame_consumed()
 
         if not self.calibrator.cam_to_proj is None:
             projmat = np.array(self.calibrator.cam_to_proj)
             if projmat.shape != (2, 3):
                 projmat = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
 
-            x, y = projmat @ np.array([past_coords.f0_x, past_coords.f0_y, 1.0])
+            x, y = projmat @ np.array([f0_x, f0_y, 1.0])
 
             theta = np.arctan2(
-                *(
-                    projmat[:, :2]
-                    @ np.array(
-                        [np.cos(past_coords.f0_theta), np.sin(past_coords.f0_theta)]
-                    )[::-1]
-                )
+                *(projmat[:, :2] @ np.array([np.cos(f0_theta), np.sin(f0_theta)])[::-1])
             )
         else:
-            x, y, theta = past_coords.f0_x, past_coords.f0_y, past_coords.f0_theta
+            x, y, theta = f0_x, f0_y, f0_theta
 
         c_values = np.array((y, x, theta))
 
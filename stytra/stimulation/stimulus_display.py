@@ -189,6 +189,10 @@ class StimDisplayWidget:
         self.movie = []
         self.movie_timestamps = []
 
+        # if set, notified when the painting is finished, to measure the
+        # closed-loop latency
+        self.latency_log = None
+
     def paintEvent(self, QPaintEvent):
         """Generate the stimulus that will be displayed. A QPainter object is
         defined, which is then passed to the current stimulus paint function
@@ -226,6 +230,9 @@ class StimDisplayWidget:
 
         p.end()
 
+        if self.latency_log is not None:
+            self.latency_log.frame_painted()
+
     def display_stimulus(self):
         """Function called by the protocol_runner timestep timer that update
         the displayed image and, if required, grab a picture of the current
@@ -0,0 +1,137 @@
+import datetime
+import numpy as np
+from collections import namedtuple
+from time import perf_counter
+from types import SimpleNamespace
+
+from PyQt5.QtWidgets import QApplication
+
+from stytra.collectors.accumulators import (
+    EstimatorLog,
+    FramerateAccumulator,
+    LatencyLog,
+    QueueDataAccumulator,
+)
+from stytra.collectors.namedtuplequeue import NamedTupleArrayQueue
+from stytra.gui.multiscope import FrameratePlot
+
+
+def _dummy_experiment(running=True):
+    return SimpleNamespace(
+        t0=datetime.datetime.now(), protocol_runner=SimpleNamespace(running=running)
+    )
+
+
+def test_growing_accumulator():
+    acc = EstimatorLog(experiment=_dummy_experiment(), initial_length=4)
+    tt = namedtuple("s", "a b")
+    for i in range(10):
+        acc.update_list(i * 0.1, tt(i, -i))
+
+    assert len(acc) == 10
+    assert acc.columns == ("t", "a", "b")
+    last = acc.get_last_n(3)
+    np.testing.assert_allclose(last[:, acc.header_dict["a"]], [7, 8, 9])
+    np.testing.assert_allclose(acc["b"], -np.arange(10))
+
+    # the returned arrays are views on the buffer, not copies
+    assert np.shares_memory(last, acc.get_last_n())
+
+    df = acc.get_dataframe()
+    assert list(df.columns) == ["a", "b", "t"]
+    np.testing.assert_allclose(df.t.values, np.arange(10) * 0.1)
+
+
+def test_ring_accumulator():
+    acc = EstimatorLog(experiment=_dummy_experiment(), max_length=5)
+    tt = namedtuple("s", "a")
+    for i in range(23):
+        acc.update_list(float(i), tt(i))
+
+    assert len(acc) == 5
+    assert acc._data.shape[0] == 10
+    np.testing.assert_allclose(acc.t, np.arange(18, 23))
+    np.testing.assert_allclose(acc.get_last_n(2)[:, 1], [21, 22])
+
+
+def test_trim_when_not_running():
+    acc = EstimatorLog(
+        experiment=_dummy_experiment(running=False), max_history_if_not_running=10
+    )
+    tt = namedtuple("s", "a")
+    for i in range(100):
+        acc.update_list(float(i), tt(i))
+    assert len(acc) <= 15
+    assert acc.get_last_n(1)[0, 1] == 99
+
+
+def test_latency_log():
+    exp = _dummy_experiment()
+    latency_log = LatencyLog(experiment=exp)
+    queue = NamedTupleArrayQueue(max_mbytes=0.01, latency=True)
+    acc = QueueDataAccumulator(
+        experiment=exp, data_queue=queue, latency_log=latency_log
+    )
+    tt = namedtuple("t", "tail_sum")
+
+    # the frame is tracked before it is received
+    t_acquired = perf_counter() - 0.002
+    for i in range(3):
+        queue.put(
+            exp.t0.timestamp() + i,
+            tt(i),
+            latency_times=(t_acquired, t_acquired + 0.001),
+        )
+    acc.update_list()
+    # the latency times are not accumulated with the data
+    assert acc.columns == ("t", "tail_sum")
+    np.testing.assert_allclose(acc.get_last_n()[:, 1], np.arange(3))
+
+    latency_log.frame_consumed()
+    latency_log.frame_painted()
+    # painting again without a new frame is not logged
+    latency_log.frame_painted()
+    assert len(latency_log) == 1
+    delays = latency_log.get_last_n(1)[0, 1:]
+    assert abs(delays[0] - 0.001) < 1e-9
+    assert np.all(np.diff(delays) >= 0)
+
+    # frames painted without being used by the estimator
+    queue.put(exp.t0.timestamp() + 3, tt(3), latency_times=(t_acquired, t_acquired))
+    acc.update_list()
+    latency_log.frame_painted()
+    assert np.isnan(latency_log.get_last_n(1)[0, 3])
+
+    summaries = latency_log.get_last_summaries()
+    assert summaries["tracked"]["n"] == 2
+    assert summaries["consumed"]["n"] == 1
+
+
+def test_framerate_accumulator(capsys):
+    exp = _dummy_experiment()
+    acc = FramerateAccumulator(experiment=exp, name="camera")
+    assert len(acc) == 0
+    assert acc.get_last_t(5).shape == (0, 2)
+
+    for fps in [None, 50.0, 20.0]:
+        acc.update_list(fps)
+    assert len(acc) == 3
+    last = acc.get_last_n()
+    assert np.isnan(last[0, acc.header_dict["framerate"]])
+    np.testing.assert_allclose(last[1:, 1], [50, 20])
+    assert acc.get_last_n(1)[0, 1] == 20
+    assert acc.get_last_t(5).shape == (3, 2)
+
+    acc.times[:2] = [acc.times[2] - 10, acc.times[2] - 6]
+    assert acc.get_last_t(5).shape == (1, 2)
+
+    # the framerate plot displays the accumulator and warns below the limit
+    app = QApplication.instance() or QApplication([])
+    plot = FrameratePlot(experiment=exp, framerate_limits={"camera": 30})
+    plot.add_stream(acc)
+    plot.update()
+    assert "BAD  camera" in capsys.readouterr().out
+
+    acc.update_list(60.0)
+    plot.update()
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,49 @@
+import datetime
+import numpy as np
+from collections import namedtuple
+from types import SimpleNamespace
+
+from stytra.collectors.accumulators import EstimatorLog
+from stytra.stimulation.estimators import VigorMotionEstimator
+
+
+def test_vigor_estimator():
+    exp = SimpleNamespace(
+        t0=datetime.datetime.now(), protocol_runner=SimpleNamespace(running=True)
+    )
+    exp.estimator_log = EstimatorLog(experiment=exp)
+    acc_tracking = EstimatorLog(experiment=exp)
+    estimator = VigorMotionEstimator(
+        acc_tracking, experiment=exp, vigor_window=0.05, history_length=16
+    )
+    assert estimator.get_velocity() == 0
+
+    tt = namedtuple("t", "tail_sum")
+    np.random.seed(0)
+    tail_sum = np.cumsum(np.random.randn(2000))
+    tail_sum[100:110] = np.nan
+    dt = 1 / 200
+    n_window = 10
+    n_lag = 40
+    i_sample = 0
+    for n_new in [1, 3, 50, 7, 500, 1000, 439]:
+        for i in range(i_sample, i_sample + n_new):
+            acc_tracking.update_list(i * dt, tt(tail_sum[i]))
+        i_sample += n_new
+
+        for lag in [0, n_lag]:
+            vel = estimator.get_velocity(lag * dt)
+            i_end = i_sample - lag
+            # the sampling rate is estimated over the first samples
+            if i_end <= 25:
+                continue
+            window = tail_sum[i_end - n_window : i_end]
+            expected = np.nanstd(window) if np.any(np.isfinite(window)) else 0
+            np.testing.assert_allclose(vel, expected * estimator.base_gain)
+
+    # after a reset of the accumulator, the new samples are not mixed with
+    # the old ones, even if as many have been received
+    acc_tracking.reset()
+    for i in range(i_sample):
+        acc_tracking.update_list(i * dt, tt(0.0))
+    assert estimator.get_velocity() == 0
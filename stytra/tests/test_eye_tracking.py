@@ -0,0 +1,47 @@
+import numpy as np
+import cv2
+
+from stytra.tracking.eyes import EyeTrackingMethod
+
+
+def _eyes_image(centers, axes, angles):
+    im = np.full((60, 80), 200, dtype=np.uint8)
+    for center, ax, angle in zip(centers, axes, angles):
+        cv2.ellipse(im, center, ax, angle, 0, 360, 20, -1)
+    return im
+
+
+def test_eye_moments():
+    centers = [(30, 20), (30, 42)]
+    angles = [30, 150]
+    im = _eyes_image(centers, [(8, 4), (9, 5)], angles)
+    # a small dark spot which is not an eye
+    im[5:7, 5:7] = 0
+
+    method = EyeTrackingMethod()
+    method.setup()
+    for weighted in [False, True]:
+        params = dict(
+            method._params.params.values,
+            wnd_pos=(10, 5),
+            wnd_dim=(40, 50),
+            threshold=128,
+            weighted=weighted,
+        )
+        output = method._process(im, **params)
+        assert output.messages == [""]
+        e = output.data
+        for i_eye, (center, angle) in enumerate(zip(centers, angles)):
+            # the position is given in the window, as (row, column)
+            assert abs(getattr(e, "pos_x_e{}".format(i_eye)) + 5 - center[1]) < 0.5
+            assert abs(getattr(e, "pos_y_e{}".format(i_eye)) + 10 - center[0]) < 0.5
+            assert getattr(e, "dim_x_e{}".format(i_eye)) > getattr(
+                e, "dim_y_e{}".format(i_eye)
+            )
+            th = -getattr(e, "th_e{}".format(i_eye)) - 90
+            assert abs((th - angle + 90) % 180 - 90) < 2
+
+    params["threshold"] = 10
+    output = method._process(im, **params)
+    assert output.messages == ["E: eyes not detected!"]
+    assert np.isnan(output.data.th_e0)
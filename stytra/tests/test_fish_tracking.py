@@ -0,0 +1,52 @@
+import numpy as np
+
+from stytra.tracking.fish import FishTrackingMethod, Fishes
+
+
+def test_search_windows():
+    method = FishTrackingMethod()
+    method.setup()
+    method.reset()
+    method.fishes = Fishes(3, 1.0, np.pi / 10, 9, 0.1, 2)
+    method.fishes.coords[:3, 0] = [20.0, 30.0, 100.0]
+    method.fishes.coords[:3, 2] = [20.0, 25.0, 100.0]
+
+    # the windows of the first two fish overlap and are merged
+    windows = method._search_windows((120, 150), 10, 1)
+    assert sorted(windows) == [[10, 36, 10, 41], [90, 111, 90, 111]]
+
+    # with downsampling, the windows are in the downsampled coordinates
+    # and cut at the image border
+    windows = method._search_windows((60, 55), 10, 2)
+    assert sorted(windows) == [[5, 18, 5, 21], [45, 56, 45, 55]]
+
+
+def test_association():
+    method = FishTrackingMethod()
+    method.setup()
+    method.reset()
+    method.fishes = Fishes(3, 1.0, np.pi / 10, 9, 0.1, 2)
+    for x in [0.0, 10.0]:
+        method.fishes.add_fish(np.array([x, 0.0, 0.0, 0.0]))
+    method.fishes.predict()
+
+    # the first detection is closer to the second fish, the second one
+    # can only be the first fish and the third one is a new fish
+    messages = []
+    detections = np.array(
+        [[8.0, 0.0, 0.0, 0.0], [-2.0, 0.0, 0.0, 0.0], [50.0, 0.0, 0.0, 0.0]]
+    )
+    method._associate(detections, 15.0, np.pi / 2, messages)
+    assert method.fishes.coords[0, 0] < 0 < 8 < method.fishes.coords[1, 0] < 10
+    assert method.fishes.coords[2, 0] == 50.0
+    assert messages == ["I:Updated previous fish"] * 2 + ["I:Added new fish"]
+
+
+def test_old_prediction_uncertainty():
+    method = FishTrackingMethod()
+    method.setup()
+    # the saved value gives the same noise on the velocity with frames of
+    # 0.02 s
+    vals = method.upgrade_params(dict(n_fish_max=2, prediction_uncertainty=0.1))
+    assert vals.keys() == {"n_fish_max", "acceleration_variance"}
+    assert np.isclose(vals["acceleration_variance"], 250.0)
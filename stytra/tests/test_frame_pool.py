@@ -0,0 +1,184 @@
+from datetime import datetime, timedelta
+from multiprocessing import Process
+from queue import Full
+import time
+
+import flammkuchen as fl
+import numpy as np
+import pytest
+
+from stytra.hardware.video.frame_pool import FramePool
+from stytra.hardware.video.ring_buffer import RingBuffer
+
+
+def test_slots_reused_when_released():
+    pool = FramePool(max_mbytes=0.0004)  # 5 slots of 4x5 int32
+    queue = pool.new_queue(max_pending=10)
+    frames = [np.full((4, 5), i, dtype=np.int32) for i in range(6)]
+    slots = []
+    for i, frame in enumerate(frames[:5]):
+        slots.append(pool.put(frame))
+        pool.send(queue, slots[-1], index=i)
+    assert slots == list(range(5))
+    with pytest.raises(Full):
+        pool.put(frames[5])
+
+    t, index, slot, frame = queue.get()
+    assert (index, slot) == (0, 0)
+    np.testing.assert_array_equal(frame, frames[0])
+    queue.release(slot)
+    assert pool.put(frames[5]) == 0
+    # the frames which were not released are untouched
+    for i in range(1, 5):
+        np.testing.assert_array_equal(queue.get()[3], frames[i])
+
+
+def test_forward_keeps_frame():
+    pool = FramePool(max_mbytes=0.0004)
+    queue_in = pool.new_queue()
+    queue_out = pool.new_queue()
+    frame = np.arange(20, dtype=np.int32).reshape(4, 5)
+    pool.send(queue_in, pool.put(frame), index=7)
+    t, index, slot, _ = queue_in.get()
+    queue_in.forward(queue_out, t, index, slot)
+    queue_in.release(slot)
+    assert pool.references()[slot] == 1
+
+    t_out, index, slot_out, frame_out = queue_out.get()
+    assert (t_out, index, slot_out) == (t, 7, slot)
+    np.testing.assert_array_equal(frame_out, frame)
+    queue_out.release(slot_out)
+    assert np.all(pool.references() == 0)
+
+
+def test_copied_frames():
+    pool = FramePool(max_mbytes=0.0004)
+    queue = pool.new_queue(max_pending=1)
+    frame = np.ones((2, 2))
+    queue.put(frame)
+    frame[:] = 0
+    with pytest.raises(Full):
+        queue.put(frame)
+    _, _, slot, frame_out = queue.get()
+    assert slot is None
+    assert np.all(frame_out == 1)
+
+
+def test_layout_changed_when_released():
+    pool = FramePool(max_mbytes=0.0004, layout_timeout=0.01)
+    queue = pool.new_queue(max_pending=10)
+    pool.send(queue, pool.put(np.full((4, 5), 1, dtype=np.int32)))
+    _, _, slot, frame = queue.get()
+    # the frame of the old shape is not overwritten while it is used
+    with pytest.raises(Full):
+        pool.put(np.zeros((2, 3), dtype=np.int32))
+    assert np.all(frame == 1)
+    queue.release(slot)
+    pool.put(np.zeros((2, 3), dtype=np.int32))
+    assert pool.layout == (np.dtype(np.int32).str, (2, 3))
+
+
+def test_ring_buffer_holds_frames():
+    pool = FramePool(max_mbytes=0.0004)
+    ring = RingBuffer(10, pool)
+    t0 = datetime(2020, 1, 1)
+    for i in range(4):
+        slot = pool.put(np.full((4, 5), i, dtype=np.int32))
+        ring.put(slot, t0 + timedelta(seconds=i))
+    # only half of the pool is kept
+    assert ring.capacity() == 2
+    assert len(ring) == 2
+    numbers, times = ring.times()
+    np.testing.assert_array_equal(numbers, [2, 3])
+    assert ring.read(1) is None
+    t, frame = ring.read(3)
+    assert t == (t0 + timedelta(seconds=3)).timestamp()
+    assert np.all(frame == 3)
+    ring.clear()
+    assert np.all(pool.references() == 0)
+
+
+def test_ring_buffer_save(tmp_path):
+    pool = FramePool(max_mbytes=1)
+    ring = RingBuffer(100, pool)
+    t0 = datetime(2020, 1, 1)
+    for i in range(50):
+        slot = pool.put(np.full((10, 20), i, dtype=np.uint8))
+        ring.put(slot, t0 + timedelta(seconds=i * 0.1))
+
+    n_frames, span = ring.save(str(tmp_path / "replay.hdf5"), duration=1.0)
+    assert n_frames == 11
+    assert span == pytest.approx(1.0)
+    data = fl.load(str(tmp_path / "replay.hdf5"))
+    assert data["video"].shape == (11, 10, 20)
+    np.testing.assert_array_equal(data["video"][:, 0, 0], np.arange(39, 50))
+    np.testing.assert_allclose(np.diff(data["times"]), 0.1, rtol=1e-4)
+
+
+def _consume(queue, n_frames):
+    for _ in range(n_frames):
+        _, index, slot, frame = queue.get(timeout=5)
+        assert np.all(frame == index)
+        queue.release(slot)
+
+
+def test_frames_across_processes():
+    pool = FramePool(max_mbytes=1)
+    queue = pool.new_queue(max_pending=1000)
+    consumer = Process(target=_consume, args=(queue, 200))
+    consumer.start()
+    i_frame = 0
+    while i_frame < 200:
+        try:
+            slot = pool.put(np.full((100, 100), i_frame, dtype=np.uint8))
+        except Full:
+            continue
+        pool.send(queue, slot, index=i_frame)
+        i_frame += 1
+    consumer.join(timeout=10)
+    assert consumer.exitcode == 0
+    assert np.all(pool.references() == 0)
+
+
+def _forward(queue, other_queue, n_frames):
+    for _ in range(n_frames):
+        t, index, slot, frame = queue.get(timeout=5)
+        queue.forward(other_queue, t, index, slot)
+        queue.release(slot)
+
+
+def _hold(queue, n_frames):
+    for _ in range(n_frames):
+        _, index, slot, frame = queue.get(timeout=5)
+        # the frame is not overwritten while it is held
+        for _ in range(20):
+            assert np.all(frame == index % 256)
+        queue.release(slot)
+
+
+def test_forwarded_frames_not_overwritten():
+    pool = FramePool(max_mbytes=0.08)  # 8 slots of 100x100 uint8
+    queue = pool.new_queue(max_pending=1000)
+    other_queue = pool.new_queue(max_pending=1000)
+    n_frames = 500
+    consumers = [
+        Process(target=_forward, args=(queue, other_queue, n_frames)),
+        Process(target=_hold, args=(other_queue, n_frames)),
+    ]
+    for consumer in consumers:
+        consumer.start()
+    i_frame = 0
+    t_end = time.perf_counter() + 20
+    # if a consumer fails, its frames are never released
+    while i_frame < n_frames and time.perf_counter() < t_end:
+        try:
+            slot = pool.put(np.full((100, 100), i_frame % 256, dtype=np.uint8))
+        except Full:
+            continue
+        pool.send(queue, slot, index=i_frame)
+        i_frame += 1
+    assert i_frame == n_frames
+    for consumer in consumers:
+        consumer.join(timeout=20)
+        assert consumer.exitcode == 0
+    assert np.all(pool.references() == 0)
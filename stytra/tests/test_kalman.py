@@ -12,21 +12,46 @@ def test_fish():
     fshs = Fishes(1, 1.0, 1.0, 2, 1.0, 1)
     fshs.add_fish(np.array([0.0, 0.0, np.pi + 0.1, 0.0, 0.0]))
     fshs.predict()
-    fshs.update(np.array([1.0, 1.0, np.pi + 2 * np.pi, 0.0, 0.0]))
+    fshs.update_assigned(
+        np.array([[1.0, 1.0, np.pi + 2 * np.pi, 0.0, 0.0]]),
+        np.array([0]),
+        np.array([0]),
+    )
     assert np.allclose(
         fshs.coords,
         np.array(
             [
                 [
-                    0.66666667,
-                    0.33333466,
-                    0.66666667,
-                    0.33333466,
-                    3.17492599,
-                    -0.03333376,
+                    0.69230769,
+                    0.46153846,
+                    0.69230769,
+                    0.46153846,
+                    3.17236188,
+                    -0.04615385,
                     0.0,
                     0.0,
                 ]
             ]
         ),
     )
+
+
+def test_fish_elapsed_time():
+    """ Test that the prediction over several frames at once moves the fish
+    as much as the predictions for each frame
+    """
+    fshs = [Fishes(2, 1.0, 1.0, 2, 1.0, 5) for _ in range(2)]
+    for f in fshs:
+        f.add_fish(np.array([0.0, 0.0, 0.0, 0.0, 0.0]))
+        f.add_fish(np.array([10.0, 5.0, 1.0, 0.0, 0.0]))
+        f.predict()
+        f.update_assigned(
+            np.array([[1.0, 2.0, 0.1, 0.0, 0.0], [11.0, 4.0, 0.9, 0.0, 0.0]]),
+            np.array([0, 1]),
+            np.array([0, 1]),
+        )
+    fshs[0].predict(3.0)
+    for _ in range(3):
+        fshs[1].predict()
+    assert np.allclose(fshs[0].coords, fshs[1].coords)
+    assert np.all(fshs[0].i_not_updated == 1)
@@ -1,7 +1,12 @@
-from stytra.collectors.namedtuplequeue import NamedTupleQueue
+from stytra.collectors.namedtuplequeue import (
+    NamedTupleQueue,
+    NamedTupleArrayQueue,
+    ReorderingQueue,
+)
 from multiprocessing import Process
 from collections import namedtuple
 from time import sleep
+import numpy as np
 
 
 class TupProc(Process):
@@ -31,3 +36,71 @@ def test_ntqueue():
     tp.join()
     _, tup2 = tp.q.get()
     assert tup2 == t(2, 2, 3)
+
+
+class ArrayTupProc(Process):
+    def __init__(self, q, n_put):
+        super().__init__()
+        self.q = q
+        self.n_put = n_put
+
+    def run(self):
+        t1 = namedtuple("t", "a b c")
+        t2 = namedtuple("t", "a b")
+        for i in range(self.n_put):
+            self.q.put(float(i), t1(i, -i, 0))
+        self.q.put(float(self.n_put), t2(1, 2))
+
+
+def test_namedtuple_array_queue():
+    q = NamedTupleArrayQueue(max_mbytes=0.01)
+    tp = ArrayTupProc(q, 100)
+    tp.start()
+    tp.join()
+
+    (type1, rows1), (type2, rows2) = q.get_all()
+    assert type1._fields == ("a", "b", "c")
+    assert type2._fields == ("a", "b")
+    assert np.all(rows1[:, 0] == np.arange(100))
+    assert np.all(rows1[:, 2] == -np.arange(100))
+    assert np.all(rows2 == np.array([[100.0, 1, 2]]))
+    assert q.empty()
+
+
+def test_reordering_queue():
+    t = namedtuple("t", "a")
+    workers = [NamedTupleArrayQueue(max_mbytes=0.01, indexed=True) for _ in range(2)]
+    q = ReorderingQueue(workers, max_wait=10)
+
+    # the second worker is faster: its frames are held back
+    for i in [1, 3]:
+        workers[1].put(float(i), t(i), i)
+    workers[0].put(0.0, t(0), 0)
+    ((tuple_type, rows),) = q.get_all()
+    assert np.all(rows == np.array([[0.0, 0], [1.0, 1]]))
+
+    workers[0].put(2.0, t(2), 2)
+    ((tuple_type, rows),) = q.get_all()
+    assert tuple_type._fields == ("a",)
+    assert np.all(rows[:, 1] == [2, 3])
+    assert q.empty()
+
+
+def test_reordering_queue_late_rows():
+    t = namedtuple("t", "a")
+    workers = [NamedTupleArrayQueue(max_mbytes=0.01, indexed=True) for _ in range(2)]
+    q = ReorderingQueue(workers, max_wait=0.01)
+
+    # the frame 1 is given up on, and dropped when it arrives
+    for i in [0, 2]:
+        workers[0].put(float(i), t(i), i)
+    ((_, rows),) = q.get_all()
+    assert np.all(rows[:, 1] == [0])
+    sleep(0.05)
+    ((_, rows),) = q.get_all()
+    assert np.all(rows[:, 1] == [2])
+    workers[1].put(1.0, t(1), 1)
+    workers[0].put(3.0, t(3), 3)
+    ((_, rows),) = q.get_all()
+    assert np.all(rows[:, 1] == [3])
+    assert q.n_late == 1
@@ -0,0 +1,79 @@
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from stytra.experiments.fish_pipelines import pipeline_dict
+from stytra.hardware.video.read import H5FrameReader
+from stytra.offline.batch import make_chunks, track_videos
+from stytra.offline.sweep import sweep_param_sets, sweep_video
+
+
+def test_make_chunks():
+    assert make_chunks(250, 100, 30) == [(0, 0, 100), (70, 100, 200), (170, 200, 250)]
+
+
+def _video_and_params(tmp_path):
+    video = tmp_path / "fish.h5"
+    shutil.copy(
+        str(
+            Path(__file__).parent.parent / "examples" / "assets" / "fish_compressed.h5"
+        ),
+        str(video),
+    )
+    pipeline = pipeline_dict["eyes"]()
+    pipeline.setup()
+    params_file = tmp_path / "fish_trackingparams.json"
+    with open(str(params_file), "w") as f:
+        json.dump(
+            dict(pipeline_type="eyes", pipeline_params=pipeline.serialize_params()), f
+        )
+
+    return video, params_file, pipeline
+
+
+def test_batch_tracking(tmp_path):
+    video, params_file, pipeline = _video_and_params(tmp_path)
+
+    frames = H5FrameReader(str(video))
+    expected = np.array([pipeline.run(frames[i]).data for i in range(len(frames))])
+    frames.close()
+
+    track_videos([video], params_file, n_processes=2, chunk_frames=60)
+    df = pd.read_hdf(str(tmp_path / "fish.hdf5"), "/data")
+    assert not (tmp_path / "fish_chunks").exists()
+    np.testing.assert_allclose(df.values, expected)
+    assert list(df.index) == list(range(len(expected)))
+
+
+def test_sweep_param_sets():
+    assert sweep_param_sets({"/a": {"x": [1, 2]}, "/b": {"y": [3, 4]}}) == [
+        {"/a": {"x": 1}, "/b": {"y": 3}},
+        {"/a": {"x": 1}, "/b": {"y": 4}},
+        {"/a": {"x": 2}, "/b": {"y": 3}},
+        {"/a": {"x": 2}, "/b": {"y": 4}},
+    ]
+
+
+def test_sweep(tmp_path):
+    video, params_file, pipeline = _video_and_params(tmp_path)
+    frames = H5FrameReader(str(video))
+    expected = np.array([pipeline.run(frames[i]).data for i in range(len(frames))])
+    frames.close()
+
+    node = "/source/eyes_tracking"
+    threshold = pipeline.serialize_params()[node]["threshold"]
+    summary = sweep_video(
+        video,
+        params_file,
+        {node: {"threshold": [threshold, 1]}},
+        block_frames=50,
+        n_blocks=2,
+    )
+    df = pd.read_hdf(str(tmp_path / "fish_sweep000.hdf5"), "/data")
+    np.testing.assert_allclose(df.values, expected)
+
+    assert list(summary.n_frames) == [len(expected)] * 2
+    assert list(summary.error_frames) == [0, len(expected)]
@@ -2,6 +2,8 @@ from stytra.tracking.pipelines import Pipeline, ImageToDataNode, NodeOutput
 from lightparam import Param
 from collections import namedtuple
 
+from stytra.utilities import TimingRecorder
+
 
 class TestNode(ImageToDataNode):
     def __init__(self, *args, **kwargs):
@@ -38,3 +40,48 @@ def test_a_pipeline():
     p.deserialize_params(ser)
     assert p.run(None) == NodeOutput([], tt(None, 2))
     assert p.diagnostic_image == "img"
+
+
+class OtherTestNode(ImageToDataNode):
+    def __init__(self, *args, **kwargs):
+        super().__init__("othernode", *args, **kwargs)
+        self._output_type = namedtuple("o", "b")
+
+    def _process(self, input, b: Param(3), set_diagnostic=None):
+        return NodeOutput(["E:other"], self._output_type(b))
+
+
+class TwoOutputPipeline(TestPipeline):
+    def __init__(self):
+        super().__init__()
+        self.on = OtherTestNode()
+        self.on.parent = self.root
+
+
+def test_compiled_pipeline():
+    p = TwoOutputPipeline()
+    p.setup()
+    out = p.run(5)
+    assert out.messages == ["E:other"]
+    assert out.data._fields == ("inp", "par", "b")
+    assert (out.data.inp, out.data.b) == (5, 3)
+
+    # parameters are read again only after they are deserialized
+    p.all_params["/source/othernode"].b = 4
+    assert p.run(5).data.b == 3
+    p.deserialize_params({"/source/othernode": dict(b=4)})
+    assert p.run(6).data.b == 4
+
+
+def test_pipeline_timing():
+    p = TwoOutputPipeline()
+    p.setup()
+    p.timer = TimingRecorder()
+    for i in range(10):
+        p.run(i)
+    collected = p.timer.pop()
+    assert set(collected.keys()) == {"/source", "/source/testnode", "/source/othernode"}
+    counts, total = collected["/source/testnode"]
+    assert counts.sum() == 10
+    assert 0 < TimingRecorder.percentile(counts, 50) < 1
+    assert p.timer.pop() == dict()
@@ -0,0 +1,55 @@
+import numpy as np
+
+from stytra.tracking.preprocessing import (
+    Prefilter,
+    BackgroundSubtractor,
+    negdif,
+    absdif,
+)
+
+
+def test_prefilter_buffers():
+    prefilter = Prefilter()
+    prefilter.setup()
+    np.random.seed(0)
+    frame = np.random.randint(0, 255, (60, 80), dtype=np.uint8)
+    frame_copy = frame.copy()
+    for image_scale in [1, 0.5]:
+        for filter_size in [0, 3]:
+            for color_invert in [True, False]:
+                for clip in [0, 140]:
+                    params = dict(
+                        image_scale=image_scale,
+                        filter_size=filter_size,
+                        color_invert=color_invert,
+                        clip=clip,
+                    )
+                    fused = prefilter._process(frame, **params).data
+                    reference = prefilter._process_generic(frame, *params.values()).data
+                    np.testing.assert_array_equal(fused, reference)
+                    # the input frame is not modified
+                    np.testing.assert_array_equal(frame, frame_copy)
+
+
+def test_background_subtractor():
+    bgsub = BackgroundSubtractor()
+    bgsub.setup()
+    np.random.seed(0)
+    frames = np.random.randint(0, 255, (5, 30, 40), dtype=np.uint8)
+    for only_darker, dif_function in [(True, negdif), (False, absdif)]:
+        bgsub.reset()
+        background = frames[0].astype(np.float32)
+        for i_frame, frame in enumerate(frames):
+            if i_frame == 3 and only_darker:
+                # the mask is computed from the frame after the request
+                assert bgsub.thresholded(20) is None
+            out = bgsub._process(
+                frame, learning_rate=0.1, learn_every=1, only_darker=only_darker
+            )
+            if i_frame > 0:
+                background[:, :] = frame.astype(np.float32) * np.float32(
+                    0.1
+                ) + background * np.float32(1 - 0.1)
+            np.testing.assert_array_equal(out.data, dif_function(background, frame))
+            if i_frame >= 3:
+                np.testing.assert_array_equal(bgsub.thresholded(20), out.data > 20)
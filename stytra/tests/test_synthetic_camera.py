@@ -0,0 +1,80 @@
+import numpy as np
+
+from stytra.collectors.namedtuplequeue import NamedTupleArrayQueue
+from stytra.experiments.fish_pipelines import pipeline_dict
+from stytra.hardware.video.cameras.synthetic import SyntheticCamera
+
+
+def test_ground_truth_queue():
+    queue = NamedTupleArrayQueue()
+    cam = SyntheticCamera(
+        frame_size=(120, 160), framerate=1000, ground_truth_queue=queue
+    )
+    times = []
+    for i in range(20):
+        frame = cam.read()
+        times.append(cam.frame_time.timestamp())
+    assert frame.shape == (120, 160)
+    assert frame.dtype == np.uint8
+
+    [(tuple_type, rows)] = queue.get_all()
+    assert tuple_type._fields[:3] == ("frame", "f0_x", "f0_y")
+    np.testing.assert_array_equal(rows[:, 0], times)
+    np.testing.assert_array_equal(rows[:, 1], np.arange(20))
+
+
+def test_free_swimming_accuracy():
+    cam = SyntheticCamera(frame_size=(240, 320), framerate=1000, n_fish=1, seed=1)
+    pipeline = pipeline_dict["fish"]()
+    pipeline.setup()
+    errors = []
+    for i in range(1000):
+        output = pipeline.run(cam.read(), i / 1000).data
+        if not np.isnan(output.f0_x):
+            errors.append(
+                (
+                    output.f0_x - cam.pose.f0_x,
+                    output.f0_y - cam.pose.f0_y,
+                    np.angle(np.exp(1j * (output.f0_theta - cam.pose.f0_theta))),
+                )
+            )
+
+    # the background has to be learned before the fish is found
+    assert len(errors) > 300
+    assert np.all(np.median(np.abs(errors), 0) < [0.5, 0.5, 0.05])
+
+
+def test_embedded_accuracy():
+    cam = SyntheticCamera(
+        frame_size=(300, 200), framerate=1000, mode="embedded", n_fish=1, bout_rate=4
+    )
+    pipeline = pipeline_dict["eyes_tail"]()
+    pipeline.setup()
+    x, y, length = cam.x[0], cam.y[0], cam.fish_length
+    # the tail is tracked in the downscaled image, in units of its height
+    height = 300 * 0.5
+    pipeline.deserialize_params(
+        {
+            "/source/filtering/tail_tracking": dict(
+                tail_start=((y + 0.1 * length) * 0.5 / height, x * 0.5 / height),
+                tail_length=(0.85 * length * 0.5 / height, 0),
+            ),
+            "/source/eyes_tracking": dict(
+                wnd_pos=(int(x - 0.25 * length), int(y - 0.2 * length)),
+                wnd_dim=(int(0.5 * length), int(0.3 * length)),
+            ),
+        }
+    )
+    tail_sums = []
+    eye_errors = []
+    for i in range(1000):
+        output = pipeline.run(cam.read(), i / 1000).data
+        tail_sums.append((output.tail_sum, cam.pose.f0_tail_sum))
+        eye_errors.append(
+            (output.th_e0 - cam.pose.f0_th_e0, output.th_e1 - cam.pose.f0_th_e1)
+        )
+
+    tail_sums = np.array(tail_sums)
+    assert np.max(np.abs(tail_sums[:, 1])) > 0.5
+    assert np.corrcoef(tail_sums.T)[0, 1] > 0.99
+    assert np.mean(np.abs(eye_errors)) < 5
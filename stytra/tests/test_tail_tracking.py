@@ -0,0 +1,63 @@
+import numpy as np
+import cv2
+
+from stytra.tracking.tail import CentroidTrackingMethod, MultiTailTrackingMethod
+
+
+def test_centroid_tail_tracking():
+    # a straight tail, slightly tilted and between the pixels
+    im = np.zeros((100, 120), dtype=np.uint8)
+    direction = np.array([np.cos(0.3), np.sin(0.3)])
+    start = np.array([20.3, 40.6])
+    end = start + direction * 80
+    cv2.line(
+        im,
+        tuple(int(round(c * 16)) for c in start),
+        tuple(int(round(c * 16)) for c in end),
+        255,
+        3,
+        shift=4,
+    )
+    im = cv2.GaussianBlur(im, (7, 7), 1.5)
+
+    method = CentroidTrackingMethod()
+    method.setup()
+    params = dict(
+        method._params.params.values,
+        tail_start=(start[1] / im.shape[0], start[0] / im.shape[0]),
+        tail_length=(
+            direction[1] * 70 / im.shape[0],
+            direction[0] * 70 / im.shape[0],
+        ),
+    )
+    expected = np.arctan2(direction[0], direction[1])
+    for _ in range(2):
+        tail_sum, *angles = method._process(im, **params).data
+        np.testing.assert_allclose(angles, expected, atol=0.02)
+        np.testing.assert_allclose(tail_sum, 0, atol=0.02)
+
+
+def test_multi_tail_tracking():
+    # the same straight tail, repeated in different parts of the image
+    n_tails = 3
+    im = np.zeros((50 * n_tails, 100), dtype=np.uint8)
+    for i_tail in range(n_tails):
+        cv2.line(im, (15, 50 * i_tail + 20), (90, 50 * i_tail + 30), 255, 3)
+    im = cv2.GaussianBlur(im, (7, 7), 1.5)
+    scale = im.shape[0]
+
+    method = MultiTailTrackingMethod()
+    method.setup()
+    # the parameters are shared between the instances, so they are restored
+    defaults = method._params.params.values
+    method._params.n_tails = n_tails
+    method._params.tail_starts = [
+        ((50 * i_tail + 20) / scale, 15 / scale) for i_tail in range(n_tails)
+    ]
+    method._params.tail_lengths = [(9 / scale, 65 / scale)] * n_tails
+    output = method._process(im, **method._params.params.values).data
+    method._params.params.values = defaults
+
+    assert output._fields[:2] == ("f0_tail_sum", "f0_theta_00")
+    angles = np.array(output).reshape(n_tails, -1)[:, 1:]
+    np.testing.assert_allclose(angles, np.arctan2(75, 10), atol=0.05)
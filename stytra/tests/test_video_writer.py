@@ -0,0 +1,202 @@
+import datetime
+import os
+import av
+import numpy as np
+import pandas as pd
+import flammkuchen as fl
+import threading
+import time
+from multiprocessing import Event
+
+from stytra.hardware.video.frame_pool import FramePool
+from stytra.hardware.video.write import H5VideoWriter, StreamingVideoWriter
+from stytra.hardware.video.read import H5FrameReader, VideoIndex
+
+
+def test_h5_video_writer(tmp_path):
+    writer = H5VideoWriter(None, Event(), Event(), flush_every=3)
+    writer.filename_queue.put(str(tmp_path / "rec_"))
+    writer.configure((4, 5))
+    t0 = datetime.datetime.now()
+    for i in range(10):
+        writer.ingest_frame(np.full((4, 5), i, dtype=np.uint8))
+        writer.ingest_time(t0 + datetime.timedelta(seconds=i * 0.01))
+    writer.complete()
+
+    data = fl.load(str(tmp_path / "rec_video.hdf5"))
+    assert data["video"].shape == (10, 4, 5)
+    assert np.all(data["video"][:, 0, 0] == np.arange(10))
+    np.testing.assert_allclose(np.diff(data["times"]), 0.01, rtol=1e-4)
+
+
+def test_h5_frame_reader(tmp_path):
+    writer = H5VideoWriter(None, Event(), Event())
+    writer.filename_queue.put(str(tmp_path / "rec_"))
+    writer.configure((100, 100))
+    for i in range(50):
+        writer.ingest_frame(np.full((100, 100), i, dtype=np.uint8))
+        writer.ingest_time(datetime.datetime.now())
+    writer.complete()
+
+    reader = H5FrameReader(
+        str(tmp_path / "rec_video.hdf5"), block_mbytes=0.1, cache_blocks=2
+    )
+    assert len(reader) == 50
+    assert reader.block_frames == 10
+    for i in list(range(50)) + [3, 47, 0]:
+        assert np.all(reader[i] == i)
+    assert len(reader.cache) <= 2
+    reader.close()
+
+
+def test_streaming_video_writer_lossless(tmp_path):
+    # big enough for all the frames to wait for the encoding
+    pool = FramePool(max_mbytes=1)
+    queue = pool.new_queue()
+    writer = StreamingVideoWriter(
+        queue,
+        Event(),
+        Event(),
+        extension="mkv",
+        format="ffv1",
+        lossless=True,
+        log_format="csv",
+    )
+    writer.filename_queue.put(str(tmp_path / "rec_"))
+    rng = np.random.RandomState(0)
+    frames = rng.randint(0, 256, (20, 40, 60)).astype(np.uint8)
+    # irregular intervals between the frames
+    times = np.cumsum(rng.uniform(0.002, 0.02, 20))
+    t0 = datetime.datetime.now()
+    for i, (frame, t) in enumerate(zip(frames, times)):
+        pool.send(queue, pool.put(frame), index=i)
+        _, i_frame, slot, frame_in = queue.get()
+        writer.record(t0 + datetime.timedelta(seconds=t), i_frame, slot, frame_in)
+    writer.complete()
+    assert np.all(pool.references() == 0)
+
+    container = av.open(str(tmp_path / "rec_video.mkv"))
+    decoded = list(container.decode(video=0))
+    assert len(decoded) == 20
+    for frame, av_frame in zip(frames, decoded):
+        np.testing.assert_array_equal(av_frame.to_ndarray(format="gray8"), frame)
+    # the frames are presented at the times they were acquired
+    np.testing.assert_allclose([f.time for f in decoded], times - times[0], atol=0.001)
+    container.close()
+
+    metadata = pd.read_csv(str(tmp_path / "rec_video_frames.csv"), sep=";")
+    np.testing.assert_array_equal(metadata.frame, np.arange(20))
+    np.testing.assert_allclose(metadata.t - metadata.t[0], times - times[0], atol=1e-5)
+
+
+def test_streaming_backlog_limited(tmp_path):
+    pool = FramePool(max_mbytes=0.0192)  # 8 slots of 40x60 uint8
+    queue = pool.new_queue()
+    writer = StreamingVideoWriter(
+        queue, Event(), Event(), extension="mkv", format="ffv1", lossless=True
+    )
+    writer.filename_queue.put(str(tmp_path / "rec_"))
+    # the encoding is stalled until all the frames are received
+    encoding = threading.Event()
+    encode_loop = writer.encode_loop
+
+    def stalled_encode_loop(*args):
+        encoding.wait()
+        encode_loop(*args)
+
+    writer.encode_loop = stalled_encode_loop
+    t0 = datetime.datetime(2020, 1, 1)
+    for i in range(6):
+        timestamp = t0 + datetime.timedelta(seconds=i * 0.01)
+        pool.send(queue, pool.put(np.full((40, 60), i, dtype=np.uint8)), timestamp, i)
+        writer.record(*queue.get())
+    # the frames waiting to be encoded hold at most a quarter of the pool
+    assert np.sum(pool.references() > 0) == 2
+    messages = [writer.message_queue.get(timeout=1) for _ in range(2)]
+    assert messages == [
+        "W:Video encoding lagging behind",
+        "W:Dropping frames from recording",
+    ]
+    encoding.set()
+    writer.complete()
+    assert np.all(pool.references() == 0)
+
+    metadata = fl.load(str(tmp_path / "rec_video_frames.hdf5"))
+    np.testing.assert_array_equal(metadata["frame"], [0, 1])
+
+
+def test_frames_released_before_filename(tmp_path):
+    pool = FramePool(max_mbytes=0.1)
+    queue = pool.new_queue()
+    writer = H5VideoWriter(queue, Event(), Event())
+    t0 = datetime.datetime(2020, 1, 1)
+    for i in range(3):
+        pool.send(queue, pool.put(np.full((4, 5), i, dtype=np.uint8)), t0, i)
+        writer.record(*queue.get())
+        # the frames received before the file name are not kept
+        assert np.all(pool.references() == 0)
+        if i == 0:
+            writer.filename_queue.put(str(tmp_path / "rec_"))
+            # the queue is fed by a background thread
+            time.sleep(0.1)
+    writer.complete()
+    assert np.all(pool.references() == 0)
+    assert fl.load(str(tmp_path / "rec_video.hdf5"), "/video").shape[0] == 2
+
+
+def test_segmented_recording(tmp_path):
+    pool = FramePool(max_mbytes=0.1)
+    queue = pool.new_queue()
+    writer = H5VideoWriter(queue, Event(), Event(), segment_frames=4, flush_every=2)
+    writer.filename_queue.put(str(tmp_path / "rec_"))
+    t0 = datetime.datetime(2020, 1, 1)
+    for i in range(10):
+        pool.send(queue, pool.put(np.full((4, 5), i, dtype=np.uint8)), index=i)
+        _, i_frame, slot, frame = queue.get()
+        writer.record(t0 + datetime.timedelta(seconds=i), i_frame, slot, frame)
+    # the index is up to date before the recording is finished
+    index = VideoIndex(str(tmp_path / "rec_video_index.json"))
+    assert [s["n_frames"] for s in index.segments] == [4, 4, 2]
+    t_end = (t0 + datetime.timedelta(seconds=9)).timestamp()
+    assert index.segments[-1]["t_end"] == t_end
+    writer.complete()
+    assert np.all(pool.references() == 0)
+
+    index = VideoIndex(str(tmp_path / "rec_video_index.json"))
+    assert len(index) == 10
+    assert [s["n_frames"] for s in index.segments] == [4, 4, 2]
+    path, i_frame = index.locate(5)
+    assert (os.path.basename(path), i_frame) == ("rec_video_0001.hdf5", 1)
+    assert fl.load(path, "/video")[i_frame, 0, 0] == 5
+
+    t_start = (t0 + datetime.timedelta(seconds=3.5)).timestamp()
+    paths = index.segments_between(t_start, t_start + 1)
+    assert [os.path.basename(p) for p in paths] == ["rec_video_0001.hdf5"]
+
+
+def test_frame_metadata(tmp_path):
+    pool = FramePool(max_mbytes=0.1)
+    queue = pool.new_queue()
+    acquisition_times = np.arange(100) * 0.01
+    writer = H5VideoWriter(
+        queue, Event(), Event(), acquisition_times=acquisition_times, flush_every=4
+    )
+    writer.filename_queue.put(str(tmp_path / "rec_"))
+    t0 = datetime.datetime(2020, 1, 1)
+    # the frames 3 and 7 did not reach the recording
+    indices = [0, 1, 2, 4, 5, 6, 8, 9, 10, 11]
+    for i in indices:
+        timestamp = t0 + datetime.timedelta(seconds=i * 0.01)
+        pool.send(queue, pool.put(np.full((4, 5), i, dtype=np.uint8)), timestamp, i)
+        writer.record(*queue.get())
+    # the metadata is written while recording
+    assert writer.metadata_file.root.frame.nrows == 8
+    writer.complete()
+
+    metadata = fl.load(str(tmp_path / "rec_video_frames.hdf5"))
+    np.testing.assert_array_equal(metadata["frame"], indices)
+    np.testing.assert_allclose(metadata["t_acquired"], acquisition_times[indices])
+    np.testing.assert_allclose(
+        np.diff(metadata["t"]), np.diff(indices) * 0.01, rtol=1e-4
+    )
+    np.testing.assert_array_equal(np.flatnonzero(metadata["dropped"]), [3, 6])
@@ -119,10 +119,10 @@ class TestExperimentClass(unittest.TestCase):
     def check_result(array, key, tol=3):
         solutions = dict(
             th_e0=np.array(
-                [-95.58, -95.58, -95.58, -95.58, -95.58, -95.58, -95.58, -95.58, -95.58]
+                [-93.88, -93.88, -93.88, -93.88, -93.88, -93.88, -93.88, -93.88, -93.88]
             ),
             th_e1=np.array(
-                [-77.34, -77.34, -77.34, -77.34, -77.34, -77.34, -79.74, -79.74, -79.74]
+                [-80.74, -80.74, -80.74, -80.74, -80.74, -80.74, -80.35, -80.35, -80.35]
             ),
             theta_00=np.array(
                 [-1.52, -1.52, -1.52, -1.52, -1.52, -1.52, -1.52, -1.52, -1.52]
@@ -3,8 +3,8 @@
 """
 
 import numpy as np
+from numba import jit
 from skimage.filters import threshold_local
-import cv2
 from lightparam import Parametrized, Param
 from stytra.tracking.pipelines import ImageToDataNode, NodeOutput
 from collections import namedtuple
@@ -43,6 +43,11 @@ class EyeTrackingMethod(ImageToDataNode):
         wnd_pos: Param((129, 20), gui=False),
         threshold: Param(56, limits=(1, 254)),
         wnd_dim: Param((14, 22), gui=False),
+        weighted: Param(
+            False,
+            desc="Weight the pixels of the eyes by how much darker than the "
+            "threshold they are, for subpixel estimates",
+        ),
         **extraparams
     ):
         """
@@ -57,46 +62,27 @@ class EyeTrackingMethod(ImageToDataNode):
             dimension of the window on the eyes (w, h);
         threshold :
             threshold for ellipse fitting (int).
+        weighted :
+            whether the ellipses are fitted to the intensity-weighted pixels
 
         Returns
         -------
 
         """
         message = ""
-        PAD = 0
 
-        cropped = _pad(
-            (
-                im[
-                    wnd_pos[1] : wnd_pos[1] + wnd_dim[1],
-                    wnd_pos[0] : wnd_pos[0] + wnd_dim[0],
-                ]
-                < threshold
-            )
-            .view(dtype=np.uint8)
-            .copy(),
-            padding=PAD,
-            val=255,
-        )
-
-        # try:
-        e = _fit_ellipse(cropped)
+        # the window is a view of the image, thresholded while the eyes
+        # are labelled
+        window = im[
+            wnd_pos[1] : wnd_pos[1] + wnd_dim[1], wnd_pos[0] : wnd_pos[0] + wnd_dim[0]
+        ]
+        e = _fit_eyes(window, threshold, weighted)
 
         if self.set_diagnostic == "thresholded":
             self.diagnostic_image = (im < threshold).view(dtype=np.uint8)
 
-        if e is False:
-            e = (np.nan,) * 10
+        if np.isnan(e[0]):
             message = "E: eyes not detected!"
-        else:
-            e = (
-                e[0][0][::-1]
-                + e[0][1][::-1]
-                + (-e[0][2],)
-                + e[1][0][::-1]
-                + e[1][1][::-1]
-                + (-e[1][2],)
-            )
         return NodeOutput([message], self._output_type(*e))
 
 
@@ -149,44 +135,105 @@ def _local_thresholding(im, padding=2, block_size=17, offset=70):
     return padded > threshold_local(padded, block_size=block_size, offset=offset)
 
 
-def _fit_ellipse(thresholded_image):
-    """Finds contours and fits an ellipse to thresholded image
+@jit(nopython=True)
+def _fit_eyes(window, threshold, weighted, min_area=5):
+    """Labels the regions darker than the threshold in the window and
+    fits ellipses to the two largest ones from their second-order moments
 
     Parameters
     ----------
-    thresholded_image :
-        Binary image containing two eyes
+    window :
+        part of the image containing two eyes
+    threshold :
+        the eyes are darker than the threshold
+    weighted :
+        whether the pixels are weighted by how much darker than the
+        threshold they are
+    min_area :
+        minimal number of pixels of an eye
 
     Returns
     -------
     type
-        When eyes were found, the two ellipses, otherwise False
+        array of the row and column of the center, the major and minor
+        axes and the angle in degrees of each eye, NaN if less than two
+        eyes are found
 
     """
-    cont_ret = cv2.findContours(
-        thresholded_image.astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
-    )
-
-    # API change, in OpenCV 4 there are 2 values unlike OpenCV3
-    if len(cont_ret) == 3:
-        _, contours, hierarchy = cont_ret
-    else:
-        contours, hierarchy = cont_ret
-
-    if len(contours) >= 2:
-
-        # Get the two largest ellipses (i.e. the eyes, not any dirt)
-        contours = sorted(contours, key=lambda c: c.shape[0], reverse=True)[:2]
-        # Sort them that first ellipse is always the left eye (in the image)
-        contours = sorted(contours, key=np.max)
-
-        # Fit the ellipses for the two eyes
-        if len(contours[0]) > 4 and len(contours[1]) > 4:
-            e = [cv2.fitEllipse(contours[i]) for i in range(2)]
-            return e
-        else:
-            return False
-
-    else:
-        # Not at least two eyes + maybe dirt found...
-        return False
+    h, w = window.shape
+    labelled = np.zeros((h, w), dtype=np.bool_)
+    stack = np.empty(h * w, dtype=np.int64)
+
+    # sums for the moments of the two largest regions: area, mass, first
+    # and second-order moments
+    sums = np.zeros((2, 7))
+    for i_start in range(h * w):
+        if labelled.flat[i_start] or window.flat[i_start] >= threshold:
+            continue
+        labelled.flat[i_start] = True
+        stack[0] = i_start
+        n_stack = 1
+        region = np.zeros(7)
+        while n_stack > 0:
+            n_stack -= 1
+            i = stack[n_stack]
+            y = i // w
+            x = i - y * w
+            m = 1.0
+            if weighted:
+                m = float(threshold) - window[y, x]
+            region[0] += 1
+            region[1] += m
+            region[2] += m * x
+            region[3] += m * y
+            region[4] += m * x * x
+            region[5] += m * y * y
+            region[6] += m * x * y
+
+            # add the 8-connected neighbours
+            for ny in range(max(y - 1, 0), min(y + 2, h)):
+                for nx in range(max(x - 1, 0), min(x + 2, w)):
+                    if not labelled[ny, nx] and window[ny, nx] < threshold:
+                        labelled[ny, nx] = True
+                        stack[n_stack] = ny * w + nx
+                        n_stack += 1
+
+        # keep the two largest regions (i.e. the eyes, not any dirt)
+        if region[0] > sums[0, 0]:
+            sums[1, :] = sums[0, :]
+            sums[0, :] = region
+        elif region[0] > sums[1, 0]:
+            sums[1, :] = region
+
+    e = np.full(10, np.nan)
+    if sums[1, 0] < min_area:
+        return e
+
+    # sort the eyes along the longest side of the window
+    i_coord = 2 if w > h else 3
+    if sums[0, i_coord] / sums[0, 1] > sums[1, i_coord] / sums[1, 1]:
+        sums = sums[::-1, :]
+
+    for i_eye in range(2):
+        mass = sums[i_eye, 1]
+        cx = sums[i_eye, 2] / mass
+        cy = sums[i_eye, 3] / mass
+        mu20 = sums[i_eye, 4] / mass - cx * cx
+        mu02 = sums[i_eye, 5] / mass - cy * cy
+        mu11 = sums[i_eye, 6] / mass - cx * cy
+
+        # the axes of an ellipse with the same second moments
+        common = np.sqrt(4 * mu11 ** 2 + (mu20 - mu02) ** 2)
+        major = 2 * np.sqrt(2 * max(mu20 + mu02 + common, 0.0))
+        minor = 2 * np.sqrt(2 * max(mu20 + mu02 - common, 0.0))
+        theta = 0.5 * np.arctan2(2 * mu11, mu20 - mu02)
+
+        # same conventions as the ellipses fitted by OpenCV to the contours
+        e[i_eye * 5 : i_eye * 5 + 5] = (
+            cy,
+            cx,
+            major,
+            minor,
+            -np.mod(np.degrees(theta) + 90, 180),
+        )
+    return e
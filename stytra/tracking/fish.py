@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
 from numba import jit, jitclass, int64, float64
+from scipy.optimize import linear_sum_assignment
 
 from stytra.tracking.tail import find_fish_midline
 from stytra.tracking.preprocessing import BackgroundSubtractor
@@ -8,7 +9,7 @@ from stytra.tracking.preprocessing import BackgroundSubtractor
 from itertools import chain
 
 from lightparam import Param
-from stytra.tracking.simple_kalman import predict_inplace, update_inplace
+from stytra.tracking.simple_kalman import predict_batch, update_batch
 from stytra.tracking.pipelines import ImageToDataNode, NodeOutput
 from collections import namedtuple
 
@@ -25,6 +26,9 @@ def _fish_column_names(i_fish, n_segments):
 
 
 class FishTrackingMethod(ImageToDataNode):
+    stateful = True
+    uses_frame_time = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, name="fish_tracking", **kwargs)
         self.monitored_headers = ["biggest_area", "f0_theta"]
@@ -38,6 +42,23 @@ class FishTrackingMethod(ImageToDataNode):
         self.dilation_kernel = np.ones((3, 3), dtype=np.uint8)
         self.fishes = None
 
+        # state of the search around the predicted fish positions
+        self._frames_since_scan = 0
+        self._full_scan_next = True
+
+        # time of the previous frame, to predict over the elapsed interval
+        self._previous_time = None
+
+        # buffers for the downsampled and thresholded images
+        self._buffers = dict()
+
+    def _buffer(self, key, shape, dtype):
+        buffer = self._buffers.get(key, None)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self._buffers[key] = buffer
+        return buffer
+
     def changed(self, vals):
         if any(
             p in vals.keys() for p in ["n_segments", "n_fish_max", "bg_downsample"]
@@ -64,10 +85,180 @@ class FishTrackingMethod(ImageToDataNode):
             self._params.n_fish_max,
             n_segments=self._params.n_segments - 1,
             pos_std=self._params.pos_uncertainty,
-            pred_coef=self._params.prediction_uncertainty,
+            pred_coef=self._params.acceleration_variance,
             angle_std=np.pi / 10,
             persist_fish_for=self._params.persist_fish_for,
+            frame_interval=self._params.frame_interval,
         )
+        self._full_scan_next = True
+
+    def upgrade_params(self, vals):
+        """ prediction_uncertainty, used before the prediction was done in
+        seconds, scaled a process noise given in frames, with a frame of
+        0.02 s. It is converted to the acceleration variance giving the
+        same noise on the velocity for frames of frame_interval
+        """
+        if "prediction_uncertainty" in vals.keys():
+            vals = dict(vals)
+            frame_interval = vals.get("frame_interval", self._params.frame_interval)
+            vals["acceleration_variance"] = (
+                vals.pop("prediction_uncertainty") * 0.02 ** 2 / frame_interval ** 4
+            )
+        return vals
+
+    def _elapsed_time(self, frame_interval):
+        """ Time in seconds elapsed since the previous frame, computed from
+        the frame times so that the fish motion is predicted correctly if
+        frames are dropped or the frame rate changes. If the frame times
+        are not known, the nominal frame interval is used
+        """
+        previous_time, self._previous_time = self._previous_time, self.frame_time
+        if self.frame_time is None or previous_time is None:
+            return frame_interval
+        interval = self.frame_time - previous_time
+        if interval <= 0:
+            return frame_interval
+        return interval
+
+    def _threshold(self, bg, bg_downsample, bg_dif_threshold):
+        """ Downsamples and thresholds the whole background difference
+
+        Returns
+        -------
+        the downsampled image and the dilated thresholded image
+
+        """
+        bg_mask = None
+        if bg_downsample > 1:
+            key = ("downsampled", bg.shape, bg_downsample)
+            bg_small = cv2.resize(
+                bg,
+                None,
+                dst=self._buffers.get(key, None),
+                fx=1 / bg_downsample,
+                fy=1 / bg_downsample,
+            )
+            self._buffers[key] = bg_small
+            if isinstance(self.parent, BackgroundSubtractor):
+                self.parent.mask_threshold = None
+        else:
+            bg_small = bg
+            # the background subtraction can threshold the difference
+            # in the same pass
+            if isinstance(self.parent, BackgroundSubtractor):
+                bg_mask = self.parent.thresholded(bg_dif_threshold)
+
+        if bg_mask is None:
+            bg_mask = np.greater(
+                bg_small,
+                bg_dif_threshold,
+                out=self._buffer("mask", bg_small.shape, np.bool_),
+            ).view(dtype=np.uint8)
+
+        bg_thresh = cv2.dilate(
+            bg_mask,
+            self.dilation_kernel,
+            dst=self._buffer("thresholded", bg_small.shape, np.uint8),
+        )
+        return bg_small, bg_thresh
+
+    def _search_windows(self, shape, search_window, bg_downsample):
+        """ Computes the windows, in downsampled image coordinates, around
+        the predicted positions of the tracked fish. Overlapping windows are
+        merged so that no fish is found twice.
+
+        Returns
+        -------
+        list of [top, bottom, left, right] windows
+
+        """
+        half_size = max(int(search_window // bg_downsample), 1)
+        windows = []
+        for x, y in self.fishes.coords[:, [0, 2]]:
+            if np.isnan(x) or np.isnan(y):
+                continue
+            x, y = int(round(x / bg_downsample)), int(round(y / bg_downsample))
+            window = [
+                max(y - half_size, 0),
+                min(y + half_size + 1, shape[0]),
+                max(x - half_size, 0),
+                min(x + half_size + 1, shape[1]),
+            ]
+            if window[0] < window[1] and window[2] < window[3]:
+                windows.append(window)
+
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(windows)):
+                for j in range(i + 1, len(windows)):
+                    a, b = windows[i], windows[j]
+                    if a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]:
+                        windows[i] = [
+                            min(a[0], b[0]),
+                            max(a[1], b[1]),
+                            min(a[2], b[2]),
+                            max(a[3], b[3]),
+                        ]
+                        del windows[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return windows
+
+    def _threshold_window(self, bg, window, bg_downsample, bg_dif_threshold):
+        """ Downsamples and thresholds the background difference only in
+        a window given in downsampled image coordinates
+        """
+        top, bottom, left, right = window
+        if bg_downsample > 1:
+            bg_small = cv2.resize(
+                bg[
+                    top * bg_downsample : bottom * bg_downsample,
+                    left * bg_downsample : right * bg_downsample,
+                ],
+                (right - left, bottom - top),
+            )
+            if isinstance(self.parent, BackgroundSubtractor):
+                self.parent.mask_threshold = None
+        else:
+            bg_small = bg[top:bottom, left:right]
+            if isinstance(self.parent, BackgroundSubtractor):
+                bg_mask = self.parent.thresholded(bg_dif_threshold)
+                if bg_mask is not None:
+                    return cv2.dilate(
+                        bg_mask[top:bottom, left:right], self.dilation_kernel
+                    )
+        return cv2.dilate(
+            (bg_small > bg_dif_threshold).view(dtype=np.uint8), self.dilation_kernel
+        )
+
+    def _associate(self, detections, max_distance, max_angle, messages):
+        """ Assigns the detections to the tracked fish, minimizing the sum
+        of the Mahalanobis distances to the predicted fish positions,
+        and adds the ones which were not assigned as new fish
+        """
+        costs = self.fishes.association_costs(detections, max_distance, max_angle)
+        gated = np.isinf(costs)
+        assigned = np.zeros(len(detections), dtype=np.bool_)
+        if not np.all(gated):
+            # the gated pairs are given a cost so high that they are chosen
+            # only if there is nothing else to assign
+            costs[gated] = np.max(costs[~gated]) * (costs.size + 1) + 1.0
+            i_fishes, i_detections = linear_sum_assignment(costs)
+            valid = ~gated[i_fishes, i_detections]
+            self.fishes.update_assigned(
+                detections, i_fishes[valid], i_detections[valid]
+            )
+            assigned[i_detections[valid]] = True
+            messages.extend(["I:Updated previous fish"] * int(np.sum(valid)))
+
+        for detection in detections[~assigned]:
+            if self.fishes.add_fish(detection):
+                messages.append("I:Added new fish")
+            else:
+                messages.append("E:More fish than n_fish max")
 
     def _process(
         self,
@@ -87,37 +278,100 @@ class FishTrackingMethod(ImageToDataNode):
             (1, 50),
             desc="How many frames does the fish persist for if it is not detected",
         ),
-        prediction_uncertainty: Param(0.1, (0.0, 10.0, 0.0001)),
+        acceleration_variance: Param(
+            1e6,
+            (0.0, 1e9),
+            desc="Variance of the random accelerations of the fish, "
+            "in squared pixels (or radians) per second to the fourth",
+        ),
+        frame_interval: Param(
+            0.02,
+            (0.0001, 10.0),
+            unit="s",
+            desc="Interval between frames, used for the prediction "
+            "if the frame times are not known",
+        ),
         fish_area: Param((200, 1200), (1, 4000)),
         border_margin: Param(5, (0, 100)),
         tail_length: Param(60.0, (1.0, 200.0)),
         tail_track_window: Param(3, (3, 70)),
+        search_window: Param(
+            0,
+            (0, 1000),
+            desc="Half-size in pixels of the windows searched around the "
+            "predicted positions of the tracked fish, 0 to always "
+            "search the whole frame",
+        ),
+        full_scan_every: Param(
+            50,
+            (1, 10000),
+            desc="Every how many frames the whole frame is searched for "
+            "new fish when searching around the tracked ones",
+        ),
+        max_distance: Param(
+            15.0,
+            (0.0, 200.0),
+            desc="Maximal distance in pixels between the predicted position "
+            "of a fish and a detection assigned to it",
+        ),
+        max_angle: Param(
+            np.pi / 2,
+            (0.0, np.pi),
+            desc="Maximal difference between the predicted heading of a fish "
+            "and the one of a detection assigned to it",
+        ),
     ):
 
         # update the previously-detected fish using the Kalman filter
+        elapsed_time = self._elapsed_time(frame_interval)
         if self.fishes is None:
             self.reset()
         else:
-            self.fishes.predict()
+            self.fishes.predict(elapsed_time)
 
         area_scale = bg_downsample * bg_downsample
         border_margin = border_margin // bg_downsample
 
-        # downsample background
-        if bg_downsample > 1:
-            bg_small = cv2.resize(bg, None, fx=1 / bg_downsample, fy=1 / bg_downsample)
-        else:
-            bg_small = bg
-
-        bg_thresh = cv2.dilate(
-            (bg_small > bg_dif_threshold).view(dtype=np.uint8), self.dilation_kernel
+        tracked = ~np.isnan(self.fishes.coords[:, 0])
+
+        # search only around the predicted positions of the fish, unless
+        # a full scan is due, a fish was lost or the thresholded image is shown
+        full_scan = (
+            search_window == 0
+            or self._full_scan_next
+            or not np.any(tracked)
+            or self._frames_since_scan + 1 >= full_scan_every
+            or self.set_diagnostic
+            in ["thresholded background difference", "fish detection"]
         )
 
         # find regions where there is a difference with the background
-        n_comps, labels, stats, centroids = cv2.connectedComponentsWithStats(bg_thresh)
+        if full_scan:
+            self._frames_since_scan = 0
+            bg_small, bg_thresh = self._threshold(bg, bg_downsample, bg_dif_threshold)
+            n_comps, labels, stats, centroids = cv2.connectedComponentsWithStats(
+                bg_thresh
+            )
+            stats = stats[1:]
+        else:
+            self._frames_since_scan += 1
+            window_stats = [np.empty((0, 5), np.int32)]
+            small_shape = (bg.shape[0] // bg_downsample, bg.shape[1] // bg_downsample)
+            for window in self._search_windows(
+                small_shape, search_window, bg_downsample
+            ):
+                n_comps, labels, stats, centroids = cv2.connectedComponentsWithStats(
+                    self._threshold_window(bg, window, bg_downsample, bg_dif_threshold)
+                )
+                # move the regions to the whole image coordinates
+                stats = stats[1:]
+                stats[:, cv2.CC_STAT_TOP] += window[0]
+                stats[:, cv2.CC_STAT_LEFT] += window[2]
+                window_stats.append(stats)
+            stats = np.concatenate(window_stats)
 
         try:
-            max_area = np.max(stats[1:, cv2.CC_STAT_AREA]) * area_scale
+            max_area = np.max(stats[:, cv2.CC_STAT_AREA]) * area_scale
         except ValueError:
             max_area = 0
 
@@ -126,8 +380,8 @@ class FishTrackingMethod(ImageToDataNode):
 
         messages = []
 
-        nofish = True
-        for row, centroid in zip(stats, centroids):
+        detections = []
+        for row in stats:
             # check if the contour is fish-sized and central enough
             if not fish_area[0] < row[cv2.CC_STAT_AREA] * area_scale < fish_area[1]:
                 continue
@@ -195,19 +449,19 @@ class FishTrackingMethod(ImageToDataNode):
             angles[1:] = np.unwrap(angles[1:] - angles[0])
 
             # put the data together for one fish
-            fish_coords = np.concatenate([np.array(points[0][:2]), angles])
-
-            nofish = False
-            # check if this is a new fish, or it is an update of
-            # a fish detected previously
-            if self.fishes.update(fish_coords):
-                messages.append("I:Updated previous fish")
-            elif self.fishes.add_fish(fish_coords):
-                messages.append("I:Added new fish")
-            else:
-                messages.append("E:More fish than n_fish max")
+            detections.append(np.concatenate([np.array(points[0][:2]), angles]))
+
+        # check which detections are updates of the fish detected previously,
+        # and which ones are new fish
+        if len(detections) > 0:
+            self._associate(np.array(detections), max_distance, max_angle, messages)
 
-        if nofish:
+        # if a fish is lost, look for it in the whole frame
+        self._full_scan_next = bool(
+            np.any(tracked & (np.asarray(self.fishes.i_not_updated) > 0))
+        )
+
+        if len(detections) == 0:
             messages.append(
                 "W:No object of right area, between {:.0f} and {:.0f}".format(
                     *fish_area
@@ -238,7 +492,6 @@ spec = [
     ("n_fish", int64),
     ("coords", float64[:, :]),
     ("i_not_updated", int64[:]),
-    ("F", float64[:, :]),
     ("uncertainties", float64[:]),
     ("Q", float64[:, :]),
     ("Ps", float64[:, :, :, :]),
@@ -249,60 +502,109 @@ spec = [
 
 @jitclass(spec)
 class Fishes(object):
+    """ Kalman filters for the position and heading of the tracked fish.
+    The time is measured in seconds and the velocities are in pixels (or
+    radians) per second, so that the prediction follows the real interval
+    between frames, also if frames are missed or the frame rate changes.
+    The process noise is a white noise acceleration of variance pred_coef,
+    and the velocities of new fish are as uncertain as moving by the
+    position uncertainty in one frame_interval.
+    """
+
     def __init__(
-        self, n_fish_max, pos_std, angle_std, n_segments, pred_coef, persist_fish_for
+        self,
+        n_fish_max,
+        pos_std,
+        angle_std,
+        n_segments,
+        pred_coef,
+        persist_fish_for,
+        frame_interval=1.0,
     ):
         self.n_fish = n_fish_max
         self.coords = np.full((n_fish_max, 6 + n_segments), np.nan)
-        self.uncertainties = np.array((pos_std, angle_std, angle_std))
+        self.uncertainties = np.array((pos_std, pos_std, angle_std))
         self.def_P = np.zeros((3, 2, 2))
         for i, uc in enumerate(self.uncertainties):
             self.def_P[i, 0, 0] = uc
-            self.def_P[i, 1, 1] = uc
+            self.def_P[i, 1, 1] = uc / frame_interval ** 2
         self.i_not_updated = np.zeros(n_fish_max, dtype=np.int64)
         self.Ps = np.zeros((n_fish_max, 3, 2, 2))
-        self.F = np.array([[1.0, 1.0], [0.0, 1.0]])
-        dt = 0.02
-        self.Q = (
-            np.array([[0.25 * dt ** 4, 0.5 * dt ** 3], [0.5 * dt ** 3, dt ** 2]])
-            * pred_coef
-        )
+
+        # process noise of a white noise acceleration, scaled by the
+        # powers of the elapsed time in predict
+        self.Q = np.array([[0.25, 0.5], [0.5, 1.0]]) * pred_coef
         self.persist_fish_for = persist_fish_for
 
-    def predict(self):
+    def predict(self, dt=1.0):
+        """ Predicts the fish state after dt seconds """
+        Q = np.empty((2, 2))
+        Q[0, 0] = self.Q[0, 0] * dt ** 4
+        Q[0, 1] = self.Q[0, 1] * dt ** 3
+        Q[1, 0] = self.Q[1, 0] * dt ** 3
+        Q[1, 1] = self.Q[1, 1] * dt ** 2
+        for i_coord in range(3):
+            predict_batch(
+                self.coords[:, i_coord * 2 : i_coord * 2 + 2],
+                self.Ps[:, i_coord],
+                dt,
+                Q,
+            )
         for i_fish in range(self.n_fish):
             if not np.isnan(self.coords[i_fish, 0]):
-                for i_coord in range(0, 6, 2):
-                    predict_inplace(
-                        self.coords[i_fish, i_coord : i_coord + 2],
-                        self.Ps[i_fish, i_coord // 2],
-                        self.F,
-                        self.Q,
-                    )
                 self.i_not_updated[i_fish] += 1
                 if self.i_not_updated[i_fish] > self.persist_fish_for:
                     self.coords[i_fish, :] = np.nan
 
-    def update(self, new_fish):
+    def update_assigned(self, detections, i_fishes, i_detections):
+        """ Updates the fish i_fishes with the detections i_detections """
+        z = np.empty(len(i_fishes))
+        for i_coord in range(3):
+            for i in range(len(i_fishes)):
+                z[i] = detections[i_detections[i], i_coord]
+                # for the angle find the modulo 2pi closest
+                if i_coord == 2:
+                    z[i] = _minimal_angle_dif(self.coords[i_fishes[i], 4], z[i])
+            update_batch(
+                z,
+                self.coords[:, i_coord * 2 : i_coord * 2 + 2],
+                self.Ps[:, i_coord],
+                self.uncertainties[i_coord],
+                i_fishes,
+            )
+        for i in range(len(i_fishes)):
+            # update tail angles
+            self.coords[i_fishes[i], 6:] = detections[i_detections[i], 3:]
+            self.i_not_updated[i_fishes[i]] = 0
+
+    def association_costs(self, detections, max_distance, max_angle):
+        """ Computes the squared Mahalanobis distances between the predicted
+        fish and the detections, given the Kalman filter covariances.
+        Pairs which are farther than max_distance in pixels or max_angle
+        in heading, and fish not tracked, have an infinite cost.
+        """
+        costs = np.full((self.n_fish, detections.shape[0]), np.inf)
         for i_fish in range(self.n_fish):
-            if not np.isnan(self.coords[i_fish, 0]):
-                if self.is_close(new_fish, i_fish) and self.i_not_updated[i_fish] != 0:
-                    # update position with Kalman filtering
-                    for i_coord in range(0, 3):
-                        # if it is the angle find the modulo 2pi closest
-                        nc = new_fish[i_coord]
-                        if i_coord == 2:
-                            nc = _minimal_angle_dif(self.coords[i_fish, 4], nc)
-                        update_inplace(
-                            nc,
-                            self.coords[i_fish, i_coord * 2 : i_coord * 2 + 2],
-                            self.Ps[i_fish, i_coord],
-                            self.uncertainties[i_coord],
-                        )
-                    # update tail angles
-                    self.coords[i_fish, 6:] = new_fish[3:]
-                    self.i_not_updated[i_fish] = 0
-                    return True
+            if np.isnan(self.coords[i_fish, 0]) or self.i_not_updated[i_fish] == 0:
+                continue
+            # variances of the innovations for the position and heading
+            s_x = self.Ps[i_fish, 0, 0, 0] + self.uncertainties[0]
+            s_y = self.Ps[i_fish, 1, 0, 0] + self.uncertainties[1]
+            s_theta = self.Ps[i_fish, 2, 0, 0] + self.uncertainties[2]
+            for i_det in range(detections.shape[0]):
+                dx = detections[i_det, 0] - self.coords[i_fish, 0]
+                dy = detections[i_det, 1] - self.coords[i_fish, 2]
+                dtheta = (
+                    np.mod(
+                        detections[i_det, 2] - self.coords[i_fish, 4] + np.pi, np.pi * 2
+                    )
+                    - np.pi
+                )
+                if dx ** 2 + dy ** 2 < max_distance ** 2 and np.abs(dtheta) < max_angle:
+                    costs[i_fish, i_det] = (
+                        dx ** 2 / s_x + dy ** 2 / s_y + dtheta ** 2 / s_theta
+                    )
+        return costs
 
     def add_fish(self, new_fish):
         for i_fish in range(self.n_fish):
@@ -315,20 +617,6 @@ class Fishes(object):
                 return True
         return False
 
-    def is_close(self, new_fish, i_fish):
-        """ Check whether the new coordinates are
-        within a certain number of pixels of the old estimate
-        and within a certain angle
-        """
-        n_px = 15
-        d_theta = np.pi / 2
-        dists = new_fish[:2] - self.coords[i_fish, 0:4:2]
-        dtheta = np.abs(
-            np.mod(new_fish[2] - self.coords[i_fish, 4] + np.pi, np.pi * 2) - np.pi
-        )
-
-        return np.sum(dists ** 2) < n_px ** 2 and dtheta < d_theta
-
 
 @jit(nopython=True)
 def points_to_angles(points):
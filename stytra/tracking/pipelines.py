@@ -2,13 +2,24 @@ from lightparam import Parametrized, Param
 from anytree import PreOrderIter, Node, Resolver
 from multiprocessing import Queue
 from collections import namedtuple
-from itertools import chain
+from datetime import datetime
+from time import perf_counter
 
 
 NodeOutput = namedtuple("NodeOutput", "messages data")
 
 
 class PipelineNode(Node):
+    """ A step of a tracking pipeline. Nodes which keep a state between
+    frames (e.g. a background model) have to set stateful to True,
+    so that they are not run on several tracking processes in parallel.
+    Nodes which set uses_frame_time to True get the time of the frame
+    they process, in seconds, in their frame_time attribute.
+    """
+
+    stateful = False
+    uses_frame_time = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._params = None
@@ -16,6 +27,9 @@ class PipelineNode(Node):
         self.diagnostic_image = None
         self.set_diagnostic = None
         self._output_type = None
+        # parameter values passed to _process, cached until they are changed
+        self._param_values = None
+        self.frame_time = None
 
     def reset(self):
         pass
@@ -23,6 +37,12 @@ class PipelineNode(Node):
     def changed(self, vals):
         pass
 
+    def upgrade_params(self, vals):
+        """ Converts the values of parameters saved by previous versions
+        of the node, returns the values to restore
+        """
+        return vals
+
     def setup(self):
         self._params = Parametrized(params=self._process, name="tracking+" + self.name)
 
@@ -35,7 +55,9 @@ class PipelineNode(Node):
         return self.separator.join([""] + [str(node.name) for node in self.path])
 
     def process(self, *inputs) -> NodeOutput:
-        out = self._process(*inputs, **self._params.params.values)
+        if self._param_values is None:
+            self._param_values = self._params.params.values
+        out = self._process(*inputs, **self._param_values)
         try:
             assert isinstance(out, NodeOutput)
         except AssertionError:
@@ -105,6 +127,21 @@ class Pipeline:
         self._param_finder = Resolver()
         self.node_dict = dict()
 
+        # the execution plan, compiled from the tree on the first run
+        self._plan = None
+
+        # if set to a TimingRecorder, the duration of each node is recorded
+        self.timer = None
+
+    @property
+    def stateful(self):
+        """ Whether the pipeline output depends on the previous frames.
+        Only pipelines which are not stateful can be run in several
+        tracking processes, pipelines which share their state between
+        processes explicitly can override this.
+        """
+        return any(node.stateful for node in PreOrderIter(self.root))
+
     @property
     def headers_to_plot(self):
         hds = []
@@ -119,6 +156,7 @@ class Pipeline:
 
         """
         diag_images = []
+        self._plan = None
         for node in PreOrderIter(self.root):
             node.setup()
             if node._params is not None:
@@ -155,17 +193,30 @@ class Pipeline:
         except KeyError:
             return None
 
+    def invalidate_param_values(self):
+        """ Makes the nodes read their parameter values again on the next
+        frame, has to be called if the parameters are changed directly
+        """
+        for node in self.node_dict.values():
+            node._param_values = None
+
     def serialize_changed_params(self):
         chg = {n: p.params.changed_values() for n, p in self.all_params.items()}
         for p in self.all_params.values():
             p.params.acknowledge_changes()
+        # the parameters of this pipeline might have been changed directly
+        if any(len(vals) > 0 for vals in chg.values()):
+            self.invalidate_param_values()
         return chg
 
     def serialize_params(self):
         return {n: p.params.values for n, p in self.all_params.items()}
 
     def deserialize_params(self, rec_params):
+        self.invalidate_param_values()
         for item, vals in rec_params.items():
+            if item in self.node_dict.keys():
+                vals = self.node_dict[item].upgrade_params(vals)
             self.all_params[item].params.values = vals
             if item != "diagnostics" and item != "reset":
                 self.node_dict[item].changed(vals)
@@ -186,34 +237,98 @@ class Pipeline:
             for node in self.node_dict.values():
                 node.reset()
 
-    def recursive_run(self, node: PipelineNode, *input_data):
-        output = node.process(*input_data)
-        if isinstance(node, ImageToDataNode):
-            return output
+    def compile(self):
+        """ Flattens the tree into a list of node calls in pre-order, each
+        reading the output of its parent from a list of slots. The outputs of
+        the data nodes are concatenated, in the same order, into the output
+        of the pipeline.
+        """
+        self._plan = []
+        self._data_slots = []
+        self._data_nodes = []
+        self._timed_nodes = [
+            node for node in PreOrderIter(self.root) if node.uses_frame_time
+        ]
+
+        def add_node(node, i_input):
+            i_output = len(self._plan) + 1
+            self._plan.append((node.process, i_input, i_output, node.strpath))
+            if isinstance(node, ImageToDataNode):
+                self._data_slots.append(i_output)
+                self._data_nodes.append(node)
+            else:
+                for child in node.children:
+                    add_node(child, i_output)
 
-        child_outputs = tuple(
-            self.recursive_run(child, output.data) for child in node.children
-        )
-        if node._output_type is None or node.output_type_changed:
-            node._output_type = namedtuple(
-                "o", chain.from_iterable(map(lambda x: x.data._fields, child_outputs))
+        add_node(self.root, 0)
+        self._slot_values = [None] * (len(self._plan) + 1)
+        self._output_type = None
+
+    def _set_output_layout(self):
+        """ Makes the output type and the slices of the output record
+        which are filled with the outputs of each data node
+        """
+        fields = []
+        self._output_slices = []
+        for i_slot in self._data_slots:
+            node_fields = self._slot_values[i_slot]._fields
+            self._output_slices.append(
+                slice(len(fields), len(fields) + len(node_fields))
             )
+            fields.extend(node_fields)
+        self._output_type = namedtuple("o", fields)
+        self._output_values = [None] * len(fields)
 
-        # collect all diagnostic messages and return a named tuple collecting
-        # all the outputs
+    def run(self, input, frame_time=None):
+        """ Processes a frame
 
-        # first element of the tuple concatenates all lists of diagnostic messages
-        # second element makes a named tuple with fields from all the child named tuples
-        output_tuple = node._output_type(
-            *(chain.from_iterable(map(lambda x: x.data, child_outputs)))
-        )
-        return NodeOutput(
-            output.messages
-            + list(chain.from_iterable(map(lambda x: x.messages, child_outputs))),
-            output_tuple,
-        )
+        Parameters
+        ----------
+        input
+            the frame
+        frame_time
+            the time of the frame, as a datetime or in seconds, passed to the
+            nodes which use it
 
-    def run(self, input):
-        out = self.recursive_run(self.root, input)
-        self.root.acknowledge_changes()
-        return out
+        """
+        if self._plan is None:
+            self.compile()
+
+        if frame_time is not None and self._timed_nodes:
+            if isinstance(frame_time, datetime):
+                frame_time = frame_time.timestamp()
+            for node in self._timed_nodes:
+                node.frame_time = frame_time
+
+        values = self._slot_values
+        values[0] = input
+        messages = []
+        if self.timer is None:
+            for process, i_input, i_output, _ in self._plan:
+                output = process(values[i_input])
+                if output.messages:
+                    messages.extend(output.messages)
+                values[i_output] = output.data
+        else:
+            for process, i_input, i_output, strpath in self._plan:
+                t_start = perf_counter()
+                output = process(values[i_input])
+                self.timer.add(strpath, perf_counter() - t_start)
+                if output.messages:
+                    messages.extend(output.messages)
+                values[i_output] = output.data
+
+        if self._output_type is None or any(
+            node.output_type_changed for node in self._data_nodes
+        ):
+            self._set_output_layout()
+        for node in self._data_nodes:
+            node.acknowledge_changes()
+
+        if len(self._data_slots) == 1:
+            return NodeOutput(messages, values[self._data_slots[0]])
+
+        output_values = self._output_values
+        for i_slot, output_slice in zip(self._data_slots, self._output_slices):
+            output_values[output_slice] = values[i_slot]
+        return NodeOutput(messages, self._output_type._make(output_values))
@@ -6,15 +6,51 @@
 import cv2
 
 import numpy as np
-from numba import vectorize, uint8, float32
+from numba import vectorize, jit, uint8, float32
 from lightparam import Param
 from stytra.tracking.pipelines import ImageToImageNode, NodeOutput
 
 
+@jit(nopython=True)
+def _invert_clip(im, out, invert, clip):
+    """ Inverts (if required) and clips the image in a single pass,
+    the output can be the same array as the input. The arithmetic is kept
+    in 8 bits, so that the loops are vectorized
+    """
+    c = np.uint8(clip)
+    zero = np.uint8(0)
+    if invert:
+        for i in range(im.shape[0]):
+            for j in range(im.shape[1]):
+                x = np.uint8(255) - im[i, j]
+                out[i, j] = x - c if x > c else zero
+    else:
+        for i in range(im.shape[0]):
+            for j in range(im.shape[1]):
+                x = im[i, j]
+                out[i, j] = x - c if x > c else zero
+
+
 class Prefilter(ImageToImageNode):
+    """ Resizes, smooths, inverts and clips the image. The intermediate and
+    output images are written in buffers kept by the node, so the output
+    is valid until the next frame is processed.
+    """
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, name="filtering", **kwargs)
         self.diagnostic_image_options = ["filtered"]
+        self._buffers = dict()
+
+    def _buffer(self, key, shape, dtype):
+        """ Returns the buffer for a processing step, allocating it only
+        if the image shape changes
+        """
+        buffer = self._buffers.get(key, None)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self._buffers[key] = buffer
+        return buffer
 
     def _process(
         self,
@@ -34,6 +70,47 @@ class Prefilter(ImageToImageNode):
         :param color_invert:
         :return:
         """
+        if im.dtype != np.uint8:
+            return self._process_generic(
+                im, image_scale, filter_size, color_invert, clip
+            )
+
+        input_im = im
+        if image_scale != 1:
+            # the output size is given by OpenCV, which allocates a new
+            # buffer if the size changes, and only the latest one is kept
+            im = cv2.resize(
+                im,
+                None,
+                dst=self._buffers.get("resized", None),
+                fx=image_scale,
+                fy=image_scale,
+                interpolation=cv2.INTER_AREA,
+            )
+            self._buffers["resized"] = im
+        if filter_size > 0:
+            im = cv2.boxFilter(
+                im,
+                -1,
+                (filter_size, filter_size),
+                dst=self._buffer("filtered", im.shape, im.dtype),
+            )
+        if color_invert or clip > 0:
+            # the input frame must not be modified
+            if im is input_im:
+                out = self._buffer("clipped", im.shape, im.dtype)
+            else:
+                out = im
+            _invert_clip(im, out, color_invert, clip)
+            im = out
+
+        if self.set_diagnostic == "filtered":
+            self.diagnostic_image = im
+
+        return NodeOutput([], im)
+
+    def _process_generic(self, im, image_scale, filter_size, color_invert, clip):
+        """ Processing for images which are not 8-bit """
         if image_scale != 1:
             im = cv2.resize(
                 im, None, fx=image_scale, fy=image_scale, interpolation=cv2.INTER_AREA
@@ -95,15 +172,96 @@ def absdif(xf, y):
         return y - x
 
 
+@jit(nopython=True)
+def _update_subtract(
+    im, background, diff, mask, learn, learning_rate, keep_rate, only_darker, threshold
+):
+    """ Updates the background with a running average (if learn is True),
+    and computes the difference of the image from it and, if threshold is not
+    negative, the mask of the pixels where the difference is above
+    threshold, all in a single pass over the image
+
+    Parameters
+    ----------
+    im : np.ndarray
+        8-bit image
+    background : np.ndarray
+        float32 background, updated in place
+    diff : np.ndarray
+        8-bit output for the difference
+    mask : np.ndarray
+        8-bit output for the thresholded difference (0 or 1)
+    learn : bool
+        whether the background is updated
+    learning_rate : np.float32
+        weight of the image in the update
+    keep_rate : np.float32
+        weight of the previous background in the update
+    only_darker : bool
+        whether only pixels darker than the background are kept
+    threshold : int
+        threshold for the mask, if negative the mask is not computed
+
+    """
+    zero = np.uint8(0)
+    for i in range(im.shape[0]):
+        for j in range(im.shape[1]):
+            x = im[i, j]
+            if learn:
+                background[i, j] = (
+                    np.float32(x) * learning_rate + background[i, j] * keep_rate
+                )
+            b = np.uint8(background[i, j])
+            if b > x:
+                d = b - x
+            elif only_darker:
+                d = zero
+            else:
+                d = x - b
+            diff[i, j] = d
+            if threshold >= 0:
+                mask[i, j] = np.uint8(d > threshold)
+
+
 class BackgroundSubtractor(ImageToImageNode):
+    """ Subtracts a running-average background from the image. The
+    background update and the difference are computed in place, in buffers
+    kept by the node, so the output is valid until the next frame is
+    processed.
+
+    A downstream node can request the thresholded difference through
+    :meth:`thresholded() <BackgroundSubtractor.thresholded()>`,
+    which is then computed in the same pass from the next frame on.
+    """
+
+    stateful = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, name="bgsub", **kwargs)
         self.background_image = None
         self.i = 0
 
+        self._diff = None
+        self._mask = np.zeros((0, 0), np.uint8)
+        # threshold requested by the downstream node, and the one used
+        # for the current mask
+        self.mask_threshold = None
+        self._mask_threshold_used = None
+
     def reset(self):
         self.background_image = None
 
+    def thresholded(self, threshold):
+        """ Returns the mask of the pixels where the difference with the
+        background is above threshold, if it was computed for the current
+        frame, otherwise None. The mask will be computed for the following
+        frames.
+        """
+        self.mask_threshold = threshold
+        if self._mask_threshold_used == threshold:
+            return self._mask
+        return None
+
     def _process(
         self,
         im,
@@ -112,17 +270,31 @@ class BackgroundSubtractor(ImageToImageNode):
         only_darker: Param(True),
     ):
         messages = []
-        if self.background_image is None:
+        if self.background_image is None or self.background_image.shape != im.shape:
             self.background_image = im.astype(np.float32)
             messages.append("I:New backgorund image set")
-        elif self.i == 0:
-            self.background_image[:, :] = im.astype(np.float32) * np.float32(
-                learning_rate
-            ) + self.background_image * np.float32(1 - learning_rate)
+            learn = False
+        else:
+            learn = self.i == 0
 
         self.i = (self.i + 1) % learn_every
 
-        if only_darker:
-            return NodeOutput(messages, negdif(self.background_image, im))
-        else:
-            return NodeOutput(messages, absdif(self.background_image, im))
+        if self._diff is None or self._diff.shape != im.shape:
+            self._diff = np.empty(im.shape, np.uint8)
+        if self.mask_threshold is not None and self._mask.shape != im.shape:
+            self._mask = np.empty(im.shape, np.uint8)
+
+        _update_subtract(
+            im,
+            self.background_image,
+            self._diff,
+            self._mask,
+            learn,
+            np.float32(learning_rate),
+            np.float32(1 - learning_rate),
+            only_darker,
+            -1 if self.mask_threshold is None else self.mask_threshold,
+        )
+        self._mask_threshold_used = self.mask_threshold
+
+        return NodeOutput(messages, self._diff)
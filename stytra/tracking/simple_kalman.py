@@ -3,24 +3,54 @@ import numpy as np
 
 
 @jit(nopython=True)
-def predict_inplace(x, P, F, Q):
-    x[0] = x[0] + x[1]
-    P[:, :] = np.dot(np.dot(F, P), F.T) + Q
+def predict_batch(x, P, dt, Q):
+    """ Predicts in place a batch of constant velocity filters, each with a
+    state made of a position and a velocity
+
+    Parameters
+    ----------
+    x : (n, 2) array of states
+    P : (n, 2, 2) array of state covariances
+    dt : elapsed time
+    Q : (2, 2) process noise covariance for the elapsed time
+
+    """
+    for i in range(x.shape[0]):
+        x[i, 0] += dt * x[i, 1]
+        p00, p01, p10, p11 = P[i, 0, 0], P[i, 0, 1], P[i, 1, 0], P[i, 1, 1]
+        P[i, 0, 0] = p00 + dt * (p01 + p10) + dt * dt * p11 + Q[0, 0]
+        P[i, 0, 1] = p01 + dt * p11 + Q[0, 1]
+        P[i, 1, 0] = p10 + dt * p11 + Q[1, 0]
+        P[i, 1, 1] = p11 + Q[1, 1]
 
 
 @jit(nopython=True)
-def update_inplace(z, x, P, R):
-    # error (residual) between measurement and prediction
-    y = z - x[0]
-
-    # project system uncertainty into measurement space
-    S = P[0, 0] + R
-    K = P[:, 0] / S
-
-    x[:] = x + K * y
-
-    I_KH = np.eye(2)
-    I_KH[0, 0] -= K[0]
-    I_KH[1, 0] = -K[1]
-
-    P[:, :] = ((I_KH @ P) @ I_KH.T) + R * (K @ K.T)
+def update_batch(z, x, P, R, indices):
+    """ Updates in place some filters of a batch of constant velocity filters
+    with measurements of their positions, in the Joseph form
+
+    Parameters
+    ----------
+    z : (m,) array of measured positions
+    x : (n, 2) array of states
+    P : (n, 2, 2) array of state covariances
+    R : measurement variance
+    indices : (m,) array of the filters which are measured
+
+    """
+    for j in range(indices.shape[0]):
+        i = indices[j]
+        p00, p01, p10, p11 = P[i, 0, 0], P[i, 0, 1], P[i, 1, 0], P[i, 1, 1]
+        s = p00 + R
+        k0 = p00 / s
+        k1 = p10 / s
+        y = z[j] - x[i, 0]
+        x[i, 0] += k0 * y
+        x[i, 1] += k1 * y
+
+        # (I - KH) P (I - KH)^T + K R K^T
+        a00 = 1.0 - k0
+        P[i, 0, 0] = a00 * a00 * p00 + R * k0 * k0
+        P[i, 0, 1] = a00 * (p01 - k1 * p00) + R * k0 * k1
+        P[i, 1, 0] = a00 * (p10 - k1 * p00) + R * k0 * k1
+        P[i, 1, 1] = p11 - k1 * (p01 + p10) + k1 * k1 * p00 + R * k1 * k1
@@ -32,11 +32,49 @@ class TailTrackingMethod(ImageToDataNode):
 class CentroidTrackingMethod(TailTrackingMethod):
     """Center-of-mass method to find consecutive segments."""
 
+    # resting angles and the temporal filter depend on previous frames
+    stateful = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.resting_angles = None
         self.previous_angles = None
 
+        # directions of the segments in the previous frame, used as a starting
+        # guess for the search of the segments in the following one
+        self.previous_segment_angles = None
+
+        # the disc window for the center-of-mass calculation
+        self._disc = None
+        self._interpolation = None
+        self._rois = None
+
+    def reset(self):
+        super().reset()
+        self.previous_segment_angles = None
+
+    def _interpolation_grid(self, n_segments, n_output_segments):
+        """Returns the positions along the tail of the output segments and
+        of the tracked segments, computed once for each number of segments
+        """
+        key = (n_segments, n_output_segments)
+        if self._interpolation is None or self._interpolation[0] != key:
+            self._interpolation = (
+                key,
+                np.linspace(0, 1, n_output_segments),
+                np.linspace(0, 1, n_segments),
+            )
+        return self._interpolation[1:]
+
+    def _disc_offsets(self, window_size):
+        """Returns the offsets and the weights of the pixels in the disc
+        in which the center of mass is calculated, computed once for each
+        window size
+        """
+        if self._disc is None or self._disc[0] != window_size:
+            self._disc = (window_size,) + _disc_kernel(window_size / 2)
+        return self._disc[1:]
+
     def _process(
         self,
         im,
@@ -82,80 +120,217 @@ class CentroidTrackingMethod(TailTrackingMethod):
             list of cumulative sum + list of angles
 
         """
-        messages = []
-        start_y, start_x = tail_start
-        tail_length_y, tail_length_x = tail_length
-
-        scale = im.shape[0]
-
-        # Calculate tail length:
-        length_tail = np.sqrt(tail_length_x ** 2 + tail_length_y ** 2) * scale
+        # the state is reset along with the output type, before tracking
+        if self._output_type is None:
+            self.reset()
 
-        # Segment length from tail length and n of segments:
-        seg_length = length_tail / n_segments
+        messages = []
+        angles = self._track_tails(
+            im,
+            [tail_start],
+            [tail_length],
+            n_segments,
+            tail_filter_width,
+            time_filter_weight,
+            n_output_segments,
+            reset_zero,
+            window_size,
+            messages,
+        )[0]
 
-        n_segments += 1
+        # Total curvature as sum of the last 2 angles - sum of the first 2
+        return NodeOutput(
+            messages,
+            self._output_type(angles[-1] + angles[-2] - angles[0] - angles[1], *angles),
+        )
 
-        # Initial displacements in x and y:
-        disp_x = tail_length_x * scale / n_segments
-        disp_y = tail_length_y * scale / n_segments
+    def _track_tails(
+        self,
+        im,
+        tail_starts,
+        tail_lengths,
+        n_segments,
+        tail_filter_width,
+        time_filter_weight,
+        n_output_segments,
+        reset_zero,
+        window_size,
+        messages,
+    ):
+        """Finds the segments of one or more tails in the image, all
+        in a single jitted call
 
-        angles = np.full(n_segments - 1, np.nan)
-        start_x *= scale
-        start_y *= scale
+        Returns
+        -------
+        array of the angles of the output segments, one row per tail
 
-        halfwin = window_size / 2
-        for i in range(1, n_segments):
-            # Use next segment function for find next point
-            # with center-of-mass displacement:
-            start_x, start_y, disp_x, disp_y, acc = _next_segment(
-                im, start_x, start_y, disp_x, disp_y, halfwin, seg_length
+        """
+        n_tails = len(tail_starts)
+        if self._rois is None or self._rois[0] != (tail_starts, tail_lengths):
+            self._rois = (
+                (tail_starts, tail_lengths),
+                np.array(tail_starts, dtype=np.float64),
+                np.array(tail_lengths, dtype=np.float64),
             )
-            if start_x < 0:
-                messages.append("W:segment {} not detected".format(i))
-                break
 
-            abs_angle = np.arctan2(disp_x, disp_y)
-            angles[i - 1] = abs_angle
+        # start from the segment directions found in the previous frame
+        shape = (n_tails, n_segments)
+        if (
+            self.previous_segment_angles is None
+            or self.previous_segment_angles.shape != shape
+        ):
+            self.previous_segment_angles = np.full(shape, np.nan)
+
+        angles = _tail_chains(
+            im,
+            self._rois[1],
+            self._rois[2],
+            self.previous_segment_angles,
+            *self._disc_offsets(window_size)
+        )
+        self.previous_segment_angles = angles
 
-        # we want angles to be continuous, this removes potential 2pi discontinuities
-        angles = np.unwrap(angles)
+        # the segments after one which is not detected are all missing
+        for i_tail in np.flatnonzero(np.isnan(angles[:, -1])):
+            n_detected = np.argmax(np.isnan(angles[i_tail]))
+            if n_tails == 1:
+                messages.append("W:segment {} not detected".format(n_detected + 1))
+            else:
+                messages.append(
+                    "W:tail {} segment {} not detected".format(i_tail, n_detected + 1)
+                )
 
         # we do not need to record a large amount of angles
         if tail_filter_width > 0:
-            angles = gaussian_filter1d(angles, tail_filter_width, mode="nearest")
+            angles = gaussian_filter1d(
+                angles, tail_filter_width, axis=1, mode="nearest"
+            )
 
-        angles = np.interp(
-            np.linspace(0, 1, n_output_segments),
-            np.linspace(0, 1, n_segments - 1),
-            angles,
-        )
         # Interpolate to the desired number of output segments
+        angles = _interpolate_rows(
+            angles, *self._interpolation_grid(n_segments, n_output_segments)
+        )
 
         if reset_zero:
-            if self.resting_angles is None or len(self.resting_angles) != len(angles):
+            if self.resting_angles is None or self.resting_angles.shape != angles.shape:
                 self.resting_angles = angles
             else:
                 self.resting_angles = self.resting_angles * 0.5 + angles * 0.5
         else:
-            if self.resting_angles is not None:
-                angles = angles - self.resting_angles + self.resting_angles[0]
-
-        if time_filter_weight > 0 and self.previous_angles is not None:
+            if (
+                self.resting_angles is not None
+                and self.resting_angles.shape == angles.shape
+            ):
+                angles = angles - self.resting_angles + self.resting_angles[:, :1]
+
+        if (
+            time_filter_weight > 0
+            and self.previous_angles is not None
+            and self.previous_angles.shape == angles.shape
+        ):
             angles = (
                 time_filter_weight * self.previous_angles
                 + (1 - time_filter_weight) * angles
             )
 
         self.previous_angles = angles
+        return angles
+
+
+def resize_tail_rois(tail_starts, tail_lengths, n_tails):
+    """Adds or removes tail ROIs so that there are n_tails of them,
+    the new ones are placed below the last one
+
+    Returns
+    -------
+    the lists of tail starting points and tail lengths
+
+    """
+    tail_starts = [tuple(ts) for ts in tail_starts[:n_tails]]
+    tail_lengths = [tuple(tl) for tl in tail_lengths[:n_tails]]
+    while len(tail_starts) < n_tails:
+        last_y, last_x = tail_starts[-1]
+        tail_starts.append(((last_y + 0.2) % 1, last_x))
+        tail_lengths.append(tail_lengths[-1])
+    return tail_starts, tail_lengths
+
+
+class MultiTailTrackingMethod(CentroidTrackingMethod):
+    """Center-of-mass method to find the tails of several embedded fish
+    in the same image."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.monitored_headers = ["f0_tail_sum"]
+
+    def changed(self, vals):
+        if "n_tails" in vals.keys() or "n_output_segments" in vals.keys():
+            self.reset()
+
+    def reset(self):
+        super().reset()
+        fields = []
+        for i_tail in range(self._params.n_tails):
+            fields.append("f{}_tail_sum".format(i_tail))
+            fields.extend(
+                "f{}_theta_{:02}".format(i_tail, i)
+                for i in range(self._params.n_output_segments)
+            )
+        self._output_type = namedtuple("t", fields)
+        self._output_type_changed = True
+
+    def _process(
+        self,
+        im,
+        n_tails: Param(1, (1, 30)),
+        tail_starts: Param([(0.47, 1.7)], gui=False),
+        tail_lengths: Param([(0.07, -1.36)], gui=False),
+        n_segments: Param(12, (1, 50)),
+        tail_filter_width: Param(0.0, (0.0, 10.0)),
+        time_filter_weight: Param(0.0, (0.0, 1.0)),
+        n_output_segments: Param(9, (1, 30)),
+        reset_zero: Param(False),
+        window_size: Param(7, (1, 15)),
+        **extraparams
+    ):
+        """Finds the tails of n_tails embedded fish, given the starting
+        points and the directions of the tails, (y, x) in units of the
+        image height. If there are less tail regions than n_tails, they
+        are added below the last one.
+
+        Returns
+        -------
+        tail sum and angles for each tail
 
+        """
         if self._output_type is None:
             self.reset()
 
+        messages = []
+        if len(tail_starts) != n_tails or len(tail_lengths) != n_tails:
+            tail_starts, tail_lengths = resize_tail_rois(
+                tail_starts, tail_lengths, n_tails
+            )
+        angles = self._track_tails(
+            im,
+            tail_starts,
+            tail_lengths,
+            n_segments,
+            tail_filter_width,
+            time_filter_weight,
+            n_output_segments,
+            reset_zero,
+            window_size,
+            messages,
+        )
+
         # Total curvature as sum of the last 2 angles - sum of the first 2
+        tail_sums = angles[:, -1] + angles[:, -2] - angles[:, 0] - angles[:, 1]
         return NodeOutput(
             messages,
-            self._output_type(angles[-1] + angles[-2] - angles[0] - angles[1], *angles),
+            self._output_type._make(
+                np.concatenate([tail_sums[:, None], angles], 1).ravel()
+            ),
         )
 
 
@@ -347,6 +522,204 @@ def _next_segment(fc, xm, ym, dx, dy, halfwin, next_point_dist):
     return xm + dx, ym + dy, dx, dy, acc
 
 
+def _disc_kernel(halfwin):
+    """Offsets of the pixels of a disc of radius halfwin around a point,
+    with weights going smoothly to 0 at the border of the disc, so that
+    the center of mass changes continuously with the position of the disc
+
+    Returns
+    -------
+    tuple of the x and y offsets and the weights
+
+    """
+    r = int(np.ceil(halfwin + 0.5))
+    off_y, off_x = np.mgrid[-r : r + 1, -r : r + 1]
+    weights = np.clip(halfwin + 0.5 - np.sqrt(off_x ** 2 + off_y ** 2), 0, 1)
+    inside = weights > 0
+    return (
+        off_x[inside].astype(np.int64),
+        off_y[inside].astype(np.int64),
+        weights[inside].astype(np.float64),
+    )
+
+
+@jit(nopython=True)
+def _disc_center_of_mass(im, cx, cy, off_x, off_y, off_w):
+    """Center of mass of the image in a disc centered at (cx, cy),
+    interpolating the image bilinearly
+
+    Returns
+    -------
+    the total mass and the x and y coordinates of the center of mass
+
+    """
+    y_max, x_max = im.shape
+    ix = int(np.floor(cx))
+    iy = int(np.floor(cy))
+    fx = cx - ix
+    fy = cy - iy
+    w00 = (1 - fx) * (1 - fy)
+    w01 = fx * (1 - fy)
+    w10 = (1 - fx) * fy
+    w11 = fx * fy
+
+    acc = 0.0
+    acc_x = 0.0
+    acc_y = 0.0
+    for k in range(len(off_w)):
+        x = ix + off_x[k]
+        y = iy + off_y[k]
+        if x < 0 or y < 0 or x + 1 >= x_max or y + 1 >= y_max:
+            continue
+        val = off_w[k] * (
+            w00 * im[y, x]
+            + w01 * im[y, x + 1]
+            + w10 * im[y + 1, x]
+            + w11 * im[y + 1, x + 1]
+        )
+        acc += val
+        acc_x += val * off_x[k]
+        acc_y += val * off_y[k]
+
+    if acc == 0:
+        return 0.0, cx, cy
+    return acc, cx + acc_x / acc, cy + acc_y / acc
+
+
+@jit(nopython=True)
+def _tail_chain(im, xm, ym, dx, dy, seg_length, prior_angles, off_x, off_y, off_w):
+    """Finds the consecutive tail segments from the center of mass of
+    the image in a disc ahead of each segment
+
+    Parameters
+    ----------
+    im :
+        image to find tail
+    xm :
+        starting point x
+    ym :
+        starting point y
+    dx :
+        initial displacement x
+    dy :
+        initial displacement y
+    seg_length :
+        length of the segments
+    prior_angles :
+        angles of the segments in the previous frame, where the disc is
+        centered first, or NaN to continue in the direction of the
+        previous segment
+    off_x :
+        x offsets of the disc pixels
+    off_y :
+        y offsets of the disc pixels
+    off_w :
+        weights of the disc pixels
+
+    Returns
+    -------
+    array of angles of the segments, made continuous, NaN for the ones
+    not detected
+
+    """
+    n_segments = len(prior_angles)
+    angles = np.full(n_segments, np.nan)
+    for i in range(n_segments):
+        acc = 0.0
+        if not np.isnan(prior_angles[i]):
+            acc, com_x, com_y = _disc_center_of_mass(
+                im,
+                xm + seg_length * np.sin(prior_angles[i]),
+                ym + seg_length * np.cos(prior_angles[i]),
+                off_x,
+                off_y,
+                off_w,
+            )
+        # if the tail moved too much, continue in the direction of the
+        # previous segment
+        if acc == 0:
+            acc, com_x, com_y = _disc_center_of_mass(
+                im, xm + dx, ym + dy, off_x, off_y, off_w
+            )
+        if acc == 0:
+            break
+
+        # center of mass relative to the starting points
+        mn_x = com_x - xm
+        mn_y = com_y - ym
+
+        # normalise to segment length
+        a = np.sqrt(mn_y ** 2 + mn_x ** 2) / seg_length
+        if a == 0:
+            break
+
+        dx = mn_x / a
+        dy = mn_y / a
+        xm += dx
+        ym += dy
+        angles[i] = np.arctan2(dx, dy)
+
+        # remove the 2pi discontinuities between the segments
+        if i > 0:
+            angles[i] = angles[i - 1] + reduce_to_pi(angles[i] - angles[i - 1])
+
+    return angles
+
+
+@jit(nopython=True)
+def _tail_chains(im, tail_starts, tail_lengths, prior_angles, off_x, off_y, off_w):
+    """Finds the segments of several tails with _tail_chain
+
+    Parameters
+    ----------
+    im :
+        image to find the tails
+    tail_starts :
+        (n_tails, 2) array of starting points (y, x), in units of the
+        image height
+    tail_lengths :
+        (n_tails, 2) array of tail lengths (y, x), in units of the
+        image height
+    prior_angles :
+        (n_tails, n_segments) array of the angles of the segments in the
+        previous frame
+
+    Returns
+    -------
+    array of angles of the segments, one row per tail
+
+    """
+    scale = im.shape[0]
+    n_segments = prior_angles.shape[1]
+    angles = np.empty_like(prior_angles)
+    for i in range(tail_starts.shape[0]):
+        length_y = tail_lengths[i, 0] * scale
+        length_x = tail_lengths[i, 1] * scale
+        seg_length = np.sqrt(length_x ** 2 + length_y ** 2) / n_segments
+        angles[i, :] = _tail_chain(
+            im,
+            tail_starts[i, 1] * scale,
+            tail_starts[i, 0] * scale,
+            length_x / (n_segments + 1),
+            length_y / (n_segments + 1),
+            seg_length,
+            prior_angles[i],
+            off_x,
+            off_y,
+            off_w,
+        )
+    return angles
+
+
+@jit(nopython=True)
+def _interpolate_rows(values, x_output, x):
+    """Linearly interpolates each row of values, sampled at x, at x_output"""
+    output = np.empty((values.shape[0], len(x_output)))
+    for i in range(values.shape[0]):
+        output[i, :] = np.interp(x_output, x, values[i])
+    return output
+
+
 @jit(nopython=True)
 def _tail_trace_core_ls(img, start_x, start_y, disp_x, disp_y, num_points, tail_length):
     """Tail tracing based on min (or max) detection on arches. Wrapped by
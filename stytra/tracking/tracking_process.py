@@ -1,8 +1,8 @@
 from queue import Empty, Full
-from multiprocessing import Event, Value
+from multiprocessing import Event, Value, Queue
+from time import perf_counter
 
-from stytra.utilities import FrameProcess
-from arrayqueues.shared_arrays import TimestampedArrayQueue
+from stytra.utilities import FrameProcess, TimingRecorder
 
 
 class TrackingProcess(FrameProcess):
@@ -26,7 +26,9 @@ class TrackingProcess(FrameProcess):
         output_queue=None,
         recording_signal=None,
         gui_framerate=30,
-        max_mb_queue=100,
+        gui_dispatcher=True,
+        timing_interval=None,
+        acquisition_times=None,
         **kwargs
     ):
         """
@@ -34,8 +36,10 @@ class TrackingProcess(FrameProcess):
 
         Parameters
         ----------
-        in_frame_queue:
-            queue dispatching frames from camera
+        in_frame_queue: FrameQueue
+            queue dispatching frames from camera, the frames sent to the
+            recording and the GUI are not copied but sent through other
+            queues of the same frame pool
         finished_signal
             signal for the end of the acquisition
         pipeline: Pipeline
@@ -49,10 +53,17 @@ class TrackingProcess(FrameProcess):
         processing_counter
         gui_framerate: int
             target framerate of the display GUI
-        gui_dispatcher
-
-        max_mb_queue: int (200)
-            the maximal size of the image output queues
+        gui_dispatcher: bool (True)
+            whether this process sends frames to the GUI, if there are
+            several tracking processes only one of them does
+        timing_interval: float
+            if not None, the durations of the pipeline nodes and of the
+            steps of the tracking loop are recorded, and their histograms
+            are put in the timing_queue every timing_interval seconds
+        acquisition_times:
+            if not None, the shared array of the acquisition times of the
+            frames of the camera, which are put in the output queue with the
+            time at which the frame is tracked, to measure the latency
 
         kwargs
         """
@@ -60,25 +71,34 @@ class TrackingProcess(FrameProcess):
         super().__init__(name="tracking", **kwargs)
 
         self.frame_queue = in_frame_queue
-        self.gui_queue = TimestampedArrayQueue(max_mbytes=max_mb_queue)  # GUI queue for
+        # GUI queue for displaying the image
+        if gui_dispatcher:
+            self.gui_queue = in_frame_queue.pool.new_queue(max_pending=4)
+        else:
+            self.gui_queue = None
 
         self.recording_signal = recording_signal
         if recording_signal is not None:
-            self.frame_copy_queue = TimestampedArrayQueue(max_mbytes=max_mb_queue)
+            self.frame_copy_queue = in_frame_queue.pool.new_queue()
         else:
             self.frame_copy_queue = None
 
-        #  displaying
-        #  the image
         self.output_queue = output_queue  # queue for processing output (e.g., pos)
         self.processing_parameter_queue = processing_parameter_queue
 
         self.finished_signal = finished_signal
         self.gui_framerate = gui_framerate
+        self.gui_dispatcher = gui_dispatcher
 
         self.pipeline_cls = pipeline
         self.pipeline = None
 
+        self.timing_interval = timing_interval
+        self.timing_queue = Queue() if timing_interval is not None else None
+        self.timer = None
+
+        self.acquisition_times = acquisition_times
+
         self.i = 0
 
     def process_internal(self, frame):
@@ -111,6 +131,12 @@ class TrackingProcess(FrameProcess):
         self.pipeline = self.pipeline_cls()
         self.pipeline.setup()
 
+        if self.timing_interval is not None:
+            self.timer = TimingRecorder()
+            self.pipeline.timer = self.timer
+        t_last_timing = perf_counter()
+        t_wait_start = perf_counter()
+
         while not self.finished_signal.is_set():
 
             # Gets the processing parameters from their queue
@@ -119,42 +145,73 @@ class TrackingProcess(FrameProcess):
             # Gets frame from its queue, if the input is too fast, drop frames
             # and process the latest, if it is too slow continue:
             try:
-                time, frame_idx, frame = self.frame_queue.get(timeout=0.001)
+                time, frame_idx, slot, frame = self.frame_queue.get(timeout=0.001)
             except Empty:
                 continue
 
+            if self.timer is not None:
+                t_frame_start = perf_counter()
+                self.timer.add("queue_wait", t_frame_start - t_wait_start)
+
             messages = []
-            # If we are copying the frames to another queue (e.g. for video recording), do it here
+            # If we are sending the frames to another queue (e.g. for video recording), do it here
             if self.recording_signal is not None and self.recording_signal.is_set():
                 try:
-                    self.frame_copy_queue.put(frame.copy(), timestamp=time)
-                except:
+                    self.frame_queue.forward(
+                        self.frame_copy_queue, time, frame_idx, slot
+                    )
+                except Full:
                     messages.append("W:Dropping frames from recording")
 
             # If a processing function is specified, apply it:
 
-            new_messages, output = self.pipeline.run(frame)
+            new_messages, output = self.pipeline.run(frame, time)
+
+            if self.timer is not None:
+                t_pipeline_end = perf_counter()
+                self.timer.add("pipeline", t_pipeline_end - t_frame_start)
+
+            if self.acquisition_times is not None:
+                latency_times = (
+                    self.acquisition_times[frame_idx % len(self.acquisition_times)],
+                    perf_counter(),
+                )
+            else:
+                latency_times = None
+
+            try:
+                self.output_queue.put(time, output, frame_idx, latency_times)
+            except Full:
+                messages.append("W:Tracking output queue full")
+
+            if self.timer is not None:
+                t_output_end = perf_counter()
+                self.timer.add("output_dispatch", t_output_end - t_pipeline_end)
 
             for msg in messages + new_messages:
                 self.message_queue.put(msg)
 
-            self.output_queue.put(time, output)
-
             # calculate the frame rate
             self.update_framerate()
 
             # put current frame into the GUI queue
-            self.send_to_gui(
-                time,
-                self.pipeline.diagnostic_image
-                if self.pipeline.diagnostic_image is not None
-                else frame,
-            )
+            if self.gui_dispatcher:
+                self.send_to_gui(time, frame_idx, slot)
+
+            self.frame_queue.release(slot)
+
+            if self.timer is not None:
+                t_wait_start = perf_counter()
+                self.timer.add("gui_dispatch", t_wait_start - t_output_end)
+                if t_wait_start - t_last_timing > self.timing_interval:
+                    self.timing_queue.put(self.timer.pop())
+                    t_last_timing = t_wait_start
 
         return
 
-    def send_to_gui(self, frametime, frame):
-        """ Sends the current frame to the GUI queue at the appropriate framerate"""
+    def send_to_gui(self, frametime, frame_idx, slot):
+        """ Sends the current frame, or the diagnostic image of the pipeline
+        if there is one, to the GUI queue at the appropriate framerate"""
         if self.framerate_rec.current_framerate:
             every_x = max(
                 int(self.framerate_rec.current_framerate / self.gui_framerate), 1
@@ -163,7 +220,12 @@ class TrackingProcess(FrameProcess):
             every_x = 1
         if self.i == 0:
             try:
-                self.gui_queue.put(frame, timestamp=frametime)
+                if self.pipeline.diagnostic_image is not None:
+                    self.gui_queue.put(
+                        self.pipeline.diagnostic_image, frametime, frame_idx
+                    )
+                else:
+                    self.frame_queue.forward(self.gui_queue, frametime, frame_idx, slot)
             except Full:
                 self.message_queue.put("E:GUI queue full")
 
@@ -192,7 +254,7 @@ class DispatchProcess(FrameProcess):
         **kwargs
     ):
         """
-        :param in_frame_queue: queue dispatching frames from camera
+        :param in_frame_queue: FrameQueue dispatching frames from camera
         :param finished_evt: signal for the end of the acquisition
         :param processing_parameter_queue: queue for function&parameters
         :param gui_framerate: framerate of the display GUI
@@ -200,9 +262,9 @@ class DispatchProcess(FrameProcess):
         super().__init__(name="tracking", **kwargs)
 
         self.frame_queue = in_frame_queue
-        self.gui_queue = TimestampedArrayQueue(max_mbytes=600)  # GUI queue
-        # for displaying the image
-        self.output_frame_queue = TimestampedArrayQueue(max_mbytes=600)
+        # GUI queue for displaying the image
+        self.gui_queue = in_frame_queue.pool.new_queue(max_pending=4)
+        self.output_frame_queue = in_frame_queue.pool.new_queue()
 
         self.dispatching_set_evt = dispatching_set_evt
         self.finished_signal = finished_evt
@@ -219,22 +281,28 @@ class DispatchProcess(FrameProcess):
             # Gets frame from its queue, if the input is too fast, drop frames
             # and process the latest, if it is too slow continue:
             try:
-                time, frame_idx, frame = self.frame_queue.get(timeout=0.001)
+                time, frame_idx, slot, frame = self.frame_queue.get(timeout=0.001)
             except Empty:
                 continue
 
             if self.dispatching_set_evt.is_set():
-                self.output_frame_queue.put(frame.copy(), time)
+                try:
+                    self.frame_queue.forward(
+                        self.output_frame_queue, time, frame_idx, slot
+                    )
+                except Full:
+                    self.message_queue.put("W:Dropping frames from recording")
 
             # put current frame into the GUI queue
-            self.send_to_gui(time, frame)
+            self.send_to_gui(time, frame_idx, slot)
+            self.frame_queue.release(slot)
 
             # calculate the frame rate
             self.update_framerate()
 
         return
 
-    def send_to_gui(self, frametime, frame):
+    def send_to_gui(self, frametime, frame_idx, slot):
         """ Sends the current frame to the GUI queue at the appropriate framerate"""
         if self.framerate_rec.current_framerate:
             every_x = max(
@@ -243,5 +311,8 @@ class DispatchProcess(FrameProcess):
         else:
             every_x = 1
         if self.i == 0:
-            self.gui_queue.put(frame, timestamp=frametime)
+            try:
+                self.frame_queue.forward(self.gui_queue, frametime, frame_idx, slot)
+            except Full:
+                pass
         self.i = (self.i + 1) % every_x
@@ -1,5 +1,6 @@
 import datetime
 import json
+import math
 import time
 from collections import OrderedDict
 from multiprocessing import Process, Queue
@@ -71,6 +72,69 @@ class FramerateRecorder:
         self.i_fps = (self.i_fps + 1) % self.n_fps_frames
 
 
+class TimingRecorder:
+    """Collects histograms of durations (e.g. of the steps of the tracking),
+    in logarithmically spaced bins from 1 us to 10 s. Durations outside the
+    range are counted in the first and last bins.
+    """
+
+    min_exponent = -6
+    max_exponent = 1
+    bins_per_decade = 10
+    n_bins = (max_exponent - min_exponent) * bins_per_decade
+    bin_edges = 10.0 ** (min_exponent + np.arange(n_bins + 1) / bins_per_decade)
+
+    def __init__(self):
+        self.histograms = dict()
+        self.totals = dict()
+
+    def add(self, name, duration):
+        """Counts a duration in seconds for the named step"""
+        try:
+            histogram = self.histograms[name]
+        except KeyError:
+            histogram = self.histograms[name] = [0] * self.n_bins
+            self.totals[name] = 0.0
+        if duration > 0:
+            i_bin = int(
+                (math.log10(duration) - self.min_exponent) * self.bins_per_decade
+            )
+            i_bin = min(max(i_bin, 0), self.n_bins - 1)
+        else:
+            i_bin = 0
+        histogram[i_bin] += 1
+        self.totals[name] += duration
+
+    def pop(self):
+        """Returns the histograms collected so far and starts new ones
+
+        Returns
+        -------
+        dict
+            for each step, a tuple of the counts in every bin and the
+            total duration
+
+        """
+        collected = {
+            name: (np.array(histogram), self.totals[name])
+            for name, histogram in self.histograms.items()
+        }
+        self.histograms = dict()
+        self.totals = dict()
+        return collected
+
+    @classmethod
+    def percentile(cls, counts, q):
+        """Estimates a percentile from a histogram, as the upper edge of the bin
+        where the percentile falls
+        """
+        cumulative = np.cumsum(counts)
+        if cumulative[-1] == 0:
+            return np.nan
+        i_bin = np.searchsorted(cumulative, cumulative[-1] * q / 100)
+        return cls.bin_edges[i_bin + 1]
+
+
 class FrameProcess(Process):
     """A basic class for a process that deals with frames. It provides
     framerate calculation.
@@ -272,7 +336,7 @@ def save_df(df, path, fileformat):
     elif fileformat == "feather":
         df.to_feather(outpath)
     elif fileformat == "hdf5":
-        df.to_hdf(outpath, "/data", complib="blosc", complevel=5)
+        df.to_hdf(outpath, key="/data", complib="blosc", complevel=5)
     elif fileformat == "json":
         json.dump(df.to_dict(), open(str(outpath), "w"))
     else: